@@ -2,13 +2,29 @@ from __future__ import annotations
 
 import copy
 import datetime
+import hashlib
 import posixpath
 from pathlib import Path
-from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import importlib_resources
 import tzlocal
 
+if TYPE_CHECKING:
+    from .tracking import Reads
+
 __version__ = "1.27.0"
 
 YAML_ENCODING = "utf-8"
@@ -49,6 +65,10 @@ IGNORE = [
 
 METADATA_FILE_SUFFIX = ".props.yml"
 
+# process: builder processes, thread: builder threads in this process,
+# serial: build in this process without concurrency.
+EXECUTORS = ("process", "thread", "serial")
+
 PathTuple = Tuple[str, ...]
 ContentPath = Tuple[PathTuple, str]
 
@@ -110,8 +130,18 @@ class ContentSrc(NamedTuple):
             assert self.srcpath
             return open(self.srcpath, "rb").read()
 
+    def digest(self) -> str:
+        return get_digest(self.read_bytes())
+
+
+DependsRecord = Tuple[ContentSrc, Set[ContentPath], Set[str], "Reads"]
+DependsDict = Mapping[ContentPath, DependsRecord]
+
+
+def get_digest(data: bytes) -> str:
+    """Hash of file contents to detect updated files"""
 
-DependsDict = Dict[ContentPath, Tuple[ContentSrc, Set[ContentPath], Set[str]]]
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
 def repr_contentpath(path: ContentPath) -> str:
@@ -188,6 +218,7 @@ class OutputInfo(NamedTuple):
     updated: Union[datetime.date, datetime.datetime, None]
     sitemap: bool
     sitemap_priority: float
+    buildtime: float = 0.0
 
 
-BuildResult = List[Tuple[ContentSrc, Set[ContentPath], Sequence[OutputInfo]]]
+BuildResult = List[Tuple[ContentSrc, Set[ContentPath], Sequence[OutputInfo], "Reads"]]
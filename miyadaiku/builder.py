@@ -1,18 +1,29 @@
 from __future__ import annotations
 
 import asyncio
+import collections
+import heapq
+import itertools
 import logging
+import math
 import multiprocessing
 import os
 import pickle
+import sys
 import tempfile
+import threading
+import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
 from typing import (
     TYPE_CHECKING,
     Any,
     Dict,
+    Iterable,
+    Iterator,
     List,
+    NamedTuple,
     Optional,
     Sequence,
     Set,
@@ -32,7 +43,22 @@ from miyadaiku import (
     repr_contentpath,
 )
 
-from . import context, depends, extend, mp_log, sitemap
+from . import (
+    context,
+    depends,
+    explain,
+    extend,
+    fragments,
+    mp_log,
+    profiling,
+    sitemap,
+    tracking,
+)
+
+try:
+    import resource
+except ImportError:
+    resource = None  # type: ignore
 
 if TYPE_CHECKING:
     from .contents import Content
@@ -43,6 +69,16 @@ global logger
 logger = logging.getLogger(__name__)
 
 
+def _get_content_size(content: Content) -> int:
+    size = content.get_body_size()
+    if size is not None:
+        return size
+    try:
+        return int(content.src.stat().st_size)
+    except (OSError, AssertionError):
+        return 0
+
+
 class Builder:
     contentpath: ContentPath
 
@@ -53,6 +89,10 @@ class Builder:
     def __init__(self, content: Content) -> None:
         self.contentpath = content.src.contentpath
 
+    def estimate_size(self, site: Site) -> int:
+        content = site.files.get_content(self.contentpath)
+        return _get_content_size(content)
+
     def build_context(self, site: Site, jinjaenv: Environment) -> context.OutputContext:
         content = site.files.get_content(self.contentpath)
         contexttype = context.CONTEXTS.get(
@@ -160,6 +200,13 @@ class IndexBuilder(Builder):
 
         return ret
 
+    def estimate_size(self, site: Site) -> int:
+        # index pages render abstracts of the listed articles
+        size = super().estimate_size(site)
+        for path in self.items:
+            size += _get_content_size(site.files.get_content(path))
+        return size
+
     def build_context(self, site: Site, jinjaenv: Environment) -> context.OutputContext:
         items = [site.files.get_content(path) for path in self.items]
         return context.IndexOutput(
@@ -188,6 +235,43 @@ class IndexBuilder(Builder):
         self.num_pages = num_pages
 
 
+class FragmentBuilder(Builder):
+    """Render html fragments of an article shared by output contexts,
+    before pages using the fragments are built."""
+
+    def build_context(self, site: Site, jinjaenv: Environment) -> context.OutputContext:
+        return context.JinjaOutput(site, jinjaenv, self.contentpath)
+
+    def build_fragments(self, site: Site, jinjaenv: Environment) -> None:
+        ctx = self.build_context(site, jinjaenv)
+        try:
+            ctx.content.build_fragments(ctx)
+        except Exception:
+            # Errors are reported by builders of the pages.
+            logger.debug(
+                "Error while rendering %s",
+                repr_contentpath(self.contentpath),
+                exc_info=True,
+            )
+
+
+def create_fragment_builders(site: Site, builders: Sequence[Builder]) -> List[Builder]:
+    """Create builders of articles built or listed by the builders"""
+
+    contentpaths: Dict[ContentPath, None] = {}
+    for builder in builders:
+        contentpaths[builder.contentpath] = None
+        if isinstance(builder, IndexBuilder):
+            contentpaths.update(dict.fromkeys(builder.items))
+
+    ret: List[Builder] = []
+    for contentpath in contentpaths:
+        content = site.files.get_content(contentpath)
+        if content.src.metadata["type"] == "article":
+            ret.append(FragmentBuilder(content))
+    return ret
+
+
 BUILDERS: Dict[str, Type[Builder]] = {
     "binary": Builder,
     "article": Builder,
@@ -204,23 +288,226 @@ def create_builders(site: Site, content: Content) -> List[Builder]:
         return []
 
 
+# Cost of a builder in bytes of source, added to the size of contents.
+BUILDER_OVERHEAD = 1024
+
+# Used to estimate build time if no build time was recorded.
+DEFAULT_SECS_PER_BYTE = 1e-6
+
+
+def estimate_costs(
+    site: Site, builders: Sequence[Builder], buildtimes: Dict[ContentPath, float]
+) -> List[float]:
+    """Estimate build time of each builder.
+
+    Build time recorded in the previous build is used if exists. Otherwise,
+    build time is estimated from the size of contents, in proportion to
+    the recorded build time of other builders.
+    """
+
+    sizes = [b.estimate_size(site) + BUILDER_OVERHEAD for b in builders]
+
+    known_secs = known_size = 0.0
+    for builder, size in zip(builders, sizes):
+        secs = buildtimes.get(builder.contentpath)
+        if secs is not None:
+            known_secs += secs
+            known_size += size
+
+    if known_secs and known_size:
+        secs_per_byte = known_secs / known_size
+    else:
+        secs_per_byte = DEFAULT_SECS_PER_BYTE
+
+    return [
+        buildtimes.get(builder.contentpath, size * secs_per_byte)
+        for builder, size in zip(builders, sizes)
+    ]
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def _read_cgroup_file(*names: str) -> Optional[str]:
+    try:
+        with open(os.path.join(CGROUP_ROOT, *names)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def get_cgroup_cpu_quota() -> Optional[int]:
+    """CPU quota of the cgroup of this process in number of CPUs"""
+
+    # cgroup v2
+    cgroup = ""
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    cgroup = line[3:].strip().lstrip("/")
+    except OSError:
+        pass
+
+    for path in (cgroup, ""):
+        cpumax = _read_cgroup_file(path, "cpu.max")
+        if cpumax:
+            quota, period = (cpumax.split() + ["100000"])[:2]
+            if quota == "max":
+                return None
+            try:
+                return max(1, math.ceil(int(quota) / int(period)))
+            except (ValueError, ZeroDivisionError):
+                return None
+
+    # cgroup v1
+    quota_us = _read_cgroup_file("cpu", "cpu.cfs_quota_us")
+    period_us = _read_cgroup_file("cpu", "cpu.cfs_period_us")
+    try:
+        cfs_quota, cfs_period = int(quota_us or -1), int(period_us or -1)
+    except ValueError:
+        return None
+    if cfs_quota <= 0 or cfs_period <= 0:
+        return None
+    return max(1, math.ceil(cfs_quota / cfs_period))
+
+
+def get_cpu_count() -> int:
+    """Number of CPUs available to this process, limited by CPU affinity
+    and cgroup CPU quota of containers."""
+
+    if hasattr(os, "sched_getaffinity"):
+        count = len(os.sched_getaffinity(0))
+    else:
+        count = multiprocessing.cpu_count()
+
+    quota = get_cgroup_cpu_quota()
+    if quota:
+        count = min(count, quota)
+    return max(1, count)
+
+
 MIN_BATCH_SIZE = 10
 
 
-def split_batch(builders: Sequence[Any]) -> Sequence[Any]:
+def split_batch(
+    builders: Sequence[Any],
+    max_workers: Optional[int] = None,
+    costs: Optional[Sequence[float]] = None,
+) -> Sequence[Any]:
     num = len(builders)
     max_batches = (num // MIN_BATCH_SIZE) or 1
-    batch_count = min(max_batches, multiprocessing.cpu_count())
+    batch_count = min(max_batches, max_workers or get_cpu_count())
     batches: List[List[Builder]] = [[] for _ in range(batch_count)]
 
-    for i, builder in enumerate(builders):
-        batches[i % batch_count].append(builder)
+    if costs is None:
+        for i, builder in enumerate(builders):
+            batches[i % batch_count].append(builder)
+        return batches
+
+    # Longest-processing-time-first: assign the most expensive builder to
+    # the batch with the least total cost.
+    order = sorted(range(num), key=costs.__getitem__, reverse=True)
+    loads = [(0.0, n) for n in range(batch_count)]
+    for i in order:
+        total, n = heapq.heappop(loads)
+        batches[n].append(builders[i])
+        heapq.heappush(loads, (total + costs[i], n))
 
     return batches
 
 
+def schedule_batches(
+    site: Site,
+    phases: Sequence[List[Builder]],
+    buildtimes: Dict[ContentPath, float],
+    num_workers: int,
+) -> Sequence[List[Builder]]:
+    """Split builders into batches for workers.
+
+    Each worker builds the builders of a phase before the builders of the
+    next phase.
+    """
+
+    if site.schedule == "dynamic":
+        # Workers pull builders in order of interleave(batches).
+        ordered: List[Builder] = []
+        for builders in phases:
+            costs = estimate_costs(site, builders, buildtimes)
+            order = sorted(range(len(builders)), key=costs.__getitem__, reverse=True)
+            ordered.extend(builders[i] for i in order)
+        return split_batch(ordered, num_workers)
+
+    total = sum(len(builders) for builders in phases)
+    batch_count = min((total // MIN_BATCH_SIZE) or 1, num_workers)
+    batches: List[List[Builder]] = [[] for _ in range(batch_count)]
+    for builders in phases:
+        if not builders:
+            continue
+        costs = estimate_costs(site, builders, buildtimes)
+        for batch, phase_batch in zip(
+            batches, split_batch(builders, batch_count, costs)
+        ):
+            batch.extend(phase_batch)
+
+    return batches
+
+
+def count_outputs(batches: Sequence[List[Builder]]) -> int:
+    return sum(
+        1
+        for batch in batches
+        for builder in batch
+        if not isinstance(builder, FragmentBuilder)
+    )
+
+
+def is_phased(batches: Sequence[List[Builder]]) -> bool:
+    """True if the batches have fragments to render in phase 1."""
+
+    return any(isinstance(b, FragmentBuilder) for batch in batches for b in batch)
+
+
+class PhaseBarrier:
+    """Wait for other workers between phase 1 and phase 2.
+
+    A worker saves fragments rendered in phase 1, and waits until every
+    worker has done so before building pages. Pages then use fragments
+    rendered by any worker. Each worker passes the barrier once per
+    build, before its first page or after its last builder.
+    """
+
+    def __init__(self, barrier: Any) -> None:
+        self.barrier = barrier
+        self.passed = False
+        self.waited = 0.0  # seconds
+
+    def wait(self, site: Site) -> None:
+        if self.passed:
+            return
+        self.passed = True
+
+        with profiling.phase("fragments"):
+            fragments.flush(site)
+
+        started = time.perf_counter()
+        try:
+            with profiling.phase("wait_phase"):
+                self.barrier.wait()
+        except threading.BrokenBarrierError:
+            # Another worker failed. Pages are built without waiting.
+            pass
+        self.waited += time.perf_counter() - started
+
+    def abort(self) -> None:
+        self.barrier.abort()
+
+
 def build_batch(
-    site: Site, jinjaev: Environment, builders: List[Builder]
+    site: Site,
+    jinjaev: Environment,
+    builders: Iterable[Builder],
+    phase: Optional[PhaseBarrier] = None,
 ) -> Tuple[int, int, BuildResult, Set[ContentPath],]:
 
     ret: BuildResult = []
@@ -228,13 +515,29 @@ def build_batch(
 
     ok = err = 0
     for builder in builders:
+        if isinstance(builder, FragmentBuilder):
+            with profiling.phase("build_fragments"):
+                builder.build_fragments(site, jinjaev)
+            continue
+
+        if phase:
+            phase.wait(site)
+
         try:
-            new_context = builder.build_context(site, jinjaev)
-            context = extend.run_pre_build(new_context)
-            if not context:
-                continue
-            logger.info("Building %s", context.content.src.repr_filename())
-            filenames = context.build()
+            started = time.perf_counter()
+            with tracking.track() as reads:
+                with profiling.phase("build_context"):
+                    new_context = builder.build_context(site, jinjaev)
+                context = extend.run_pre_build(new_context)
+                if not context:
+                    continue
+                logger.info("Building %s", context.content.src.repr_filename())
+                with profiling.phase("output"):
+                    filenames = context.build()
+
+            buildtime = time.perf_counter() - started
+            profiling.add_content(repr_contentpath(builder.contentpath), buildtime)
+            filenames = [oi._replace(buildtime=buildtime) for oi in filenames]
             extend.run_post_build(context, filenames)
 
             ret.append(
@@ -242,6 +545,7 @@ def build_batch(
                     context.content.src,
                     set(context.depends),
                     filenames,
+                    reads,
                 )
             )
             ok += 1
@@ -256,19 +560,232 @@ def build_batch(
     return ok, err, ret, errors
 
 
-def mp_build_batch(queue: Any, picklefile: str, builders: List[Builder]) -> None:
+INITIAL_CHUNK_SIZE = 1
+MAX_CHUNK_SIZE = 100
+
+# Preferred build time of a chunk in seconds.
+CHUNK_SECS = 0.5
+
+
+# Number of builders sent to the parent at once by static batches.
+RESULT_CHUNK_SIZE = 10
+
+
+def pull_chunks(taskqueue: Any) -> Iterator[List[Builder]]:
+    """Pull chunks of builders from shared task queue until it is exhausted"""
+    while True:
+        chunk = taskqueue.get()
+        if chunk is None:
+            return
+        yield chunk
+
+
+def split_chunks(builders: List[Builder], size: int) -> Iterator[List[Builder]]:
+    for i in range(0, len(builders), size):
+        yield builders[i : i + size]
+
+
+def build_chunks(
+    queue: Any,
+    site: Site,
+    jinjaenv: Environment,
+    chunks: Iterable[List[Builder]],
+    phase: Optional[PhaseBarrier] = None,
+) -> None:
+    """Build chunks of builders and send results to the parent process
+    as each chunk finished."""
+
     try:
-        site = pickle.load(open(picklefile, "rb"))
+        for chunk in chunks:
+            started = time.perf_counter()
+            waited = phase.waited if phase else 0.0
+            ret = build_batch(site, jinjaenv, chunk, phase)
+            with profiling.phase("fragments"):
+                fragments.flush(site)
+            queue.put(("RESULT", ret))
+
+            # time waiting other workers is not a build time of the chunk
+            secs = time.perf_counter() - started
+            if phase:
+                secs -= phase.waited - waited
+            queue.put(("CHUNK", (len(chunk), secs)))
+            mp_log.flush_mp_logging()
+
+        if phase:
+            phase.wait(site)
+    except BaseException:
+        # don't let other workers wait forever
+        if phase:
+            phase.abort()
+        raise
+
+
+class ChunkFeeder:
+    """Put builders into the shared task queue in chunks.
+
+    The size of chunks adapts to the observed throughput of the workers,
+    and shrinks as the remaining builders decrease so that workers finish
+    at about the same time.
+    """
+
+    def __init__(
+        self, taskqueue: Any, builders: Sequence[Builder], num_workers: int
+    ) -> None:
+        self.taskqueue = taskqueue
+        self.num_workers = num_workers
+        self._pending = collections.deque(builders)
+        self._lock = threading.Lock()
+        self._rate = 0.0  # builders per second of a worker
+        self._finished = False
+
+    def start(self) -> None:
+        # keep two chunks per worker queued
+        for _ in range(self.num_workers * 2):
+            self._put_chunk()
+
+    def chunk_size(self) -> int:
+        if not self._rate:
+            size = INITIAL_CHUNK_SIZE
+        else:
+            size = int(self._rate * CHUNK_SECS)
+
+        guided = -(-len(self._pending) // (self.num_workers * 2))
+        return max(1, min(size, guided, MAX_CHUNK_SIZE))
+
+    def chunk_done(self, num: int, secs: float) -> None:
+        with self._lock:
+            rate = num / max(secs, 1e-6)
+            if self._rate:
+                rate = self._rate * 0.7 + rate * 0.3
+            self._rate = rate
+
+        self._put_chunk()
+
+    def _put_chunk(self) -> None:
+        with self._lock:
+            if self._finished:
+                return
+
+            if not self._pending:
+                self._finished = True
+                for _ in range(self.num_workers):
+                    self.taskqueue.put(None)
+                return
+
+            size = self.chunk_size()
+            chunk = [self._pending.popleft() for _ in range(size)]
+            self.taskqueue.put(chunk)
+
+
+def interleave(batches: Sequence[List[Builder]]) -> List[Builder]:
+    # Reverts round-robin splitting of split_batch().
+    return [
+        b
+        for bs in itertools.zip_longest(*batches, fillvalue=None)
+        for b in bs
+        if b is not None
+    ]
+
+
+def get_maxrss() -> int:
+    """Peak resident set size of this process in KiB"""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss = rss // 1024  # darwin reports in bytes
+    return int(rss)
+
+
+def _run_batch(
+    queue: Any,
+    site: Site,
+    jinjaenv: Environment,
+    builders: List[Builder],
+    started: float,
+    taskqueue: Any,
+    barrier: Any,
+) -> None:
+    queue.put(("STARTED", time.time() - started))
+    context.render_cache.clear()
+
+    if taskqueue is not None:
+        chunks = pull_chunks(taskqueue)
+    else:
+        chunks = split_chunks(builders, RESULT_CHUNK_SIZE)
+
+    phase = PhaseBarrier(barrier) if barrier is not None else None
+    build_chunks(queue, site, jinjaenv, chunks, phase)
+    queue.put(("MAXRSS", get_maxrss()))
+
+    profiler = profiling.get_profiler()
+    if profiler:
+        queue.put(("PROFILE", profiler.to_dict()))
+
+
+def mp_build_batch(
+    queue: Any,
+    picklefile: str,
+    builders: List[Builder],
+    started: float,
+    taskqueue: Any = None,
+    barrier: Any = None,
+) -> None:
+    try:
+        # Profile is discarded later unless requested by the site.
+        profiling.enable()
+        with profiling.phase("worker_startup"):
+            site = pickle.load(open(picklefile, "rb"))
+        if not site.profile:
+            profiling.disable()
+
         mp_log.init_mp_logging(queue)
         try:
-            site.load_hooks()
-            site.load_modules()
-            jinjaenv = site.build_jinjaenv()
+            with profiling.phase("worker_startup"):
+                site.load_hooks()
+                site.load_modules()
+                jinjaenv = site.build_jinjaenv()
 
-            ret = build_batch(site, jinjaenv, builders)
-            queue.put(("RESULT", ret))
+            _run_batch(queue, site, jinjaenv, builders, started, taskqueue, barrier)
         except:  # NOQA
             logger.exception("Error in builder process:")
+            if barrier is not None:
+                barrier.abort()
+            raise
+
+        finally:
+            mp_log.flush_mp_logging()
+            queue.put(None)
+            queue.close()
+            queue.join_thread()
+    except:  # noqa
+        traceback.print_exc()
+        raise
+
+
+def fork_build_batch(
+    queue: Any,
+    site: Site,
+    jinjaenv: Environment,
+    builders: List[Builder],
+    started: float,
+    taskqueue: Any = None,
+    barrier: Any = None,
+) -> None:
+    # Hooks, themes and Jinja environment are inherited from the parent.
+    try:
+        if site.profile:
+            profiling.enable()
+        else:
+            profiling.disable()
+
+        mp_log.init_mp_logging(queue)
+        try:
+            _run_batch(queue, site, jinjaenv, builders, started, taskqueue, barrier)
+        except:  # NOQA
+            logger.exception("Error in builder process:")
+            if barrier is not None:
+                barrier.abort()
             raise
 
         finally:
@@ -282,39 +799,249 @@ def mp_build_batch(queue: Any, picklefile: str, builders: List[Builder]) -> None
 
 
 def dispatch_log(msgs: List[Dict[str, Any]]) -> None:
-    for msg in msgs:
-        lv = msg["levelno"]
-        logger.log(lv, msg["msg"], extra=dict(msgdict=msg))
+    mp_log.dispatch_log(logger, msgs)
+
+
+# Interval of progress report in seconds.
+PROGRESS_INTERVAL = 5.0
+
+
+class BuildProgress:
+    """Merge results sent from builder processes as they arrive."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, total: int) -> None:
+        self.loop = loop
+        self.total = total
+
+        self.ok = self.err = 0
+        self.results: BuildResult = []
+        self.errors: Set[ContentPath] = set()
+        self.startup = 0.0
+        self.maxrss = 0
+
+        self._lock = threading.Lock()
+        self._started = self._reported = time.time()
+
+    def add(self, kind: str, value: Any) -> None:
+        with self._lock:
+            if kind == "RESULT":
+                _ok, _err, _results, _errors = value
+                self.ok += _ok
+                self.err += _err
+                self.results.extend(_results)
+                self.errors.update(_errors)
+                self._report_progress()
+            elif kind == "STARTED":
+                self.startup = max(self.startup, value)
+            elif kind == "MAXRSS":
+                self.maxrss = max(self.maxrss, value)
+            elif kind == "PROFILE":
+                profiler = profiling.get_profiler()
+                if profiler:
+                    profiler.add_worker(value)
+
+    def format_progress(self, now: float) -> str:
+        done = self.ok + self.err
+        secs = now - self._started
+        rate = done / secs if secs else 0.0
+        eta = (self.total - done) / rate if rate else 0.0
+        return (
+            f"Built {done}/{self.total} files "
+            f"({rate:.1f} files/sec, ETA {eta:.0f} secs)"
+        )
 
+    def _report_progress(self) -> None:
+        now = time.time()
+        if now - self._reported < PROGRESS_INTERVAL:
+            return
+        self._reported = now
+        self.loop.call_soon_threadsafe(logger.info, self.format_progress(now))
+
+    def report_workers(self, mode: str, num_workers: int) -> None:
+        logger.info(
+            "Builder processes(%s): %d, startup: %.2f secs, "
+            "peak RSS: parent %d MiB, worker %d MiB",
+            mode,
+            num_workers,
+            self.startup,
+            get_maxrss() // 1024,
+            self.maxrss // 1024,
+        )
 
-def run_build(
-    loop: asyncio.AbstractEventLoop, picklefile: str, batch: List[Builder]
-) -> List[Tuple[str, Any]]:
-    queue: Any = multiprocessing.Queue()
-    p = multiprocessing.Process(target=mp_build_batch, args=(queue, picklefile, batch))
-    p.start()
-    msgs = []
+    def get_result(self) -> Tuple[int, int, BuildResult, Set[ContentPath],]:
+        return self.ok, self.err, self.results, self.errors
+
+    def get_unreported(self, batches: Sequence[List[Builder]]) -> Set[ContentPath]:
+        """Contents of builders whose results were not received."""
+
+        with self._lock:
+            counts = collections.Counter(
+                builder.contentpath
+                for batch in batches
+                for builder in batch
+                if not isinstance(builder, FragmentBuilder)
+            )
+            counts.subtract(src.contentpath for src, *_ in self.results)
+            return {
+                contentpath
+                for contentpath, count in counts.items()
+                if (count > 0) and (contentpath not in self.errors)
+            }
+
+
+# Interval to check if builder processes are alive in seconds.
+POLL_INTERVAL = 1.0
+
+
+def recv_msgs(
+    loop: asyncio.AbstractEventLoop,
+    queue: Any,
+    progress: BuildProgress,
+    feeder: Optional[ChunkFeeder] = None,
+    proc: Any = None,
+) -> None:
     while True:
-        msg = queue.get()
+        try:
+            msg = queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            if (proc is not None) and not proc.is_alive():
+                raise RuntimeError("Builder process terminated unexpectedly")
+            continue
+
         if msg is None:
             break
         if msg[0] == "LOGS":
             loop.call_soon_threadsafe(dispatch_log, msg[1])
-
-        elif msg[0] == "RESULT":
-            msgs.append(msg)
+        elif msg[0] == "CHUNK":
+            if feeder:
+                feeder.chunk_done(*msg[1])
+        else:
+            progress.add(*msg)
 
     queue.close()
     queue.join_thread()
 
-    p.join()
-    return msgs
+
+def run_build(
+    loop: asyncio.AbstractEventLoop,
+    picklefile: str,
+    batch: List[Builder],
+    progress: BuildProgress,
+    started: Optional[float] = None,
+    feeder: Optional[ChunkFeeder] = None,
+    barrier: Any = None,
+) -> None:
+    queue: Any = multiprocessing.Queue()
+    taskqueue = feeder.taskqueue if feeder else None
+    p = multiprocessing.Process(
+        target=mp_build_batch,
+        args=(queue, picklefile, batch, started or time.time(), taskqueue, barrier),
+    )
+    p.start()
+    try:
+        recv_msgs(loop, queue, progress, feeder, p)
+    finally:
+        p.join()
+
+
+def report_lost(progress: BuildProgress, batches: Sequence[List[Builder]]) -> None:
+    """Report builders of dead builder processes as failed."""
+
+    failed = progress.get_unreported(batches)
+    if failed:
+        progress.add("RESULT", (0, len(failed), [], failed))
+
+
+async def wait_workers(futs: Sequence[Any], barrier: Any = None) -> bool:
+    """Wait for threads receiving results from builder processes. Returns
+    False if a builder process died."""
+
+    alive = True
+    for fut in asyncio.as_completed(futs):
+        try:
+            await fut
+        except RuntimeError:
+            logger.exception("Error in builder process:")
+            alive = False
+            # workers waiting for the dead worker
+            if barrier is not None:
+                barrier.abort()
+    return alive
+
+
+def can_fork() -> bool:
+    if sys.platform != "linux":
+        return False
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return False
+    # Forking a process with running threads may deadlock the child.
+    return threading.active_count() == 1
+
+
+async def submit_fork(
+    site: Site, batches: Sequence[List[Builder]]
+) -> Tuple[int, int, BuildResult, Set[ContentPath],]:
+
+    started = time.time()
+
+    # Workers share the loaded site and Jinja environment by copy-on-write.
+    jinjaenv = site.build_jinjaenv()
+
+    ctx = multiprocessing.get_context("fork")
+
+    feeder = None
+    if site.schedule == "dynamic":
+        feeder = ChunkFeeder(ctx.Queue(), interleave(batches), len(batches))
+        feeder.start()
+
+    barrier = ctx.Barrier(len(batches)) if is_phased(batches) else None
+
+    procs = []
+    for batch in batches:
+        queue = ctx.Queue()
+        p = ctx.Process(
+            target=fork_build_batch,
+            args=(
+                queue,
+                site,
+                jinjaenv,
+                batch,
+                started,
+                feeder.taskqueue if feeder else None,
+                barrier,
+            ),
+        )
+        p.start()
+        procs.append((p, queue))
+
+    loop = asyncio.get_running_loop()
+    progress = BuildProgress(loop, count_outputs(batches))
+    executor = ThreadPoolExecutor(max_workers=max(len(procs), 1))
+    futs = [
+        loop.run_in_executor(executor, recv_msgs, loop, q, progress, feeder, p)
+        for p, q in procs
+    ]
+
+    if not await wait_workers(futs, barrier):
+        report_lost(progress, batches)
+
+    for p, q in procs:
+        p.join()
+
+    progress.report_workers("fork", len(procs))
+    return progress.get_result()
 
 
 async def submit(
     site: Site, batches: Sequence[List[Builder]]
 ) -> Tuple[int, int, BuildResult, Set[ContentPath],]:
 
+    if site.fork:
+        if can_fork():
+            return await submit_fork(site, batches)
+        logger.info("Fork is not available. Builder processes are spawned.")
+
+    started = time.time()
     fd, picklefile = tempfile.mkstemp()
 
     try:
@@ -325,33 +1052,46 @@ async def submit(
 
         loop = asyncio.get_running_loop()
         futs = []
-        results = []
-        errors = set()
 
         # build Queue here for Python 3.9 issue35943
         # force importing multiprocessing.* modules
         dmy_executor = ThreadPoolExecutor(max_workers=1)
-        fut = loop.run_in_executor(dmy_executor, run_build, loop, picklefile, [])
+        fut = loop.run_in_executor(
+            dmy_executor, run_build, loop, picklefile, [], BuildProgress(loop, 0)
+        )
         await fut
 
+        feeder = None
+        if site.schedule == "dynamic":
+            feeder = ChunkFeeder(
+                multiprocessing.Queue(), interleave(batches), len(batches)
+            )
+            feeder.start()
+
+        barrier = multiprocessing.Barrier(len(batches)) if is_phased(batches) else None
+
+        progress = BuildProgress(loop, count_outputs(batches))
         executor = ThreadPoolExecutor(max_workers=len(batches))
         for batch in batches:
             futs.append(
-                loop.run_in_executor(executor, run_build, loop, picklefile, batch)
+                loop.run_in_executor(
+                    executor,
+                    run_build,
+                    loop,
+                    picklefile,
+                    batch,
+                    progress,
+                    started,
+                    feeder,
+                    barrier,
+                )
             )
 
-        ok = err = 0
-        for fut in futs:
-            msgs = await fut
-            for msg in msgs:
-                if msg[0] == "RESULT":
-                    _ok, _err, _results, _errors = msg[1]
-                    ok += _ok
-                    err += _err
-                    results.extend(_results)
-                    errors.update(_errors)
+        if not await wait_workers(futs, barrier):
+            report_lost(progress, batches)
 
-        return ok, err, results, errors
+        progress.report_workers("spawn", len(batches))
+        return progress.get_result()
 
     finally:
         if fd:
@@ -359,12 +1099,87 @@ async def submit(
         os.unlink(picklefile)
 
 
+def thread_build_batch(
+    site: Site,
+    jinjaenv: Environment,
+    builders: List[Builder],
+    progress: BuildProgress,
+    feeder: Optional[ChunkFeeder],
+    barrier: Optional[threading.Barrier] = None,
+) -> None:
+    if feeder:
+        chunks = pull_chunks(feeder.taskqueue)
+    else:
+        chunks = split_chunks(builders, RESULT_CHUNK_SIZE)
+
+    phase = PhaseBarrier(barrier) if barrier is not None else None
+    try:
+        for chunk in chunks:
+            started = time.perf_counter()
+            waited = phase.waited if phase else 0.0
+            progress.add("RESULT", build_batch(site, jinjaenv, chunk, phase))
+            with profiling.phase("fragments"):
+                fragments.flush(site)
+            if feeder:
+                secs = time.perf_counter() - started
+                if phase:
+                    secs -= phase.waited - waited
+                feeder.chunk_done(len(chunk), secs)
+
+        if phase:
+            phase.wait(site)
+    except BaseException:
+        if phase:
+            phase.abort()
+        raise
+
+
+async def submit_thread(
+    site: Site, batches: Sequence[List[Builder]]
+) -> Tuple[int, int, BuildResult, Set[ContentPath],]:
+
+    # Threads share the loaded site and a Jinja environment.
+    site.load_modules()
+    jinjaenv = site.build_jinjaenv()
+    context.render_cache.clear()
+
+    feeder = None
+    if site.schedule == "dynamic":
+        feeder = ChunkFeeder(Queue(), interleave(batches), len(batches))
+        feeder.start()
+
+    barrier = threading.Barrier(len(batches)) if is_phased(batches) else None
+
+    loop = asyncio.get_running_loop()
+    progress = BuildProgress(loop, count_outputs(batches))
+    with ThreadPoolExecutor(max_workers=max(len(batches), 1)) as executor:
+        futs = [
+            loop.run_in_executor(
+                executor,
+                thread_build_batch,
+                site,
+                jinjaenv,
+                batch,
+                progress,
+                feeder,
+                barrier,
+            )
+            for batch in batches
+        ]
+        for fut in futs:
+            await fut
+
+    logger.info("Builder threads: %d", len(batches))
+    return progress.get_result()
+
+
 def submit_debug(
     site: Site, batches: Sequence[List[Builder]]
 ) -> Tuple[int, int, BuildResult, Set[ContentPath],]:
 
     site.load_modules()
     jinjaenv = site.build_jinjaenv()
+    context.render_cache.clear()
 
     ok = err = 0
     ret = []
@@ -377,39 +1192,403 @@ def submit_debug(
         ret.extend(results)
         errors.update(_errors)
 
+    with profiling.phase("fragments"):
+        fragments.flush(site)
+
     return ok, err, ret, errors
 
 
-def build(site: Site) -> Tuple[int, int, DependsDict, BuildResult, Set[ContentPath]]:
+class SiteDelta(NamedTuple):
+    attrs: Dict[str, Any]
+    updated: Dict[ContentPath, Content]
+    removed: List[ContentPath]
+
+
+def _get_env_key(site: Site) -> Tuple[Any, ...]:
+    # Workers reload hooks, themes and Jinja environment if this key changes.
+    hook = site.root / "hooks.py"
+    hook_mtime = hook.stat().st_mtime if hook.exists() else None
+    return (
+        site.root,
+        tuple(site.themes),
+        hook_mtime,
+        pickle.dumps(site.jinja_global_vars),
+        sorted(site.jinja_templates.items()),
+    )
+
+
+def _is_same_content(c1: Optional[Content], c2: Content) -> bool:
+    if c1 is None:
+        return False
+    # compare references to the file cache without reading bodies
+    return (type(c1) is type(c2)) and (c1.src == c2.src) and (c1._body == c2._body)
+
+
+def apply_site_delta(site: Site, delta: SiteDelta) -> None:
+    files = site.files
+    site.__dict__.update(delta.attrs)
+    site.files = files
+
+    for contentpath in delta.removed:
+        files._contentfiles.pop(contentpath, None)
+    files._contentfiles.update(delta.updated)
+
+
+def pool_worker(inbox: Any, outbox: Any, taskqueue: Any, barrier: Any) -> None:
+    mp_log.init_mp_logging(outbox)
+
+    site: Optional[Site] = None
+    jinjaenv: Optional[Environment] = None
+
+    while True:
+        msg = inbox.get()
+        if msg is None:
+            break
+
+        (kind, data), builders, phased = msg
+        if builders is None:
+            # pull builders from the shared task queue
+            chunks = pull_chunks(taskqueue)
+        else:
+            chunks = split_chunks(builders, RESULT_CHUNK_SIZE)
+
+        profiling.enable()
+        try:
+            try:
+                with profiling.phase("worker_startup"):
+                    if kind == "SITE":
+                        site = None
+                        site = pickle.loads(data)
+                        assert site
+                        site.load_hooks()
+                        site.load_modules()
+                        jinjaenv = site.build_jinjaenv()
+                    else:
+                        if not site or not jinjaenv:
+                            raise RuntimeError("Site is not loaded")
+                        apply_site_delta(site, pickle.loads(data))
+                        site.update_jinjaenv(jinjaenv)
+
+            except Exception:
+                logger.exception("Error in builder process:")
+                if phased:
+                    barrier.abort()
+                site = None
+                failed = {b.contentpath for chunk in chunks for b in chunk}
+                outbox.put(("RESYNC", None))
+                outbox.put(("RESULT", (0, len(failed), [], failed)))
+                continue
+
+            if not site.profile:
+                profiling.disable()
+
+            context.render_cache.clear()
+            phase = PhaseBarrier(barrier) if phased else None
+            build_chunks(outbox, site, jinjaenv, chunks, phase)
+            # ContentProxy.set() modifies the contents in the worker.
+            outbox.put(("MODIFIED", context.render_cache.get_modified()))
+
+            profiler = profiling.get_profiler()
+            if profiler:
+                outbox.put(("PROFILE", profiler.to_dict()))
+
+        finally:
+            profiling.disable()
+            mp_log.flush_mp_logging()
+            outbox.put(None)
+
+    outbox.close()
+    outbox.join_thread()
+
+
+class BuildPool:
+    """Builder processes kept alive between builds.
+
+    Workers keep imported themes, compiled Jinja environment and their
+    caches. After the first build, only the contents updated since the
+    previous build are sent to the workers.
+    """
+
+    num_workers: int
+
+    def __init__(self, num_workers: Optional[int] = None) -> None:
+        self.num_workers = num_workers or get_cpu_count()
+        self._procs: List[Any] = []
+        self._inboxes: List[Any] = []
+        self._outboxes: List[Any] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._taskqueue: Any = None
+        self._barrier: Any = None
+        self._env_key: Optional[Tuple[Any, ...]] = None
+        self._synced: Dict[ContentPath, Content] = {}
+
+    def __enter__(self) -> BuildPool:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def is_alive(self) -> bool:
+        return bool(self._procs) and all(p.is_alive() for p in self._procs)
+
+    def start(self) -> None:
+        self.close()
+
+        ctx = multiprocessing.get_context("spawn")
+        self._taskqueue = ctx.Queue()
+        self._barrier = ctx.Barrier(self.num_workers)
+        for i in range(self.num_workers):
+            inbox = ctx.Queue()
+            outbox = ctx.Queue()
+            proc = ctx.Process(
+                target=pool_worker,
+                args=(inbox, outbox, self._taskqueue, self._barrier),
+                daemon=True,
+            )
+            proc.start()
+
+            self._inboxes.append(inbox)
+            self._outboxes.append(outbox)
+            self._procs.append(proc)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+
+    def close(self) -> None:
+        for inbox, proc in zip(self._inboxes, self._procs):
+            if proc.is_alive():
+                inbox.put(None)
+
+        for proc in self._procs:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+
+        if self._executor:
+            self._executor.shutdown()
+
+        self._procs = []
+        self._inboxes = []
+        self._outboxes = []
+        self._executor = None
+        self._taskqueue = None
+        self._barrier = None
+        self._env_key = None
+        self._synced = {}
+
+    def _build_payload(self, site: Site) -> Tuple[str, bytes]:
+        contentfiles = dict(site.files.items())
+        env_key = _get_env_key(site)
+
+        if env_key != self._env_key:
+            payload = ("SITE", pickle.dumps(site))
+        else:
+            attrs = {k: v for k, v in site.__dict__.items() if k != "files"}
+            updated = {
+                contentpath: content
+                for contentpath, content in contentfiles.items()
+                if not _is_same_content(self._synced.get(contentpath), content)
+            }
+            removed = [
+                contentpath
+                for contentpath in self._synced
+                if contentpath not in contentfiles
+            ]
+            payload = ("DELTA", pickle.dumps(SiteDelta(attrs, updated, removed)))
+
+        self._env_key = env_key
+        self._synced = contentfiles
+        return payload
+
+    def _recv(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        n: int,
+        progress: BuildProgress,
+        feeder: Optional[ChunkFeeder],
+    ) -> List[Tuple[str, Any]]:
+        queue = self._outboxes[n]
+        proc = self._procs[n]
+        msgs = []
+        while True:
+            try:
+                msg = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if not proc.is_alive():
+                    # don't let other workers wait for the dead worker
+                    self._barrier.abort()
+                    raise RuntimeError("Builder process terminated unexpectedly")
+                continue
+
+            if msg is None:
+                break
+            if msg[0] == "LOGS":
+                loop.call_soon_threadsafe(dispatch_log, msg[1])
+            elif msg[0] == "CHUNK":
+                if feeder:
+                    feeder.chunk_done(*msg[1])
+            elif msg[0] in ("MODIFIED", "RESYNC"):
+                msgs.append(msg)
+            else:
+                progress.add(*msg)
+        return msgs
+
+    async def submit(
+        self, site: Site, batches: Sequence[List[Builder]]
+    ) -> Tuple[int, int, BuildResult, Set[ContentPath],]:
+
+        if not self.is_alive():
+            self.start()
+
+        if len(batches) > self.num_workers:
+            # keep fragments of phase 1 before pages
+            flattened = sorted(
+                (b for batch in batches for b in batch),
+                key=lambda b: not isinstance(b, FragmentBuilder),
+            )
+            batches = split_batch(flattened, self.num_workers)
+
+        payload = self._build_payload(site)
+        phased = is_phased(batches)
+        self._barrier.reset()
+
+        feeder = None
+        if site.schedule == "dynamic":
+            feeder = ChunkFeeder(self._taskqueue, interleave(batches), self.num_workers)
+            feeder.start()
+
+        loop = asyncio.get_running_loop()
+        progress = BuildProgress(loop, count_outputs(batches))
+        futs = []
+        for n, inbox in enumerate(self._inboxes):
+            if feeder:
+                inbox.put((payload, None, phased))
+            else:
+                inbox.put((payload, batches[n] if n < len(batches) else [], phased))
+            futs.append(
+                loop.run_in_executor(
+                    self._executor, self._recv, loop, n, progress, feeder
+                )
+            )
+
+        dead = False
+        for fut in futs:
+            try:
+                msgs = await fut
+            except RuntimeError:
+                logger.exception("Error in builder process:")
+                dead = True
+                self._env_key = None
+                continue
+
+            for kind, value in msgs:
+                if kind == "MODIFIED":
+                    for contentpath in value:
+                        self._synced.pop(contentpath, None)
+                elif kind == "RESYNC":
+                    self._env_key = None
+
+        if dead:
+            # Builders pulled from the shared queue by the dead worker are
+            # not known to the parent. Every builder without a result is
+            # reported as failed.
+            report_lost(progress, batches)
+
+        if not self.is_alive():
+            self.close()
+
+        return progress.get_result()
+
+
+def build(
+    site: Site, pool: Optional[BuildPool] = None
+) -> Tuple[int, int, DependsDict, BuildResult, Set[ContentPath]]:
+    if site.explain:
+        explain.enable()
+
     if site.rebuild:
         rebuild = True
+        explain.rebuild("rebuild_option")
     else:
-        rebuild, updates, deps, outputinfos = depends.check_depends(site)
+        with profiling.phase("check_depends"):
+            rebuild, updates, deps, outputinfos = depends.check_depends(site)
 
-    builders = []
-    for contentpath, content in site.files.items():
-        if rebuild or (contentpath in updates):
-            builders.extend(create_builders(site, content))
+    # Fragments may be rendered by updated filters of modules, hooks or
+    # themes.
+    site.reuse_fragments = not rebuild
+    site.build_id = fragments.new_build_id()
 
-    batches = split_batch(builders)
+    if rebuild:
+        buildtimes = depends.load_buildtimes(site)
+    else:
+        buildtimes = depends.get_buildtimes(outputinfos)
+
+    executor = "serial" if site.debug else site.executor
+    if executor != "process":
+        pool = None
+    num_workers = pool.num_workers if pool else (site.jobs or get_cpu_count())
+
+    with profiling.phase("create_builders"):
+        builders = []
+        builder_reads: Dict[ContentPath, tracking.Reads] = {}
+        for contentpath, content in site.files.items():
+            if rebuild or (contentpath in updates):
+                # Index pages query contents while creating builders.
+                with tracking.track() as reads:
+                    builders.extend(create_builders(site, content))
+                builder_reads[contentpath] = reads
+
+        # Phase 1 renders fragments of articles, phase 2 builds pages
+        # from the fragments.
+        phases = [create_fragment_builders(site, builders), builders]
+        batches = schedule_batches(site, phases, buildtimes, num_workers)
+
+    explainer = explain.get_explainer()
+    if explainer and site.explain:
+        counts = collections.Counter(b.contentpath for b in builders)
+        explain_report = explain.write_report(explainer, counts, site.explain)
+        logger.info(explain.format_summary(explain_report))
+        explain.disable()
 
     if not site.outputdir.is_dir():
         site.outputdir.mkdir(parents=True, exist_ok=True)
 
-    if not site.debug:
-        ok, err, newresults, errors = asyncio.run(submit(site, batches))
-    else:
-        ok, err, newresults, errors = submit_debug(site, batches)
+    with profiling.phase("build"):
+        if executor == "serial":
+            ok, err, newresults, errors = submit_debug(site, batches)
+        elif executor == "thread":
+            ok, err, newresults, errors = asyncio.run(submit_thread(site, batches))
+        elif pool:
+            ok, err, newresults, errors = asyncio.run(pool.submit(site, batches))
+        else:
+            ok, err, newresults, errors = asyncio.run(submit(site, batches))
+
+    with profiling.phase("fragments"):
+        fragments.prune(site)
 
     if rebuild:
         deps = {}
         outputinfos = []
 
-    newdeps = depends.update_deps(site, deps, newresults, errors)
-    newois = depends.update_outputinfos(site, outputinfos, newresults)
-    depends.save_deps(site, newdeps, newois, errors)
+    with profiling.phase("save_depends"):
+        records = depends.update_deps(site, deps, newresults, errors, builder_reads)
+        newois = depends.update_outputinfos(site, outputinfos, newresults)
+        depends.save_deps(
+            site,
+            records,
+            [oi for rec in newresults for oi in rec[2]],
+            errors,
+            clear=rebuild,
+        )
+        newdeps = depends.load_store(site)
 
     if site.config.get("/", "generate_sitemap", True):
-        sitemap.write_sitemap(site, newois)
+        with profiling.phase("sitemap"):
+            sitemap.write_sitemap(site, newois)
+
+    profiler = profiling.get_profiler()
+    if profiler and site.profile:
+        report = profiling.write_report(profiler, site.profile)
+        logger.info(profiling.format_summary(report))
+        profiling.disable()
 
     return (ok, err, newdeps, newresults, errors)
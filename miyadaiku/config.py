@@ -8,6 +8,8 @@ import dateutil.parser
 import miyadaiku
 from miyadaiku import ContentSrc, PathTuple, exceptions, to_pathtuple
 
+from . import tracking
+
 IPYNB_EXPORT_OPTIONS = {
     "TemplateExporter": {},
     "TagRemovePreprocessor": {
@@ -70,6 +72,7 @@ DEFAULTS = dict(
     has_jinja=False,
     short_header_id=False,
     strip_directory_index=False,
+    binary_publish="copy",
 )
 
 
@@ -127,9 +130,28 @@ class Config:
         if contentsrc:
             if not contentsrc.package:
                 if contentsrc.srcpath:
-                    mtime = os.stat(contentsrc.srcpath).st_mtime
+                    # mtime of files in contents directory is read by walk
+                    mtime = contentsrc.mtime or os.stat(contentsrc.srcpath).st_mtime
                     self.updated = max(self.updated, mtime)
 
+    def get_dirconfigs(self) -> Dict[PathTuple, List[Dict[str, Any]]]:
+        """Configs in contents directory by directory"""
+
+        return {dirname: list(cfgs) for dirname, cfgs in self._configs.items()}
+
+    def find_dirname(self, dirname: PathTuple, name: str) -> Optional[PathTuple]:
+        """Nearest directory with config file defines the name"""
+
+        while True:
+            for config in self._configs.get(dirname, ()):
+                if name in config:
+                    return dirname
+
+            if not dirname:
+                return None
+
+            dirname = dirname[:-1]
+
     _omit = object()
 
     def get(
@@ -143,6 +165,8 @@ class Config:
         if name in CUMULATIVE_CONFIGS:
             return self.get_cumulative(_dirname, name, default)
 
+        tracking.read_config(_dirname, name)
+
         while True:
             configs = self._configs.get(_dirname, None)
             if configs:
@@ -171,6 +195,8 @@ class Config:
     def get_cumulative(
         self, dirname: PathTuple, name: str, default: Any = _omit
     ) -> Any:
+        tracking.read_config(dirname, name)
+
         ret: List[Any] = []
         found = False
         while True:
@@ -7,6 +7,7 @@ import os
 import posixpath
 import re
 import string
+import threading
 import unicodedata
 import urllib.parse
 from pathlib import Path, PurePosixPath
@@ -18,8 +19,9 @@ from bs4.element import NavigableString
 
 from miyadaiku import METADATA_FILE_SUFFIX, ContentSrc, PathTuple, repr_contentpath
 
-from . import config, context, extend, site
-from .jinjaenv import safepath
+from . import config, context, extend, fragments, profiling, site, tracking
+from .filecache import Body, BodyRef
+from .jinjaenv import is_context_free, safepath
 
 # https://stackoverflow.com/a/2267446
 digs = string.digits + string.ascii_letters
@@ -52,11 +54,31 @@ class Content:
     use_abs_path = False
 
     src: ContentSrc
-    body: Optional[bytes]
+    _body: Optional[Body]
 
-    def __init__(self, src: ContentSrc, body: Optional[bytes]) -> None:
+    def __init__(self, src: ContentSrc, body: Optional[Body]) -> None:
         self.src = src
-        self.body = body
+        self._body = body
+
+    @property
+    def body(self) -> Optional[bytes]:
+        # Bodies loaded from the file cache are read on demand.
+        body = self._body
+        if isinstance(body, BodyRef):
+            return body.load()
+        return body
+
+    @body.setter
+    def body(self, body: Optional[bytes]) -> None:
+        self._body = body
+
+    def get_body_size(self) -> Optional[int]:
+        body = self._body
+        if isinstance(body, BodyRef):
+            return body.size
+        if body is not None:
+            return len(body)
+        return None
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} at {hex(id(self))} {self.src.srcpath}>"
@@ -101,6 +123,7 @@ date: {datestr}
     def get_config_metadata(
         self, site: site.Site, name: str, default: Any = _omit
     ) -> Any:
+        tracking.read_metadata(self.src.contentpath, name)
         if name in self.src.metadata:
             return config.format_value(name, self.src.metadata.get(name))
 
@@ -284,13 +307,25 @@ date: {datestr}
         self._build_html(ctx)
         return cast(str, ctx.get_cache("html", self))
 
+    def build_fragments(self, ctx: context.OutputContext) -> None:
+        """Render fragments shared with other output contexts"""
+        pass
+
     def get_soup(self, ctx: context.OutputContext) -> Any:
         ret = ctx.get_cache("soup", self)
         if ret:
             return ret
 
         self._build_html(ctx)
-        return ctx.get_cache("soup", self)
+        soup = ctx.get_cache("soup", self)
+        if soup is None:
+            # html restored from the fragment cache
+            html = ctx.get_cache("html", self)
+            if html:
+                with profiling.phase("soup"):
+                    soup = BeautifulSoup(html, "html.parser")
+                ctx.set_cache("soup", self, soup)
+        return soup
 
     def get_first_header(self, context: context.OutputContext) -> Optional[str]:
         soup = self.get_soup(context)
@@ -400,6 +435,10 @@ class BinContent(Content):
     pass
 
 
+# Contents of which headers are being built in the current thread.
+_building_headers = threading.local()
+
+
 class HTMLContent(Content):
     def metadata_ext(self, site: site.Site) -> str:
         ext = self.get_config_metadata(site, "ext", None)
@@ -482,22 +521,72 @@ class HTMLContent(Content):
         ctx.set_cache("header_anchors", self, header_anchors)
         return soup
 
+    # Caches built by _build_html_src(), shared between output contexts
+    SHARED_CACHES = ("html", "soup", "ids", "targets", "headers", "header_anchors")
+
+    def _is_shareable(self, ctx: context.OutputContext) -> bool:
+        shareable = context.render_cache.is_shareable(self)
+        if shareable is None:
+            # post_build_html hooks may depend on the output context
+            shareable = not extend.hooks_post_build_html
+            if shareable and self.get_metadata(ctx.site, "has_jinja"):
+                src = (self.body or b"").decode("utf-8")
+                shareable = is_context_free(ctx.jinjaenv, src)
+            context.render_cache.set_shareable(self, shareable)
+        return shareable
+
     def _build_html_src(self, ctx: context.OutputContext) -> None:
-        if self.get_metadata(ctx.site, "has_jinja"):
-            html = self.eval_body(ctx, "html")
-        else:
-            html = (self.body or b"").decode("utf-8")
+        shareable = self._is_shareable(ctx)
+        if shareable and (context.render_cache.get("html", self) is None):
+            fragments.load(ctx.site, self)
+
+        if shareable and (context.render_cache.get("html", self) is not None):
+            for name in self.SHARED_CACHES:
+                ctx.set_cache(name, self, context.render_cache.get(name, self))
 
-        soup = BeautifulSoup(html, "html.parser")
+            # metadata and configs read while rendering
+            tracking.replay(context.render_cache.get("reads", self))
+            return
 
-        soup = self.set_anchors(ctx, soup)
+        with tracking.recording() as reads:
+            if self.get_metadata(ctx.site, "has_jinja"):
+                html = self.eval_body(ctx, "html")
+            else:
+                html = (self.body or b"").decode("utf-8")
 
-        soup = extend.run_post_build_html(ctx, self, soup)
+            with profiling.phase("soup"):
+                soup = BeautifulSoup(html, "html.parser")
+
+            soup = self.set_anchors(ctx, soup)
+
+            soup = extend.run_post_build_html(ctx, self, soup)
 
         ctx.set_cache("html", self, str(soup))
         ctx.set_cache("soup", self, soup)
 
-    _in_build_headers = False
+        if shareable:
+            for name in self.SHARED_CACHES:
+                context.render_cache.set(name, self, ctx.get_cache(name, self))
+            context.render_cache.set("reads", self, reads)
+
+    def build_fragments(self, ctx: context.OutputContext) -> None:
+        if self._is_shareable(ctx):
+            self._build_html(ctx)
+            self.build_abstract(ctx)
+
+    @property
+    def _in_build_headers(self) -> bool:
+        return self in getattr(_building_headers, "contents", ())
+
+    @_in_build_headers.setter
+    def _in_build_headers(self, value: bool) -> None:
+        contents = getattr(_building_headers, "contents", None)
+        if contents is None:
+            contents = _building_headers.contents = set()
+        if value:
+            contents.add(self)
+        else:
+            contents.discard(self)
 
     def _build_headers(self, ctx: context.OutputContext) -> None:
 
@@ -521,23 +610,41 @@ class HTMLContent(Content):
         plain: bool = False,
     ) -> str:
 
-        abstract = self.get_metadata_abstract(ctx, plain)
-        if abstract is not None:
+        with profiling.phase("abstract"):
+            abstract = self.get_metadata_abstract(ctx, plain)
+            if abstract is not None:
+                return abstract
+
+            self._build_html(ctx)
+
+            if abstract_length is None:
+                abstract_length = ctx.content.get_metadata(
+                    ctx.site, "abstract_length"
+                )
+
+            if not self._is_shareable(ctx):
+                return self._build_abstract(ctx, abstract_length, plain)
+
+            cachename = f"abstract_{abstract_length}_{plain}"
+            abstract = context.render_cache.get(cachename, self)
+            if abstract is None:
+                abstract = self._build_abstract(ctx, abstract_length, plain)
+                context.render_cache.set(cachename, self, abstract)
             return abstract
 
-        self._build_html(ctx)
-        soup = ctx.get_cache("soup", self)
+    def _build_abstract(
+        self, ctx: context.OutputContext, abstract_length: int, plain: bool
+    ) -> str:
+
+        soup = self.get_soup(ctx)
         if not soup:
             return ""
 
-        soup = copy.copy(ctx.get_cache("soup", self))
+        soup = copy.copy(soup)
 
         for elem in soup(["head", "style", "script", "title"]):
             elem.extract()
 
-        if abstract_length is None:
-            abstract_length = ctx.content.get_metadata(ctx.site, "abstract_length")
-
         def return_abstract() -> str:
             if not plain:
                 return str(soup)
@@ -710,6 +817,6 @@ CONTENT_CLASSES = {
 }
 
 
-def build_content(contentsrc: ContentSrc, body: Optional[bytes]) -> Content:
+def build_content(contentsrc: ContentSrc, body: Optional[Body]) -> Content:
     cls = CONTENT_CLASSES[contentsrc.metadata["type"]]
     return cls(contentsrc, body)
@@ -4,11 +4,11 @@ import datetime
 import os
 import posixpath
 import random
-import shutil
+import threading
 import time
 import urllib.parse
 from abc import abstractmethod
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
 from functools import update_wrapper
 from pathlib import Path
@@ -43,6 +43,8 @@ from miyadaiku import (
     exceptions,
     parse_dir,
     parse_path,
+    profiling,
+    publish,
     repr_contentpath,
 )
 
@@ -94,6 +96,7 @@ class ContentProxy:
             setattr(self.content, k, v)
 
         self.context.invalidate_cache()
+        render_cache.invalidate(self.content)
         return ""
 
     @safe_prop
@@ -421,7 +424,9 @@ MKDIR_MAX_RETRY = 5
 MKDIR_WAIT = 0.1
 
 
-def prepare_output_path(path: Path, directory: PathTuple, filename: str) -> Path:
+def prepare_output_path(
+    path: Path, directory: PathTuple, filename: str, remove: bool = True
+) -> Path:
     dir = path.joinpath(*directory)
     name = filename.strip("/\\")
     dest = os.path.expanduser((dir / name))
@@ -440,7 +445,7 @@ def prepare_output_path(path: Path, directory: PathTuple, filename: str) -> Path
         except IOError:
             time.sleep(MKDIR_WAIT * random.random())
 
-    if os.path.exists(dest):
+    if remove and os.path.exists(dest):
         os.unlink(dest)
 
     return Path(dest).absolute()
@@ -472,7 +477,8 @@ def eval_jinja(
     template.filename = filename
 
     try:
-        return template.render(**kwargs)
+        with profiling.phase("jinja"):
+            return template.render(**kwargs)
 
     except exceptions.JinjaEvalError as e:
         e.add_error_from_src(e, template.filename, text)
@@ -505,7 +511,8 @@ def eval_jinja_template(
     args.update(kwargs)
 
     try:
-        return template.render(**args)
+        with profiling.template(templatename):
+            return template.render(**args)
 
     except exceptions.JinjaEvalError as e:
         e.add_error_from_template(e, ctx.jinjaenv, templatename)
@@ -532,10 +539,122 @@ class HTMLInfo(NamedTuple):
     ]  # ids of header elements specified by header_target class
 
 
+# Maximum number of contents held in the render cache.
+RENDER_CACHE_SIZE = 1000
+
+
+class RenderCache:
+    """Rendered HTML of contents shared by all output contexts in the process.
+
+    Only contents rendered independently of output contexts are stored.
+    Entries are valid while the content object is alive, so a content
+    reloaded for another build never hits stale entries.
+    """
+
+    _entries: OrderedDict[ContentPath, Tuple[Content, Optional[Dict[str, Any]]]]
+    _updated: Dict[ContentPath, Content]
+    _modified: Set[ContentPath]
+
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._updated = {}
+        self._modified = set()
+        self._lock = threading.RLock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._updated.clear()
+            self._modified.clear()
+
+    def _get_entry(self, content: Content) -> Optional[Tuple[Content, Any]]:
+        entry = self._entries.get(content.src.contentpath)
+        if entry is None or entry[0] is not content:
+            return None
+        self._entries.move_to_end(content.src.contentpath)
+        return entry
+
+    def is_shareable(self, content: Content) -> Optional[bool]:
+        """True if rendered html of the content is shared, False if not,
+        None if not known yet."""
+
+        with self._lock:
+            entry = self._get_entry(content)
+        if entry is None:
+            return None
+        return entry[1] is not None
+
+    def set_shareable(self, content: Content, shareable: bool) -> None:
+        contentpath = content.src.contentpath
+        with self._lock:
+            self._entries[contentpath] = (content, {} if shareable else None)
+            self._entries.move_to_end(contentpath)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, cachename: str, content: Content) -> Any:
+        with self._lock:
+            entry = self._get_entry(content)
+            if entry is None or entry[1] is None:
+                return None
+            return entry[1].get(cachename, None)
+
+    def set(self, cachename: str, content: Content, value: Any) -> None:
+        with self._lock:
+            entry = self._get_entry(content)
+            if entry is not None and entry[1] is not None:
+                entry[1][cachename] = value
+                self._updated[content.src.contentpath] = content
+
+    def load(self, content: Content, values: Dict[str, Any]) -> None:
+        """Restore entries saved by the fragment cache"""
+        with self._lock:
+            self.set_shareable(content, True)
+            entry = self._get_entry(content)
+            assert entry
+            entry[1].update(values)
+
+    def pop_updated(self) -> List[Tuple[Content, Dict[str, Any]]]:
+        """Entries updated since the last call"""
+        ret = []
+        with self._lock:
+            for contentpath, content in self._updated.items():
+                if contentpath in self._modified:
+                    continue
+                entry = self._get_entry(content)
+                if entry is not None and entry[1] is not None:
+                    ret.append((content, dict(entry[1])))
+            self._updated.clear()
+        return ret
+
+    def invalidate(self, content: Content) -> None:
+        with self._lock:
+            self._entries.pop(content.src.contentpath, None)
+            self._updated.pop(content.src.contentpath, None)
+            self._modified.add(content.src.contentpath)
+
+    def is_modified(self, content: Content) -> bool:
+        """True if the content was modified by ContentProxy.set()"""
+        with self._lock:
+            return content.src.contentpath in self._modified
+
+    def get_modified(self) -> Set[ContentPath]:
+        """Contents modified by ContentProxy.set()"""
+        with self._lock:
+            return set(self._modified)
+
+
+render_cache = RenderCache()
+
+
 class OutputContext:
     is_sitemap = False
     sitemap_priority = 0.5
 
+    # Remove existing output file before build
+    remove_output = True
+
     site: Site
     contentpath: ContentPath
     content: Content
@@ -565,7 +684,9 @@ class OutputContext:
         pageargs = self._build_pagearg()
         filename = self.content.build_filename(self, pageargs)
         dir = self.content.src.contentpath[0]
-        return prepare_output_path(self.site.outputdir, dir, filename)
+        return prepare_output_path(
+            self.site.outputdir, dir, filename, remove=self.remove_output
+        )
 
     def add_depend(self, content: Content) -> None:
         self.depends.add(content.src.contentpath)
@@ -709,18 +830,35 @@ class OutputContext:
 
 
 class BinaryOutput(OutputContext):
+    # Unchanged outputs are not written again.
+    remove_output = False
+
     def write_body(self, outpath: Path) -> None:
+        with profiling.phase("write"):
+            self._write_body(outpath)
+
+    def _write_body(self, outpath: Path) -> None:
         body = self.content.body
-        if body is None:
-            package = self.content.src.package
-            if package:
-                bytes = self.content.src.read_bytes()
-                outpath.write_bytes(bytes)
-            else:
-                assert self.content.src.srcpath
-                shutil.copyfile(self.content.src.srcpath, outpath)
+        if body is not None:
+            publish.publish_bytes(body, outpath)
+            return
+
+        src = self.content.src
+        mode = "copy"
+        if src.package:
+            srcpath = publish.get_local_path(src.get_package_path())
+            if not srcpath:
+                publish.publish_bytes(src.read_bytes(), outpath)
+                return
         else:
-            outpath.write_bytes(body)
+            assert src.srcpath
+            srcpath = src.srcpath
+            mode = publish.get_mode(
+                self.content.get_metadata(self.site, "binary_publish"),
+                src.repr_filename(),
+            )
+
+        publish.publish_file(srcpath, outpath, mode, self.site.use_hash)
 
     def build(self) -> List[OutputInfo]:
         oi = self.build_outputinfo()
@@ -740,7 +878,8 @@ class JinjaOutput(OutputContext):
         pagearg = self._build_pagearg()
         output = eval_jinja_template(self, self.content, templatename, pagearg)
 
-        oi.filename.write_text(output)
+        with profiling.phase("write"):
+            oi.filename.write_text(output)
         return [oi]
 
 
@@ -799,7 +938,8 @@ class IndexOutput(OutputContext):
         pagearg = self._build_pagearg()
         output = eval_jinja_template(self, self.content, templatename, pagearg)
 
-        oi.filename.write_text(output)
+        with profiling.phase("write"):
+            oi.filename.write_text(output)
         return [oi]
 
 
@@ -888,7 +1028,8 @@ class FeedOutput(OutputContext):
 
         body = feed.writeString("utf-8")
 
-        oi.filename.write_text(body)
+        with profiling.phase("write"):
+            oi.filename.write_text(body)
 
         return [oi]
 
@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+import json
 import os
 import pickle
+import sqlite3
 from pathlib import Path
 from typing import (
     TYPE_CHECKING,
-    Callable,
+    Any,
     Dict,
+    Iterable,
     Iterator,
+    List,
+    Mapping,
     Optional,
     Sequence,
     Set,
@@ -15,166 +20,585 @@ from typing import (
 )
 
 from miyadaiku import (
-    CONFIG_FILE,
-    CONTENTS_DIR,
     MODULES_DIR,
     NBCONVERT_TEMPLATES_DIR,
     TEMPLATES_DIR,
     BuildResult,
     ContentPath,
     DependsDict,
+    DependsRecord,
     OutputInfo,
+    PathTuple,
+    get_digest,
 )
 
+from . import explain
+from .config import CUMULATIVE_CONFIGS
+from .filetree import FileEntry, FileTree
+from .tracking import Members, Query, Reads, track
+
 if TYPE_CHECKING:
     from miyadaiku import site
 
-DEP_FILE = "_depends.pickle"
-DEP_VER = "4.0.0"
+DEP_FILE = "_depends.db"
+DEP_VER = "9.0.0"
+
+# Hash of files by filename
+Digests = Dict[str, str]
+
+# Configs in contents directory by directory
+DirConfigs = Dict[PathTuple, List[Dict[str, Any]]]
+
+
+def _key(contentpath: ContentPath) -> str:
+    return json.dumps([list(contentpath[0]), contentpath[1]])
+
+
+def _contentpath(key: str) -> ContentPath:
+    dirname, filename = json.loads(key)
+    return (tuple(dirname), filename)
+
+
+class DependsStore(Mapping[ContentPath, DependsRecord]):
+    """Depends records of contents in sqlite database.
+
+    Records are read in a query when they are accessed first, and remain
+    accessible after the database is closed. Only the records of
+    contents updated by a build are written.
+    """
+
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self._conn = sqlite3.connect(str(filename), timeout=30)
+        self._records: Optional[Dict[ContentPath, DependsRecord]] = None
+        self._keys: Optional[Set[ContentPath]] = None
+
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS meta (
+                    name TEXT PRIMARY KEY,
+                    value BLOB NOT NULL)"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS contents (
+                    contentpath TEXT PRIMARY KEY,
+                    value BLOB NOT NULL)"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS outputs (
+                    url TEXT PRIMARY KEY,
+                    contentpath TEXT NOT NULL,
+                    value BLOB NOT NULL)"""
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def load(self) -> Dict[ContentPath, DependsRecord]:
+        """Read all records."""
+
+        if self._records is None:
+            rows = self._conn.execute("SELECT contentpath, value FROM contents")
+            self._records = {
+                _contentpath(key): pickle.loads(value) for key, value in rows
+            }
+        return self._records
+
+    def _get_keys(self) -> Set[ContentPath]:
+        if self._records is not None:
+            return set(self._records)
+
+        if self._keys is None:
+            rows = self._conn.execute("SELECT contentpath FROM contents")
+            self._keys = {_contentpath(row[0]) for row in rows}
+        return self._keys
+
+    def __getitem__(self, contentpath: ContentPath) -> DependsRecord:
+        return self.load()[contentpath]
+
+    def __contains__(self, contentpath: object) -> bool:
+        return contentpath in self.load()
+
+    def __iter__(self) -> Iterator[ContentPath]:
+        return iter(self.load())
+
+    def __len__(self) -> int:
+        return len(self.load())
+
+    def get_meta(self, name: str, default: Any = None) -> Any:
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        if not row:
+            return default
+        return pickle.loads(row[0])
+
+    def get_outputinfos(self) -> List[OutputInfo]:
+        rows = self._conn.execute("SELECT value FROM outputs ORDER BY rowid")
+        return [pickle.loads(row[0]) for row in rows]
+
+    def write(
+        self,
+        records: Mapping[ContentPath, DependsRecord],
+        outputinfos: Iterable[OutputInfo],
+        meta: Dict[str, Any],
+        contentpaths: Set[ContentPath],
+        clear: bool = False,
+    ) -> None:
+        """Save updated records in a transaction.
+
+        Records of contents not in contentpaths are removed.
+        """
+
+        contents = [(_key(path), pickle.dumps(rec)) for path, rec in records.items()]
+        outputs = [
+            (oi.url, _key(oi.contentpath), pickle.dumps(oi)) for oi in outputinfos
+        ]
+        removed = [(_key(path),) for path in (self._get_keys() - contentpaths)]
+
+        with self._conn:
+            if clear:
+                self._conn.execute("DELETE FROM contents")
+                self._conn.execute("DELETE FROM outputs")
+            self._conn.executemany(
+                "DELETE FROM contents WHERE contentpath = ?", removed
+            )
+            self._conn.executemany(
+                "DELETE FROM outputs WHERE contentpath = ?", removed
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO contents VALUES (?, ?)", contents
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)", outputs
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [(name, pickle.dumps(value)) for name, value in meta.items()],
+            )
+
+        self._records = None
+        self._keys = None
+
+
+def open_store(site: site.Site) -> DependsStore:
+    return DependsStore(site.root / DEP_FILE)
+
+
+def load_store(site: site.Site) -> DependsStore:
+    """Read all records, and close the database."""
+
+    store = open_store(site)
+    try:
+        store.load()
+    finally:
+        store.close()
+    return store
+
 
+def is_newer(
+    entry: FileEntry, mtime: float, digests: Optional[Digests] = None
+) -> bool:
+    """True if the file was modified after mtime.
 
-def is_newer(path: Path, mtime: float) -> bool:
-    if not path.exists():
+    If digests is given, files with the same contents as the last build
+    are not modified.
+    """
+    if entry.stat.st_mtime <= mtime:
         return False
-    return path.stat().st_mtime > mtime
+    if digests is None:
+        return True
+    with open(entry.path, "rb") as f:
+        return digests.get(entry.path) != get_digest(f.read())
 
 
 def check_directory(
-    path: Path, mtime: float, pred: Optional[Callable[[Path], bool]] = None
+    tree: FileTree, mtime: float, digests: Optional[Digests] = None
 ) -> Iterator[Path]:
-    if not path.exists():
-        return
-
-    for root, dirs, files in os.walk(path):
-        rootpath = Path(root)
-        for file in files:
-            srcfile = rootpath / file
-            if pred and not pred(srcfile):
+    for entry in tree:
+        if is_newer(entry, mtime, digests):
+            yield Path(entry.path)
+
+
+def get_sitetrees(site: site.Site) -> List[FileTree]:
+    """Directories other than contents checked for update"""
+
+    return [
+        site.filetrees.get(site.root / dirname)
+        for dirname in (MODULES_DIR, TEMPLATES_DIR, NBCONVERT_TEMPLATES_DIR)
+    ]
+
+
+def get_digests(site: site.Site) -> Digests:
+    """Hash of files not modified since the site was loaded"""
+
+    ret = {}
+    for tree in get_sitetrees(site):
+        for entry in tree:
+            # stat again, since the file may be updated while building
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                continue
+            if stat.st_mtime <= site.files.mtime:
+                with open(entry.path, "rb") as f:
+                    ret[entry.path] = get_digest(f.read())
+    return ret
+
+
+def diff_metadata(old: Dict[str, Any], new: Dict[str, Any]) -> Set[str]:
+    """Keys of metadata added, removed or modified"""
+
+    notfound = object()
+    return {
+        key
+        for key in old.keys() | new.keys()
+        if old.get(key, notfound) != new.get(key, notfound)
+    }
+
+
+def diff_configs(old: DirConfigs, new: DirConfigs) -> Dict[PathTuple, Set[str]]:
+    """Keys of configs updated in each directory"""
+
+    ret = {}
+    for dirname in old.keys() | new.keys():
+        oldcfgs = old.get(dirname, [])
+        newcfgs = new.get(dirname, [])
+        if oldcfgs == newcfgs:
+            continue
+
+        notfound = object()
+        keys = set().union(*oldcfgs, *newcfgs)
+        ret[dirname] = {
+            key
+            for key in keys
+            if [c.get(key, notfound) for c in oldcfgs]
+            != [c.get(key, notfound) for c in newcfgs]
+        }
+    return ret
+
+
+def get_config_updates(
+    site: site.Site, updates: Dict[PathTuple, Set[str]]
+) -> Dict[ContentPath, Set[str]]:
+    """Config keys updated for each content.
+
+    Keys overridden by configs in subdirectories or by metadata of the
+    content are not updated for the content.
+    """
+
+    ret: Dict[ContentPath, Set[str]] = {}
+    for path, content in site.files.items():
+        dirname = content.get_parent()
+        for updated_dir, keys in updates.items():
+            if dirname[: len(updated_dir)] != updated_dir:
                 continue
-            if is_newer(srcfile, mtime):
-                yield srcfile
+
+            for key in keys:
+                if key not in CUMULATIVE_CONFIGS:
+                    if key in content.src.metadata:
+                        continue
+                    found = site.config.find_dirname(dirname, key)
+                    if found and (len(found) > len(updated_dir)):
+                        continue
+
+                ret.setdefault(path, set()).add(key)
+    return ret
+
+
+def _rebuild(
+    reason: str, **detail: Any
+) -> Tuple[bool, Set[ContentPath], DependsDict, Sequence[OutputInfo]]:
+    explain.rebuild(reason, **detail)
+    return True, set(), {}, []
 
 
 def check_depends(
     site: site.Site,
 ) -> Tuple[bool, Set[ContentPath], DependsDict, Sequence[OutputInfo]]:
-    deppath = site.root / DEP_FILE
+    if not (site.root / DEP_FILE).exists():
+        return _rebuild("no_depends_file")
 
-    mtime: float
-    ver: str
-    depends: DependsDict
-    results: BuildResult
+    try:
+        depends = open_store(site)
+    except Exception:
+        return _rebuild("depends_error")
 
-    # load depends file
+    # records are kept in memory after the database is closed
     try:
-        with open(deppath, "rb") as f:
-            recs = pickle.load(f)
+        return _check_depends(site, depends)
+    finally:
+        depends.close()
 
-        if recs[1] != DEP_VER:
-            # old file format
-            return True, set(), {}, []
 
-        mtime, ver, depends, outputinfos, errors = recs
+def _check_depends(
+    site: site.Site, depends: DependsStore
+) -> Tuple[bool, Set[ContentPath], DependsDict, Sequence[OutputInfo]]:
+    # load depends file
+    try:
+        if depends.get_meta("ver") != DEP_VER:
+            # old file format
+            return _rebuild("depends_version")
+
+        mtime: float = depends.get_meta("mtime")
+        errors: Set[ContentPath] = depends.get_meta("errors")
+        digests: Optional[Digests] = depends.get_meta("digests")
+        dirconfigs: DirConfigs = depends.get_meta("dirconfigs")
+        siteconfig: Dict[str, Any] = depends.get_meta("siteconfig", {})
+        global_configs: Set[str] = depends.get_meta("global_configs", set())
+        outputinfos = depends.get_outputinfos()
+        depends.load()
     except Exception:
         # file load error
-        return True, set(), {}, []
+        return _rebuild("depends_error")
 
-    # rebuild if config file updated
-    if is_newer(site.root / CONFIG_FILE, mtime):
-        return True, set(), {}, []
+    if not site.use_hash:
+        digests = None
+
+    # rebuild if configs read while loading the site are updated
+    siteconfig_updates = diff_metadata(siteconfig, site.siteconfig)
+    global_updates = siteconfig_updates & global_configs
+    if global_updates:
+        return _rebuild("site_config", keys=global_updates)
 
     # todo: check for removal of templates
 
+    moduletree, templatetree, nbtemplatetree = get_sitetrees(site)
+
     # check modules directory
-    if any(check_directory(site.root / MODULES_DIR, mtime)):
-        return True, set(), {}, []
+    module = next(check_directory(moduletree, mtime, digests=digests), None)
+    if module:
+        return _rebuild("module", filename=module)
 
     # check template directory
-    if any(check_directory(site.root / TEMPLATES_DIR, mtime)):
-        return True, set(), {}, []
+    updated_templates = {
+        path.relative_to(templatetree.root).as_posix()
+        for path in check_directory(templatetree, mtime, digests=digests)
+    }
+
+    if updated_templates:
+        # rebuild if templates loaded by the site are updated
+        with track() as global_reads:
+            site.build_jinjaenv()
+        global_templates = updated_templates & global_reads.templates
+        if global_templates:
+            return _rebuild("site_template", templates=global_templates)
 
     # check nbconvert template directory
-    if any(check_directory(site.root / NBCONVERT_TEMPLATES_DIR, mtime)):
-        return True, set(), {}, []
-
-    def is_yaml(filename: Path) -> bool:
-        return filename.suffix in (".yml", ".yaml")
+    nbtemplate = next(check_directory(nbtemplatetree, mtime, digests=digests), None)
+    if nbtemplate:
+        return _rebuild("nbconvert_template", filename=nbtemplate)
 
-    # check contents directory
-    if any(check_directory(site.root / CONTENTS_DIR, mtime, is_yaml)):
-        return True, set(), {}, []
-
-    # rebuild if contents are created or removed
     contentpaths = site.files.get_contentfiles_keys()
-    if contentpaths != depends.keys():
-        return True, set(), {}, []
+    created = contentpaths - depends.keys()
+    removed = depends.keys() - contentpaths
 
     # select for updated files
     updated: Set[ContentPath] = set()
+    metadata_updates: Dict[ContentPath, Set[str]] = {}
+
+    def update(path: ContentPath, reason: str, **detail: Any) -> None:
+        updated.add(path)
+        explain.update(path, reason, **detail)
+
+    def update_dependents(path: ContentPath) -> None:
+        for dependent in depends[path][1] & contentpaths:
+            if dependent != path:
+                update(dependent, "dependency", content=path)
+
+    for path in created:
+        update(path, "created")
+
+    for path in removed:
+        update_dependents(path)
 
     for path in contentpaths:
+        if path in created:
+            continue
+
         src = site.files.get_content(path).src
 
-        # rebuild if metadata changed
+        # rebuild the content and outputs read the metadata
         if src.metadata != depends[path][0].metadata:
-            return True, set(), {}, []
+            metadata_updates[path] = diff_metadata(
+                depends[path][0].metadata, src.metadata
+            )
+            update(path, "metadata", keys=metadata_updates[path])
+            update_dependents(path)
+            continue
+
+        if (src.mtime or 0) > mtime:
+            update(path, "source")
+            update_dependents(path)
+            continue
 
-        if ((src.mtime or 0) > mtime) or (path in errors):
-            updated.update(depends[path][1])
-            updated.add(path)
+        if path in errors:
+            update(path, "error")
+            update_dependents(path)
             continue
 
         for filename in depends[path][2]:
-            p = site.outputdir / filename
-            if not p.exists():
-                updated.add(path)
+            try:
+                stat = (site.outputdir / filename).stat()
+            except FileNotFoundError:
+                update(path, "output_missing", filename=filename)
                 break
 
-            stat = p.stat()
             if (src.mtime or 0) > stat.st_mtime:
-                updated.add(path)
+                update(path, "output_stale", filename=filename)
                 break
 
+    # rebuild contents under the directory of updated config files, and
+    # outputs which read the updated keys or listed the contents.
+    config_updates = get_config_updates(
+        site, diff_configs(dirconfigs, site.config.get_dirconfigs())
+    )
+    for path, keys in config_updates.items():
+        metadata_updates.setdefault(path, set()).update(keys)
+        update(path, "directory_config", keys=keys)
+        if path in depends:
+            update_dependents(path)
+
+    if config_updates:
+        affected = set(config_updates)
+        for path in contentpaths - created:
+            if depends[path][3].queried(affected):
+                update(path, "query_directory_config")
+
+    if metadata_updates:
+        for path in contentpaths - created:
+            if depends[path][3].read_metadata(metadata_updates):
+                update(path, "read_metadata")
+
+    # rebuild outputs read the updated site configs
+    if siteconfig_updates:
+
+        def overridden(dirname: PathTuple, name: str) -> bool:
+            if name in CUMULATIVE_CONFIGS:
+                return False
+            return site.config.find_dirname(dirname, name) is not None
+
+        for path in contentpaths - created:
+            if depends[path][3].read_config(siteconfig_updates, overridden):
+                update(path, "read_site_config", keys=siteconfig_updates)
+
+    if updated_templates:
+        for path in contentpaths - created:
+            templates = depends[path][3].templates & updated_templates
+            if templates:
+                update(path, "template", templates=templates)
+
+    # rebuild outputs whose query results are changed by created or
+    # removed contents, or by updated configs
+    if created or removed or config_updates:
+        query_results: Dict[str, Members] = {}
+
+        def run_query(query: Query) -> Members:
+            key = repr(query)
+            if key not in query_results:
+                contents = site.files.get_contents(site, *query)
+                query_results[key] = tuple(c.src.contentpath for c in contents)
+            return query_results[key]
+
+        for path in contentpaths - created:
+            if depends[path][3].query_updated(run_query):
+                update(path, "query")
+
     outputinfos = [oi for oi in outputinfos if site.files.has_content(oi.contentpath)]
     return False, updated, depends, outputinfos
 
 
+def get_buildtimes(outputinfos: Sequence[OutputInfo]) -> Dict[ContentPath, float]:
+    """Average build time of outputs for each content"""
+
+    totals: Dict[ContentPath, List[float]] = {}
+    for oi in outputinfos:
+        if oi.buildtime:
+            totals.setdefault(oi.contentpath, []).append(oi.buildtime)
+
+    return {path: sum(times) / len(times) for path, times in totals.items()}
+
+
+def load_buildtimes(site: site.Site) -> Dict[ContentPath, float]:
+    if not (site.root / DEP_FILE).exists():
+        return {}
+
+    try:
+        store = open_store(site)
+    except Exception:
+        return {}
+
+    try:
+        if store.get_meta("ver") != DEP_VER:
+            return {}
+        outputinfos = store.get_outputinfos()
+    except Exception:
+        return {}
+    finally:
+        store.close()
+
+    return get_buildtimes(outputinfos)
+
+
 def update_deps(
     site: site.Site,
     d: DependsDict,
     results: BuildResult,
     errors: Set[ContentPath],
-) -> DependsDict:
-
-    new: Dict[ContentPath, Tuple[Set[ContentPath], Set[str]]] = {}
+    builder_reads: Optional[Dict[ContentPath, Reads]] = None,
+) -> Dict[ContentPath, DependsRecord]:
+    """Records of contents updated by the build"""
+
+    new: Dict[ContentPath, Tuple[Set[ContentPath], Set[str], Reads]] = {}
+
+    def get(contentpath: ContentPath) -> Tuple[Set[ContentPath], Set[str], Reads]:
+        if contentpath not in new:
+            if contentpath in d:
+                contentsrc, depends, filenames, reads = d[contentpath]
+                new[contentpath] = (
+                    set(depends),
+                    {str(site.outputdir / f) for f in filenames},
+                    reads,
+                )
+            else:
+                new[contentpath] = (set(), set(), Reads())
+        return new[contentpath]
 
     for contentpath in site.files.get_contentfiles_keys():
-        new[contentpath] = (set(), set())
+        if contentpath not in d:
+            get(contentpath)
+
+    # reads of rebuilt contents are recorded again
+    builder_reads = builder_reads or {}
+    rebuilt = set(builder_reads) | {rec[0].contentpath for rec in results}
+    for contentpath in rebuilt:
+        depends, filenames, reads = get(contentpath)
+        new[contentpath] = (depends, filenames, Reads())
 
-    for contentpath, (contentsrc, depends, filenames) in d.items():
-        new[contentpath] = (depends, {str(site.outputdir / f) for f in filenames})
+    for contentpath, reads in builder_reads.items():
+        get(contentpath)[2].update(reads)
 
-    for contentsrc, depends, outputinfos in results:
-        filenames = {str(oi.filename) for oi in outputinfos}
-        if contentsrc.contentpath in new:
-            new[contentsrc.contentpath][1].update(filenames)
-        else:
-            new[contentsrc.contentpath] = (set(), filenames)
+    for contentsrc, depends, outputinfos, reads in results:
+        rec = get(contentsrc.contentpath)
+        rec[1].update(str(oi.filename) for oi in outputinfos)
+        rec[2].update(reads)
 
         for dep_contentpath in depends:
-            if dep_contentpath in new:
-                new[dep_contentpath][0].add(contentsrc.contentpath)
-            else:
-                new[dep_contentpath] = (set([contentsrc.contentpath]), set())
+            if (
+                (dep_contentpath in new)
+                or (dep_contentpath not in d)
+                or (contentsrc.contentpath not in d[dep_contentpath][1])
+            ):
+                get(dep_contentpath)[0].add(contentsrc.contentpath)
 
     outputpath = str(site.outputdir)
-    ret: DependsDict = {}
-    for contentpath, (depends, filenames) in new.items():
+    ret: Dict[ContentPath, DependsRecord] = {}
+    for contentpath, (depends, filenames, reads) in new.items():
         if site.files.has_content(contentpath):
             src = site.files.get_content(contentpath).src
 
             filenames = {os.path.relpath(f, outputpath) for f in filenames}
-            ret[contentpath] = (src, depends, filenames)
+            ret[contentpath] = (src, depends, filenames, reads)
 
     return ret
 
@@ -195,12 +619,45 @@ def update_outputinfos(
     return list(merged_outputs.values())
 
 
+def get_global_configs(site: site.Site) -> Set[str]:
+    """Names of site configs which affect all contents"""
+
+    ret = {"themes", "ignores"}
+    ret.update(name for dirname, name in site.load_reads.configs)
+    return ret
+
+
 def save_deps(
     site: site.Site,
     depsdict: DependsDict,
     outputinfos: Sequence[OutputInfo],
     errors: Set[ContentPath],
+    clear: bool = False,
 ) -> None:
-
-    with open(site.root / DEP_FILE, "wb") as f:
-        pickle.dump((site.files.mtime, DEP_VER, depsdict, outputinfos, errors), f)
+    """Save updated records of contents and outputs.
+
+    If clear is True, records not in depsdict and outputinfos are removed.
+    """
+
+    meta = {
+        "ver": DEP_VER,
+        "mtime": site.files.mtime,
+        "errors": errors,
+        "digests": get_digests(site) if site.use_hash else {},
+        "dirconfigs": site.config.get_dirconfigs(),
+        "siteconfig": site.siteconfig,
+        "global_configs": get_global_configs(site),
+    }
+
+    records = dict(depsdict.items())
+    store = open_store(site)
+    try:
+        store.write(
+            records,
+            outputinfos,
+            meta,
+            set(site.files.get_contentfiles_keys()),
+            clear=clear,
+        )
+    finally:
+        store.close()
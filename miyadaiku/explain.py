@@ -0,0 +1,141 @@
+"""Reasons of rebuild for ``muneage --explain``."""
+
+from __future__ import annotations
+
+import json
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from miyadaiku import ContentPath, repr_contentpath
+
+# Number of contents listed for each reason in the summary log.
+SUMMARY_COUNT = 10
+
+
+def _to_json(value: Any) -> Any:
+    # ContentPath
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], tuple):
+        return repr_contentpath(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(_to_json(v) for v in value)
+    if isinstance(value, Path):
+        return str(value)
+    return value
+
+
+def _reason(reason: str, detail: Dict[str, Any]) -> Dict[str, Any]:
+    ret = {"reason": reason}
+    ret.update((k, _to_json(v)) for k, v in detail.items())
+    return ret
+
+
+class Explainer:
+    def __init__(self) -> None:
+        self.rebuild: Optional[Dict[str, Any]] = None
+        self.contents: Dict[ContentPath, List[Dict[str, Any]]] = {}
+
+    def add_rebuild(self, reason: str, detail: Dict[str, Any]) -> None:
+        self.rebuild = _reason(reason, detail)
+
+    def add(
+        self, contentpath: ContentPath, reason: str, detail: Dict[str, Any]
+    ) -> None:
+        self.contents.setdefault(contentpath, []).append(_reason(reason, detail))
+
+
+_explainer: Optional[Explainer] = None
+
+
+def enable() -> Explainer:
+    global _explainer
+    _explainer = Explainer()
+    return _explainer
+
+
+def disable() -> None:
+    global _explainer
+    _explainer = None
+
+
+def get_explainer() -> Optional[Explainer]:
+    return _explainer
+
+
+def rebuild(reason: str, **detail: Any) -> None:
+    """Record the reason why all contents are rebuilt."""
+
+    explainer = _explainer
+    if explainer is not None:
+        explainer.add_rebuild(reason, detail)
+
+
+def update(contentpath: ContentPath, reason: str, **detail: Any) -> None:
+    """Record a reason why the content is rebuilt."""
+
+    explainer = _explainer
+    if explainer is not None:
+        explainer.add(contentpath, reason, detail)
+
+
+def build_report(
+    explainer: Explainer, builders: Dict[ContentPath, int]
+) -> Dict[str, Any]:
+    """Reasons for each content with scheduled builders."""
+
+    contents = []
+    for contentpath, num in sorted(builders.items()):
+        if explainer.rebuild:
+            reasons = [explainer.rebuild]
+        else:
+            reasons = explainer.contents.get(contentpath, [])
+
+        contents.append(
+            {
+                "contentpath": repr_contentpath(contentpath),
+                "builders": num,
+                "reasons": reasons,
+            }
+        )
+
+    return {
+        "rebuild": explainer.rebuild,
+        "num_builders": sum(builders.values()),
+        "contents": contents,
+    }
+
+
+def format_summary(report: Dict[str, Any]) -> str:
+    lines = [
+        f"Rebuild {len(report['contents'])} contents, "
+        f"{report['num_builders']} builders"
+    ]
+
+    rebuild = report["rebuild"]
+    if rebuild:
+        detail = ", ".join(f"{k}: {v}" for k, v in rebuild.items() if k != "reason")
+        lines.append(f"  full rebuild by {rebuild['reason']} {detail}".rstrip())
+        return "\n".join(lines)
+
+    counts: Counter[str] = Counter()
+    examples: Dict[str, List[str]] = {}
+    for d in report["contents"]:
+        for reason in {r["reason"] for r in d["reasons"]}:
+            counts[reason] += 1
+            examples.setdefault(reason, []).append(d["contentpath"])
+
+    for reason, count in counts.most_common():
+        names = ", ".join(examples[reason][:SUMMARY_COUNT])
+        if count > SUMMARY_COUNT:
+            names += ", ..."
+        lines.append(f"  {reason}: {count} contents ({names})")
+
+    return "\n".join(lines)
+
+
+def write_report(
+    explainer: Explainer, builders: Dict[ContentPath, int], filename: Path
+) -> Dict[str, Any]:
+    report = build_report(explainer, builders)
+    filename.write_text(json.dumps(report, indent=2))
+    return report
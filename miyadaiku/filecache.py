@@ -0,0 +1,359 @@
+"""Cache of loaded source files.
+
+Contents loaded from source files are saved in a sqlite database in the
+site directory, so that files not updated since the last build are not
+parsed again. Bodies are compressed, and entries of removed files are
+deleted when the site is loaded.
+
+Bodies are stored by their hash, and contents hold references to them
+instead of the bodies. Bodies are read when they are used.
+
+Files in installed theme packages are also saved, with the version and
+the location of the package, so that the packages are not walked again
+until they are upgraded or moved.
+"""
+
+from __future__ import annotations
+
+import functools
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+from miyadaiku import ContentSrc, get_digest
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = "_file_cache.db"
+CACHE_VER = "4.0.0"
+
+# Number of files written in a transaction.
+BATCH_SIZE = 500
+
+# Number of bodies kept in memory after read.
+BODY_CACHE_SIZE = 256
+
+
+class BodyRef(NamedTuple):
+    """Body stored in the cache file"""
+
+    filename: str
+    hash: str
+    size: int
+
+    def load(self) -> bytes:
+        return load_body(self.filename, self.hash)
+
+
+Body = Union[bytes, BodyRef]
+
+Loaded = List[Tuple[ContentSrc, Optional[Body]]]
+
+# size and mtime in nanoseconds
+StatKey = Tuple[int, int]
+
+
+def get_statkey(stat: Any) -> StatKey:
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class CacheEntry(NamedTuple):
+    stat: StatKey
+    digest: Optional[str]
+    loaded: Loaded
+
+
+class CacheInfo(NamedTuple):
+    ver: Optional[str]
+    files: int
+    size: int
+
+
+class FileCache:
+    def __init__(self, filename: Path, clear: bool = False) -> None:
+        self.filename = filename
+        self._pendings: Dict[str, CacheEntry] = {}
+        self._bodies: Dict[str, bytes] = {}
+        self._seen: Set[str] = set()
+        self._seen_packages: Set[str] = set()
+        self._updated = False
+
+        # Packages not updated since cached. Files in the packages are
+        # not checked if they are updated.
+        self.fixed_packages: Set[str] = set()
+
+        try:
+            self._conn = self._open(clear)
+        except sqlite3.DatabaseError:
+            # not a sqlite database, e.g. cache of old versions
+            logger.info("Recreate %s", filename)
+            os.unlink(filename)
+            self._conn = self._open(True)
+
+    def _open(self, clear: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.filename), timeout=30)
+        try:
+            with conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS meta (
+                        name TEXT PRIMARY KEY,
+                        value TEXT NOT NULL)"""
+                )
+                row = conn.execute(
+                    "SELECT value FROM meta WHERE name = 'ver'"
+                ).fetchone()
+
+                if clear or not row or (row[0] != CACHE_VER):
+                    conn.execute("DROP TABLE IF EXISTS files")
+                    conn.execute("DROP TABLE IF EXISTS refs")
+                    conn.execute("DROP TABLE IF EXISTS bodies")
+                    conn.execute("DROP TABLE IF EXISTS packages")
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('ver', ?)", (CACHE_VER,)
+                    )
+
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS files (
+                        key TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime INTEGER NOT NULL,
+                        digest TEXT,
+                        srcs BLOB NOT NULL)"""
+                )
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS refs (
+                        key TEXT NOT NULL,
+                        hash TEXT NOT NULL)"""
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS refs_key ON refs (key)")
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS bodies (
+                        hash TEXT PRIMARY KEY,
+                        body BLOB NOT NULL)"""
+                )
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS packages (
+                        key TEXT PRIMARY KEY,
+                        package TEXT NOT NULL,
+                        fingerprint TEXT NOT NULL,
+                        srcs BLOB NOT NULL)"""
+                )
+        except sqlite3.DatabaseError:
+            conn.close()
+            raise
+        return conn
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Get the entry of the file. Bodies are not read from the cache."""
+
+        self._seen.add(key)
+        if key in self._pendings:
+            return self._pendings[key]
+
+        row = self._conn.execute(
+            "SELECT size, mtime, digest, srcs FROM files WHERE key = ?", (key,)
+        ).fetchone()
+        if not row:
+            return None
+
+        size, mtime, digest, srcs = row
+        loaded: Loaded = []
+        for src, body in pickle.loads(srcs):
+            if isinstance(body, BodyRef):
+                # the site directory may be moved
+                body = body._replace(filename=str(self.filename))
+            loaded.append((src, body))
+        return CacheEntry((size, mtime), digest, loaded)
+
+    def put(self, key: str, entry: CacheEntry) -> Loaded:
+        """Add the entry of the file, and return the loaded contents with
+        references to their bodies.
+
+        The references are valid after the cache is flushed.
+        """
+
+        loaded: Loaded = []
+        for src, body in entry.loaded:
+            if isinstance(body, bytes):
+                ref = BodyRef(str(self.filename), get_digest(body), len(body))
+                self._bodies[ref.hash] = body
+                body = ref
+            loaded.append((src, body))
+
+        self._seen.add(key)
+        self._pendings[key] = CacheEntry(entry.stat, entry.digest, loaded)
+        if len(self._pendings) >= BATCH_SIZE:
+            self.flush()
+        return loaded
+
+    def get_package(
+        self, key: str, package: str, fingerprint: str
+    ) -> Optional[List[ContentSrc]]:
+        """Get the files in the package directory, if the package is not
+        updated since they are saved."""
+
+        self._seen_packages.add(key)
+        row = self._conn.execute(
+            "SELECT fingerprint, srcs FROM packages WHERE key = ?", (key,)
+        ).fetchone()
+        if not row or (row[0] != fingerprint):
+            return None
+
+        self.fixed_packages.add(package)
+        srcs: List[ContentSrc] = pickle.loads(row[1])
+        return srcs
+
+    def put_package(
+        self, key: str, package: str, fingerprint: str, srcs: List[ContentSrc]
+    ) -> None:
+        self._seen_packages.add(key)
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?)",
+                (key, package, fingerprint, pickle.dumps(srcs)),
+            )
+
+    def read(self, body: Optional[Body]) -> Optional[bytes]:
+        """Read the body, including bodies not flushed yet."""
+
+        if isinstance(body, BodyRef):
+            if body.hash in self._bodies:
+                return self._bodies[body.hash]
+            row = self._conn.execute(
+                "SELECT body FROM bodies WHERE hash = ?", (body.hash,)
+            ).fetchone()
+            if not row:
+                raise KeyError(body.hash)
+            return zlib.decompress(row[0])
+        return body
+
+    def flush(self) -> None:
+        """Write pending entries in a transaction."""
+
+        if not self._pendings:
+            return
+
+        files = []
+        refs = []
+        for key, (stat, digest, loaded) in self._pendings.items():
+            files.append((key, stat[0], stat[1], digest, pickle.dumps(loaded)))
+            for src, body in loaded:
+                if isinstance(body, BodyRef):
+                    refs.append((key, body.hash))
+
+        bodies = [(hash, zlib.compress(body)) for hash, body in self._bodies.items()]
+
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM refs WHERE key = ?", [(f[0],) for f in files]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", files
+            )
+            self._conn.executemany("INSERT INTO refs VALUES (?, ?)", refs)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO bodies VALUES (?, ?)", bodies
+            )
+
+        self._pendings = {}
+        self._bodies = {}
+        self._updated = True
+
+    def evict(self) -> int:
+        """Delete entries of files and packages not read nor written since
+        opened, and
+        bodies not referred from any file."""
+
+        self.flush()
+        keys = [
+            row[0] for row in self._conn.execute("SELECT key FROM files").fetchall()
+        ]
+        removed = [(key,) for key in keys if key not in self._seen]
+
+        packages = [
+            row[0]
+            for row in self._conn.execute("SELECT key FROM packages").fetchall()
+        ]
+        removed_packages = [
+            (key,) for key in packages if key not in self._seen_packages
+        ]
+
+        with self._conn:
+            if removed_packages:
+                self._conn.executemany(
+                    "DELETE FROM packages WHERE key = ?", removed_packages
+                )
+
+            if removed:
+                self._conn.executemany("DELETE FROM files WHERE key = ?", removed)
+                self._conn.executemany("DELETE FROM refs WHERE key = ?", removed)
+
+            if removed or self._updated:
+                self._conn.execute(
+                    "DELETE FROM bodies WHERE hash NOT IN (SELECT hash FROM refs)"
+                )
+        return len(removed)
+
+    def close(self, evict: bool = False) -> None:
+        if evict:
+            self.evict()
+        else:
+            self.flush()
+        self._conn.close()
+
+    def compact(self) -> None:
+        self.flush()
+        self._conn.execute("VACUUM")
+
+    def info(self) -> CacheInfo:
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'ver'").fetchone()
+        (files,) = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()
+        return CacheInfo(row[0] if row else None, files, self.filename.stat().st_size)
+
+
+def compact(root: Path) -> Tuple[CacheInfo, CacheInfo]:
+    """Compact the cache file of the site, and return the info of the cache
+    before and after compaction."""
+
+    cache = FileCache(root / CACHE_FILE)
+    try:
+        before = cache.info()
+        cache.compact()
+        after = cache.info()
+    finally:
+        cache.close()
+    return before, after
+
+
+_readers: Dict[str, Tuple[int, sqlite3.Connection]] = {}
+_readers_lock = threading.Lock()
+
+
+def _get_reader(filename: str) -> sqlite3.Connection:
+    pid = os.getpid()
+    reader = _readers.get(filename)
+    if reader and reader[0] == pid:
+        return reader[1]
+
+    uri = f"{Path(filename).as_uri()}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=30, check_same_thread=False)
+    _readers[filename] = (pid, conn)
+    return conn
+
+
+@functools.lru_cache(maxsize=BODY_CACHE_SIZE)
+def load_body(filename: str, hash: str) -> bytes:
+    with _readers_lock:
+        row = (
+            _get_reader(filename)
+            .execute("SELECT body FROM bodies WHERE hash = ?", (hash,))
+            .fetchone()
+        )
+    if not row:
+        raise KeyError(f"{hash} is not found in {filename}")
+    return zlib.decompress(row[0])
@@ -0,0 +1,115 @@
+"""Files in the site directory, scanned once per build.
+
+The loader and the depends checker read file lists, stats and presence
+of metadata files from the trees instead of walking the directories and
+calling stat() for each file again.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+import os
+import posixpath
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import miyadaiku
+
+
+def is_ignored(ignores: Set[str], name: str) -> bool:
+    if name.lower().endswith(miyadaiku.METADATA_FILE_SUFFIX):
+        return True
+
+    basename = os.path.basename(name)
+    for p in ignores:
+        if fnmatch.fnmatch(basename, p):
+            return True
+    return False
+
+
+class FileEntry(NamedTuple):
+    path: str
+    relpath: str  # posix path from the root of the tree
+    stat: os.stat_result
+    metadatafile: Optional[str]
+
+
+class FileTree:
+    """Files in a directory, scanned by os.scandir().
+
+    If ignores is None, every file is listed. Otherwise ignored files,
+    metadata files and hidden directories are skipped.
+    """
+
+    def __init__(self, root: Path, ignores: Optional[Set[str]] = None) -> None:
+        self.root = root
+        self.ignores = ignores
+        self.entries: List[FileEntry] = []
+        self.stats: Dict[str, os.stat_result] = {}
+
+        self._scan(str(root), "")
+
+    def _scan(self, dirname: str, reldir: str) -> None:
+        try:
+            with os.scandir(dirname) as it:
+                entries = list(it)
+        except OSError:
+            return
+
+        names = {entry.name for entry in entries}
+        subdirs = []
+        for entry in entries:
+            if (self.ignores is not None) and is_ignored(self.ignores, entry.name):
+                continue
+
+            relpath = posixpath.join(reldir, entry.name)
+            if entry.is_dir():
+                # symlinks to directories are not followed, as os.walk()
+                if entry.is_symlink():
+                    continue
+                if (self.ignores is not None) and entry.name.startswith("."):
+                    continue
+                subdirs.append((entry.path, relpath))
+                continue
+
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            metadatafile = None
+            if self.ignores is not None:
+                metadataname = f"{entry.name}{miyadaiku.METADATA_FILE_SUFFIX}"
+                if metadataname in names:
+                    metadatafile = os.path.join(dirname, metadataname)
+
+            self.entries.append(FileEntry(entry.path, relpath, stat, metadatafile))
+            self.stats[entry.path] = stat
+
+        for path, relpath in subdirs:
+            self._scan(path, relpath)
+
+    def __iter__(self) -> Iterator[FileEntry]:
+        return iter(self.entries)
+
+
+class FileTrees:
+    """Trees scanned while building the site."""
+
+    def __init__(self) -> None:
+        self._trees: Dict[Tuple[Path, Optional[FrozenSet[str]]], FileTree] = {}
+
+    def get(self, path: Path, ignores: Optional[Set[str]] = None) -> FileTree:
+        path = path.expanduser().resolve()
+        key = (path, frozenset(ignores) if ignores is not None else None)
+        tree = self._trees.get(key)
+        if tree is None:
+            tree = self._trees[key] = FileTree(path, ignores)
+        return tree
+
+    def get_stat(self, path: str) -> Optional[os.stat_result]:
+        for tree in self._trees.values():
+            stat = tree.stats.get(path)
+            if stat is not None:
+                return stat
+        return None
@@ -0,0 +1,236 @@
+"""Persistent cache of rendered html fragments of contents.
+
+Html, headers, targets, ids and abstracts of contents shared by the
+render cache are saved next to the depends file, so that index and feed
+pages built later can reuse them without rendering the articles again.
+Each fragment is tagged with the build that rendered it. Full rebuilds
+use only the fragments rendered in phase 1 of the current build.
+Metadata and configs read while rendering are saved with them, and
+replayed to the depends of the pages.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+
+import miyadaiku
+from miyadaiku import repr_contentpath
+
+from . import context
+
+if TYPE_CHECKING:
+    from .contents import Content
+    from .site import Site
+
+logger = logging.getLogger(__name__)
+
+FRAGMENT_FILE = "_fragments.db"
+FRAGMENT_VER = "1.1.0"
+
+# Config values used to render html of a content.
+RENDER_CONFIGS = ("has_jinja", "short_header_id")
+
+# Soup is rebuilt from html on demand.
+NOT_STORED = ("soup",)
+
+
+def get_key(site: Site, content: Content) -> str:
+    """Digest of everything html of a content depends on.
+
+    Shared contents depend on no other contents, so the dependency set
+    is the content itself.
+    """
+
+    h = hashlib.sha256()
+    for value in (
+        FRAGMENT_VER,
+        miyadaiku.__version__,
+        repr(content.src.contentpath),
+        repr(sorted(content.src.metadata.items(), key=lambda item: item[0])),
+        repr([content.get_metadata(site, name, None) for name in RENDER_CONFIGS]),
+    ):
+        h.update(value.encode("utf-8"))
+        h.update(b"\0")
+    h.update(content.body or b"")
+    return h.hexdigest()
+
+
+class FragmentStore:
+    def __init__(self, filename: Path) -> None:
+        self.filename = filename
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(filename), timeout=30, check_same_thread=False
+        )
+        with self._conn:
+            columns = [
+                row[1]
+                for row in self._conn.execute("PRAGMA table_info(fragments)")
+            ]
+            if columns and ("build" not in columns):
+                # created by older versions
+                self._conn.execute("DROP TABLE fragments")
+
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS fragments (
+                    contentpath TEXT PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    build TEXT NOT NULL,
+                    value BLOB NOT NULL)"""
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def get(
+        self, content: Content, key: str, build: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Get fragments of the content. If build is given, fragments
+        rendered by other builds are ignored."""
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, build, value FROM fragments WHERE contentpath = ?",
+                (repr_contentpath(content.src.contentpath),),
+            ).fetchone()
+
+        if not row or row[0] != key:
+            return None
+
+        if (build is not None) and (row[1] != build):
+            return None
+
+        try:
+            return pickle.loads(row[2])  # type: ignore
+        except Exception:
+            return None
+
+    def put(
+        self, rows: List[Tuple[Content, str, Dict[str, Any]]], build: str
+    ) -> None:
+        if not rows:
+            return
+
+        values = [
+            (
+                repr_contentpath(content.src.contentpath),
+                key,
+                build,
+                pickle.dumps(value),
+            )
+            for content, key, value in rows
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?)", values
+            )
+
+    def prune(self, contentpaths: Set[str]) -> int:
+        """Delete fragments of contents not in contentpaths."""
+
+        with self._lock, self._conn:
+            rows = self._conn.execute("SELECT contentpath FROM fragments").fetchall()
+            removed = [row for row in rows if row[0] not in contentpaths]
+            self._conn.executemany(
+                "DELETE FROM fragments WHERE contentpath = ?", removed
+            )
+        return len(removed)
+
+
+_store: Optional[FragmentStore] = None
+
+
+def get_store(site: Site) -> Optional[FragmentStore]:
+    global _store
+
+    filename = site.root / FRAGMENT_FILE
+    if _store and (_store.filename == filename) and (_store.pid == os.getpid()):
+        return _store
+
+    if _store and _store.pid == os.getpid():
+        _store.close()
+    _store = None
+
+    try:
+        _store = FragmentStore(filename)
+    except sqlite3.Error:
+        logger.exception("Failed to open %s", filename)
+    return _store
+
+
+def new_build_id() -> str:
+    return uuid.uuid4().hex
+
+
+def load(site: Site, content: Content) -> bool:
+    """Restore fragments of the content into the render cache."""
+
+    build = None
+    if site.rebuild or not site.reuse_fragments:
+        # fragments of previous builds may be rendered by old filters
+        if not site.build_id:
+            return False
+        build = site.build_id
+
+    if context.render_cache.is_modified(content):
+        return False
+
+    store = get_store(site)
+    if not store:
+        return False
+
+    try:
+        value = store.get(content, get_key(site, content), build)
+    except sqlite3.Error:
+        logger.exception("Failed to load fragments of %s", content.src.repr_filename())
+        return False
+
+    if value is None:
+        return False
+
+    context.render_cache.load(content, value)
+    return True
+
+
+def flush(site: Site) -> None:
+    """Save fragments rendered since the last flush."""
+
+    rows = []
+    for content, values in context.render_cache.pop_updated():
+        value = {k: v for k, v in values.items() if k not in NOT_STORED}
+        rows.append((content, get_key(site, content), value))
+
+    if not rows:
+        return
+
+    store = get_store(site)
+    if not store:
+        return
+
+    try:
+        store.put(rows, site.build_id)
+    except sqlite3.Error:
+        logger.exception("Failed to save fragments")
+
+
+def prune(site: Site) -> None:
+    """Delete fragments of contents removed from the site."""
+
+    store = get_store(site)
+    if not store:
+        return
+
+    contentpaths = {repr_contentpath(path) for path, content in site.files.items()}
+    try:
+        store.prune(contentpaths)
+    except sqlite3.Error:
+        logger.exception("Failed to prune fragments")
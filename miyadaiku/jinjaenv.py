@@ -3,7 +3,7 @@ import os
 import re
 import urllib
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, List, MutableMapping, Optional, Tuple, Union
 
 from jinja2 import DebugUndefined  # NOQA
 from jinja2 import StrictUndefined  # NOQA
@@ -14,12 +14,18 @@ from jinja2 import (
     PackageLoader,
     PrefixLoader,
     TemplateNotFound,
+    Template,
+    TemplateSyntaxError,
+    Undefined,
     make_logging_undefined,
+    meta,
     select_autoescape,
 )
 
 import miyadaiku.site
 
+from . import tracking
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,6 +49,37 @@ class PackagesLoader(PrefixLoader):
         raise TypeError("this loader cannot iterate over all templates")
 
 
+class TrackingEnvironment(Environment):
+    """Records names of templates loaded by templates and contents.
+
+    Extends, includes and imports call get_template() or select_template()
+    every time they are rendered, even if the template is cached.
+    """
+
+    def get_template(
+        self,
+        name: Union[str, Template],
+        parent: Optional[str] = None,
+        globals: Optional[MutableMapping[str, Any]] = None,
+    ) -> Template:
+        if isinstance(name, str):
+            tracking.read_template(name)
+        return super().get_template(name, parent, globals)
+
+    def select_template(
+        self,
+        names: Iterable[Union[str, Template]],
+        parent: Optional[str] = None,
+        globals: Optional[MutableMapping[str, Any]] = None,
+    ) -> Template:
+        if not isinstance(names, Undefined):
+            names = list(names)
+            for name in names:
+                if isinstance(name, str):
+                    tracking.read_template(name)
+        return super().select_template(names, parent, globals)
+
+
 EXTENSIONS = ["jinja2.ext.do"]
 
 
@@ -52,6 +89,30 @@ def safepath(s: str) -> str:
     return s
 
 
+def is_context_free(env: Environment, src: str) -> bool:
+    """True if template source renders the same result in any context,
+    i.e. it refers to neither variables nor other templates."""
+
+    if not (env.line_statement_prefix or env.line_comment_prefix):
+        starts = (
+            env.block_start_string,
+            env.variable_start_string,
+            env.comment_start_string,
+        )
+        if not any(start in src for start in starts):
+            return True
+
+    try:
+        ast = env.parse(src)
+    except TemplateSyntaxError:
+        return False
+
+    if meta.find_undeclared_variables(ast):
+        return False
+
+    return not any(True for _ in meta.find_referenced_templates(ast))
+
+
 def urlquote(s: str) -> str:
     s = str(s)
     s = urllib.parse.quote_plus(s)
@@ -76,7 +137,7 @@ def create_env(
 
     loaders.append(PackageLoader("miyadaiku.themes.base"))
 
-    env = Environment(
+    env = TrackingEnvironment(
         undefined=make_logging_undefined(logger, DebugUndefined),
         # undefined=make_logging_undefined(logger, StrictUndefined),
         loader=ChoiceLoader(loaders),
@@ -1,27 +1,32 @@
 from __future__ import annotations
 
 import collections.abc
-import fnmatch
+import functools
+import importlib
+import importlib.metadata
+import json
 import logging
+import multiprocessing
 import os
 import posixpath
-import shelve
 import time
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor  # noqa
 from pathlib import Path
 from typing import (
     Any,
+    Callable,
     Dict,
     ItemsView,
     Iterable,
     Iterator,
     KeysView,
+    Mapping,
     List,
     Optional,
     Sequence,
     Set,
     Tuple,
-    cast,
+    Union,
 )
 
 import importlib_resources
@@ -30,61 +35,47 @@ import yaml
 import miyadaiku
 from miyadaiku import ContentPath, ContentSrc, PathTuple, to_contentpath
 
-from . import config, contents, exceptions, extend, html, site
+from . import (
+    config,
+    contents,
+    exceptions,
+    extend,
+    filecache,
+    filetree,
+    html,
+    mp_log,
+    profiling,
+    site,
+    tracking,
+)
 from .contents import Content
+from .filecache import Body, CacheEntry, Loaded, StatKey, get_statkey
+from .filetree import is_ignored
 
 logger = logging.getLogger(__name__)
 
 
-def is_ignored(ignores: Set[str], name: str) -> bool:
-    if name.lower().endswith(miyadaiku.METADATA_FILE_SUFFIX):
-        return True
-
-    basename = os.path.basename(name)
-    for p in ignores:
-        if fnmatch.fnmatch(basename, p):
-            return True
-    return False
-
-
-def walk_directory(path: Path, ignores: Set[str]) -> Iterator[ContentSrc]:
+def walk_directory(
+    path: Path, ignores: Set[str], tree: Optional[filetree.FileTree] = None
+) -> Iterator[ContentSrc]:
     logger.info(f"Loading {path}")
-    path = path.expanduser().resolve()
-    if not path.is_dir():
-        return
-
-    for root, dirs, files in os.walk(path):
-        rootpath = Path(root)
-        if rootpath.stem.startswith("."):
-            continue
-
-        dirs[:] = (dirname for dirname in dirs if not is_ignored(ignores, dirname))
-        filenames = (
-            filename for filename in files if not is_ignored(ignores, filename)
-        )
-
-        for name in filenames:
-            filename = (rootpath / name).resolve()
+    if tree is None:
+        tree = filetree.FileTree(path.expanduser().resolve(), ignores)
 
-            dirname, fname = os.path.split(filename)
-            metadatafile = os.path.join(
-                dirname, f"{fname}{miyadaiku.METADATA_FILE_SUFFIX}"
-            )
-
-            metadata: Dict[Any, Any] = {}
+    for entry in tree:
+        metadata: Dict[Any, Any] = {}
 
-            if os.path.isfile(metadatafile):
-                text = open(metadatafile, encoding=miyadaiku.YAML_ENCODING).read()
-                metadata = yaml.load(text, Loader=yaml.FullLoader) or {}
+        if entry.metadatafile:
+            text = open(entry.metadatafile, encoding=miyadaiku.YAML_ENCODING).read()
+            metadata = yaml.load(text, Loader=yaml.FullLoader) or {}
 
-            mtime = filename.stat().st_mtime
-            yield ContentSrc(
-                package="",
-                srcpath=str(filename),
-                metadata=metadata,
-                contentpath=to_contentpath(str(filename.relative_to(path))),
-                mtime=mtime,
-            )
+        yield ContentSrc(
+            package="",
+            srcpath=entry.path,
+            metadata=metadata,
+            contentpath=to_contentpath(entry.relpath),
+            mtime=entry.stat.st_mtime,
+        )
 
 
 def _iter_package_files(path: Path, ignores: Set[str]) -> Iterator[Path]:
@@ -134,6 +125,65 @@ def walk_package(package: str, path: str, ignores: Set[str]) -> Iterator[Content
         )
 
 
+@functools.lru_cache(maxsize=None)
+def _get_distributions() -> Mapping[str, List[str]]:
+    return importlib.metadata.packages_distributions()
+
+
+def get_package_fingerprint(package: str) -> Optional[str]:
+    """Version and location of the installed package.
+
+    Returns None if the package is not installed by pip, or installed in
+    editable mode, since files in the package may be updated.
+    """
+
+    packagepath = importlib_resources.files(package)
+    if not isinstance(packagepath, Path):
+        return None
+
+    top = package.split(".")[0]
+    for distname in _get_distributions().get(top, []):
+        try:
+            dist = importlib.metadata.distribution(distname)
+        except importlib.metadata.PackageNotFoundError:
+            continue
+
+        location = Path(str(dist.locate_file(""))).resolve()
+        if not packagepath.resolve().is_relative_to(location):
+            continue
+
+        direct_url = dist.read_text("direct_url.json")
+        if direct_url:
+            try:
+                if json.loads(direct_url).get("dir_info", {}).get("editable"):
+                    return None
+            except ValueError:
+                return None
+
+        return f"{dist.metadata['Name']}:{dist.version}:{packagepath.resolve()}"
+    return None
+
+
+def walk_cached_package(
+    cache: filecache.FileCache, package: str, path: str, ignores: Set[str]
+) -> Iterator[ContentSrc]:
+    """walk_package() with the file cache."""
+
+    fingerprint = get_package_fingerprint(package)
+    if fingerprint is None:
+        yield from walk_package(package, path, ignores)
+        return
+
+    fingerprint = f"{fingerprint}:{sorted(ignores)}"
+    key = f"{package}_::::_{path}"
+    srcs = cache.get_package(key, package, fingerprint)
+    if srcs is None:
+        srcs = list(walk_package(package, path, ignores))
+        cache.put_package(key, package, fingerprint, srcs)
+
+    yield from srcs
+
+
 def yamlloader(site: site.Site, src: ContentSrc) -> Sequence[Tuple[ContentSrc, None]]:
     text = src.read_bytes()
     metadata = yaml.load(text, Loader=yaml.FullLoader) or {}
@@ -189,7 +239,12 @@ def txtloader(
     return text.load(src)
 
 
-FILELOADERS = {
+FileLoader = Callable[
+    ["site.Site", ContentSrc],
+    Sequence[Tuple[ContentSrc, Optional[Union[str, bytes]]]],
+]
+
+FILELOADERS: Dict[str, FileLoader] = {
     ".rst": rstloader,
     ".rest": rstloader,
     ".md": mdloader,
@@ -211,7 +266,7 @@ class ContentFiles:
         self._contentfiles = {}
         self.mtime = time.time()
 
-    def add(self, contentsrc: ContentSrc, body: Optional[bytes]) -> None:
+    def add(self, contentsrc: ContentSrc, body: Optional[Body]) -> None:
         if contentsrc.contentpath not in self._contentfiles:
             content = contents.build_content(contentsrc, body)
             self._contentfiles[contentsrc.contentpath] = content
@@ -312,10 +367,20 @@ class ContentFiles:
                     return True
             return False
 
-        contents = [c for c in self._contentfiles.values() if adj_and(c, filters_copy)]
+        # Filtered metadata of every content is read. Record the keys
+        # instead of recording each content.
+        for key in filters_copy:
+            tracking.read_metadata(tracking.ANY_CONTENT, key)
+        for key in excludes or ():
+            tracking.read_metadata(tracking.ANY_CONTENT, key)
 
-        if excludes:
-            contents = [c for c in contents if not adj_or(c, excludes)]
+        with tracking.paused():
+            contents = [
+                c for c in self._contentfiles.values() if adj_and(c, filters_copy)
+            ]
+
+            if excludes:
+                contents = [c for c in contents if not adj_or(c, excludes)]
 
         if subdirs is not None:
             dirs = subdirs
@@ -338,7 +403,13 @@ class ContentFiles:
             recs.append((updated, title, c))
 
         recs.sort(reverse=True, key=lambda r: (r[0], r[1]))
-        return [rec[2] for rec in recs]
+        ret = [rec[2] for rec in recs]
+
+        tracking.read_query(
+            tracking.Query(filters, excludes, subdirs, recurse),
+            tuple(c.src.contentpath for c in ret),
+        )
+        return ret
 
     def group_items(
         self,
@@ -371,61 +442,175 @@ class ContentFiles:
         return sorted(d.items())
 
 
-CACHE_FILE = "_file_cache.db"
-CACHE_VER = b"1.0.0"
-CACHE_VER_KEY = "::<<miyadaiku_cache_ver>>::"
+def _load_filecache(site: site.Site) -> filecache.FileCache:
+    return filecache.FileCache(site.root / filecache.CACHE_FILE, clear=site.rebuild)
 
 
-def _load_filecache(site: site.Site) -> shelve.DbfilenameShelf:
-    filename = str(site.root / CACHE_FILE)
-    if site.rebuild:
-        file_cache = shelve.open(filename, "n")
-        file_cache[CACHE_VER_KEY] = CACHE_VER
-    else:
-        file_cache = shelve.open(filename, "c")
+def _get_cached(
+    site: site.Site, src: ContentSrc, cache: filecache.FileCache
+) -> Tuple[str, StatKey, Optional[str], Optional[Loaded]]:
+    """Look up the file cache for the source.
 
-        if file_cache.get(CACHE_VER_KEY, b"") != CACHE_VER:
-            file_cache.close()
+    Returns the cache key, stat and digest of the source and the cached
+    result, or None if the source should be loaded again.
+    """
 
-            file_cache = shelve.open(filename, "n")
-            file_cache[CACHE_VER_KEY] = CACHE_VER
+    key = f"{src.package}_::::_{src.srcpath}"
+    if src.package in cache.fixed_packages:
+        entry = cache.get(key)
+        if entry:
+            return key, entry.stat, entry.digest, entry.loaded
+
+    stat = None
+    if not src.package and src.srcpath:
+        stat = site.filetrees.get_stat(src.srcpath)
+    if stat is None:
+        stat = src.stat()
+    curstat = get_statkey(stat)
+
+    entry = cache.get(key)
+    if entry:
+        if entry.stat == curstat:
+            return key, curstat, entry.digest, entry.loaded
+
+    # stat of the file may be changed by checkout, copy, etc. without
+    # updating the contents.
+    curdigest = src.digest() if site.use_hash else None
+    if entry and curdigest:
+        if curdigest == entry.digest:
+            cache.put(key, CacheEntry(curstat, curdigest, entry.loaded))
+            return key, curstat, curdigest, entry.loaded
+
+    return key, curstat, curdigest, None
+
+
+def get_loader(src: ContentSrc, bin: bool) -> FileLoader:
+    if bin:
+        return binloader
+
+    assert src.srcpath
+    ext = os.path.splitext(src.srcpath)[1]
+    return FILELOADERS.get(ext, binloader)
+
+
+def _to_loaded(
+    items: Sequence[Tuple[ContentSrc, Optional[Union[str, bytes]]]]
+) -> Loaded:
+    ret: Loaded = []
+    for contentsrc, body in items:
+        assert contentsrc.metadata["loader"]
 
-    return file_cache
+        if isinstance(body, bytes):
+            ret.append((contentsrc, body))
+        if isinstance(body, str):
+            ret.append((contentsrc, body.encode("utf-8")))
+        else:
+            ret.append((contentsrc, None))
+    return ret
 
 
 def loadfile(
-    site: site.Site, src: ContentSrc, bin: bool, filecache: shelve.DbfilenameShelf
-) -> List[Tuple[ContentSrc, Optional[bytes]]]:
+    site: site.Site, src: ContentSrc, bin: bool, cache: filecache.FileCache
+) -> Loaded:
 
-    curstat = src.stat()
+    key, curstat, curdigest, bodies = _get_cached(site, src, cache)
+    if bodies is not None:
+        return bodies
 
-    key = f"{src.package}_::::_{src.srcpath}"
+    return parsefile(site, src, bin, cache, key, curstat, curdigest)
 
-    stat, bodies = filecache.get(key, (None, None))
-    if stat:
-        if stat == curstat:
-            return cast(List[Tuple[ContentSrc, Optional[bytes]]], bodies)
 
-    if not bin:
-        assert src.srcpath
-        ext = os.path.splitext(src.srcpath)[1]
-        loader = FILELOADERS.get(ext, binloader)
-    else:
-        loader = binloader
+def parsefile(
+    site: site.Site,
+    src: ContentSrc,
+    bin: bool,
+    cache: filecache.FileCache,
+    key: str,
+    curstat: StatKey,
+    curdigest: Optional[str],
+) -> Loaded:
+    """Parse the source not found in the cache, and save the result."""
+
+    loader = get_loader(src, bin)
+    with profiling.phase(f"loadfile:{loader.__module__}.{loader.__name__}"):
+        ret = _to_loaded(loader(site, src))
+
+    return cache.put(key, CacheEntry(curstat, curdigest, ret))
+
+
+# Loaders run in loader processes, and the modules of their parsers.
+# Parsers are called without site.
+PARALLEL_LOADERS: Dict[FileLoader, str] = {
+    rstloader: "rst",
+    mdloader: "md",
+    ipynbloader: "ipynb",
+    txtloader: "text",
+}
 
-    ret: List[Tuple[ContentSrc, Optional[bytes]]] = []
-    for contentsrc, body in loader(site, src):
-        assert contentsrc.metadata["loader"]
+# Minimum number of files to start loader processes.
+PARALLEL_LOAD_MIN = 200
 
-        if isinstance(body, bytes):
-            ret.append((contentsrc, body))
-        if isinstance(body, str):
-            ret.append((contentsrc, body.encode("utf-8")))
-        else:
-            ret.append((contentsrc, None))
 
-    filecache[key] = curstat, ret
-    return ret
+def _init_load_worker(
+    root: Path, themes: List[str], ipynb_options: Any, ipynb_root: Optional[Path]
+) -> None:
+    mp_log.init_mp_logging(None)
+
+    # Hooks and themes may customize parsers, e.g. register directives
+    # of docutils.
+    extend.load_hook(root)
+    for theme in themes:
+        importlib.import_module(theme)
+
+    from . import ipynb
+
+    ipynb.options = ipynb_options
+    ipynb.root = ipynb_root
+    ipynb.exporters = {}
+
+
+def _load_worker(args: Tuple[str, ContentSrc]) -> Tuple[Loaded, List[Any]]:
+    modname, src = args
+    parser = importlib.import_module(f"miyadaiku.{modname}")
+    ret = _to_loaded(parser.load(src))
+    return ret, mp_log.pop_mp_logging()
+
+
+class LoadPool:
+    """Loader processes to parse files in parallel."""
+
+    def __init__(self, site: site.Site) -> None:
+        from . import ipynb
+        from .builder import get_cpu_count
+
+        self.num_workers = site.jobs or get_cpu_count()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._initargs = (site.root, site.themes, ipynb.options, ipynb.root)
+
+    def close(self) -> None:
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def map(self, args: List[Tuple[str, ContentSrc]]) -> Iterator[Loaded]:
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_load_worker,
+                initargs=self._initargs,
+            )
+
+        chunksize = max(1, len(args) // (self.num_workers * 4))
+        for ret, logs in self._executor.map(_load_worker, args, chunksize=chunksize):
+            mp_log.dispatch_log(logger, logs)
+            yield ret
+
+
+def can_load_parallel(site: site.Site) -> bool:
+    if site.debug or (site.executor != "process"):
+        return False
+    return site.jobs != 1
 
 
 def loadfiles(
@@ -436,31 +621,41 @@ def loadfiles(
     ignores: Set[str],
     themes: List[str],
 ) -> None:
-    filecache = _load_filecache(site)
+    cache = _load_filecache(site)
 
     from . import ipynb
 
     ipynb.init(site)
 
+    pool = LoadPool(site) if can_load_parallel(site) else None
+
     def load(walk: Iterator[ContentSrc], bin: bool = False) -> None:
         f: Optional[ContentSrc]
         srcs: List[ContentSrc] = []
 
-        for f in walk:
-            if not f:
-                continue
+        with profiling.phase("walk"):
+            for f in walk:
+                if not f:
+                    continue
 
-            f = extend.run_pre_load(site, f, bin)
-            if not f:
-                continue
-            srcs.append(f)
+                f = extend.run_pre_load(site, f, bin)
+                if not f:
+                    continue
+                srcs.append(f)
 
-        def loaded(items: List[Tuple[ContentSrc, Optional[bytes]]]) -> None:
+        def loaded(items: Loaded) -> None:
             for src, body in items:
                 if not src:
                     return
 
-                loaded_src, body = extend.run_post_load(site, src, bin, body)
+                loaded_src: Optional[ContentSrc] = src
+                if extend.hooks_post_load:
+                    data = cache.read(body)
+                    loaded_src, newdata = extend.run_post_load(site, src, bin, data)
+
+                    # keep the reference to the cache unless updated
+                    if newdata is not data:
+                        body = newdata
 
                 if not loaded_src:
                     return
@@ -472,17 +667,67 @@ def loadfiles(
                 else:
                     files.add(loaded_src, body)
 
-        for src in srcs:
-            ret = loadfile(site, src, bin, filecache)
-            loaded(ret)
+        results: List[Optional[Loaded]] = [None] * len(srcs)
+
+        # Cache lookups of files not in the cache
+        lookups: Dict[int, Tuple[str, StatKey, Optional[str]]] = {}
+        if pool:
+            # Parse files not in the cache by loader processes. Files
+            # are added in the order of the walk regardless of the order
+            # they are parsed.
+            misses = []
+            with profiling.phase("loadfile"):
+                for i, src in enumerate(srcs):
+                    modname = PARALLEL_LOADERS.get(get_loader(src, bin))
+                    if modname is None:
+                        continue
+                    key, curstat, curdigest, bodies = _get_cached(site, src, cache)
+                    results[i] = bodies
+                    if bodies is None:
+                        lookups[i] = (key, curstat, curdigest)
+                        misses.append((i, key, curstat, curdigest, modname, src))
+
+                if len(misses) >= PARALLEL_LOAD_MIN:
+                    args = [(modname, src) for *_, modname, src in misses]
+                    for miss, ret in zip(misses, pool.map(args)):
+                        i, key, curstat, curdigest, *_ = miss
+                        entry = CacheEntry(curstat, curdigest, ret)
+                        results[i] = cache.put(key, entry)
+
+        for i, (src, result) in enumerate(zip(srcs, results)):
+            if result is None:
+                with profiling.phase("loadfile"):
+                    if i in lookups:
+                        key, curstat, curdigest = lookups[i]
+                        result = parsefile(
+                            site, src, bin, cache, key, curstat, curdigest
+                        )
+                    else:
+                        result = loadfile(site, src, bin, cache)
+            loaded(result)
+
+    try:
+        for dirname, bin in (
+            (miyadaiku.CONTENTS_DIR, False),
+            (miyadaiku.FILES_DIR, True),
+        ):
+            path = root / dirname
+            with profiling.phase("walk"):
+                tree = site.filetrees.get(path, ignores)
+            load(walk_directory(path, ignores, tree), bin)
+
+        for theme in themes:
+            for dirname, bin in (
+                (miyadaiku.CONTENTS_DIR, False),
+                (miyadaiku.FILES_DIR, True),
+            ):
+                load(walk_cached_package(cache, theme, dirname, ignores), bin)
+    finally:
+        if pool:
+            pool.close()
 
-    load(walk_directory(root / miyadaiku.CONTENTS_DIR, ignores))
-    load(walk_directory(root / miyadaiku.FILES_DIR, ignores), bin=True)
-
-    for theme in themes:
-        load(walk_package(theme, miyadaiku.CONTENTS_DIR, ignores))
-        load(walk_package(theme, miyadaiku.FILES_DIR, ignores), bin=True)
+    # Files not loaded are removed from the site. Bodies of the contents
+    # are readable after the cache is closed.
+    cache.close(evict=True)
 
     extend.run_load_finished(site)
-
-    filecache.close()
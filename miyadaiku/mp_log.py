@@ -10,6 +10,9 @@ from typing import Any, Dict, List
 _queue: Any = None
 _pendings: List[Dict[str, Any]] = []
 
+# Maximum number of log records held before sent to the parent process.
+MAX_PENDINGS = 100
+
 
 class MpLogFormatter(logging.Formatter):
     def __init__(
@@ -44,6 +47,8 @@ class MpLogHandler(logging.Handler):
         try:
             msg = self.dictformatter.format_dict(record)
             _pendings.append(msg)
+            if len(_pendings) >= MAX_PENDINGS:
+                flush_mp_logging()
 
         except RecursionError:
             raise
@@ -79,11 +84,31 @@ def init_mp_logging(queue: Any) -> None:
 
 def flush_mp_logging() -> None:
     global _pendings
-    if _pendings:
+    if _pendings and (_queue is not None):
         _queue.put(("LOGS", _pendings))
         _pendings = []
 
 
+def pop_mp_logging() -> List[Dict[str, Any]]:
+    """Take messages not sent to the queue yet.
+
+    Processes started without queue return messages to the parent by
+    themselves.
+    """
+
+    global _pendings
+    ret, _pendings = _pendings, []
+    return ret
+
+
+def dispatch_log(logger: logging.Logger, msgs: List[Dict[str, Any]]) -> None:
+    """Log messages sent from child processes."""
+
+    for msg in msgs:
+        lv = msg["levelno"]
+        logger.log(lv, msg["msg"], extra=dict(msgdict=msg))
+
+
 class Color(enum.Enum):
     RED = "\033[91m"
     GREEN = "\033[92m"
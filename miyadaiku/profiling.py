@@ -0,0 +1,218 @@
+"""Build profiler for ``muneage --profile``.
+
+Time of a phase is exclusive: while a nested phase is running, elapsed
+time is charged only to the nested phase. Time not spent in any phase
+is reported as ``other``, so that the phases of a process add up to its
+wall-clock time.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Tuple
+
+# Number of entries listed in the summary log.
+SUMMARY_COUNT = 10
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.phases: DefaultDict[str, float] = defaultdict(float)
+        self.counts: DefaultDict[str, int] = defaultdict(int)
+        self.contents: DefaultDict[str, float] = defaultdict(float)
+        self.templates: DefaultDict[str, float] = defaultdict(float)
+        self.template_counts: DefaultDict[str, int] = defaultdict(int)
+        self.workers: List[Dict[str, Any]] = []
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[List[Any]]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def enter(self, name: str) -> None:
+        now = time.perf_counter()
+        stack = self._stack()
+        with self._lock:
+            if stack:
+                top = stack[-1]
+                self.phases[top[0]] += now - top[1]
+            self.counts[name] += 1
+        stack.append([name, now])
+
+    def leave(self) -> None:
+        now = time.perf_counter()
+        stack = self._stack()
+        name, since = stack.pop()
+        with self._lock:
+            self.phases[name] += now - since
+        if stack:
+            stack[-1][1] = now
+
+    def add_content(self, contentpath: str, secs: float) -> None:
+        with self._lock:
+            self.contents[contentpath] += secs
+
+    def add_template(self, templatename: str, secs: float) -> None:
+        with self._lock:
+            self.templates[templatename] += secs
+            self.template_counts[templatename] += 1
+
+    def wall(self) -> float:
+        return time.perf_counter() - self.started
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            wall = self.wall()
+            phases = dict(self.phases)
+            phases["other"] = max(0.0, wall - sum(phases.values()))
+            return {
+                "wall": wall,
+                "phases": phases,
+                "counts": dict(self.counts),
+                "contents": dict(self.contents),
+                "templates": dict(self.templates),
+                "template_counts": dict(self.template_counts),
+            }
+
+    def add_worker(self, data: Dict[str, Any]) -> None:
+        with self._lock:
+            self.workers.append(data)
+
+
+_profiler: Optional[Profiler] = None
+
+
+def enable() -> Profiler:
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable() -> None:
+    global _profiler
+    _profiler = None
+
+
+def get_profiler() -> Optional[Profiler]:
+    return _profiler
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+
+    profiler.enter(name)
+    try:
+        yield
+    finally:
+        profiler.leave()
+
+
+@contextmanager
+def template(templatename: str) -> Iterator[None]:
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    profiler.enter("jinja")
+    try:
+        yield
+    finally:
+        profiler.leave()
+        profiler.add_template(templatename, time.perf_counter() - started)
+
+
+def add_content(contentpath: str, secs: float) -> None:
+    profiler = _profiler
+    if profiler is not None:
+        profiler.add_content(contentpath, secs)
+
+
+def _sum_dicts(dicts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    ret: DefaultDict[str, Any] = defaultdict(float)
+    for d in dicts:
+        for k, v in d.items():
+            ret[k] += v
+    return dict(ret)
+
+
+def _sorted_items(d: Dict[str, float]) -> List[Tuple[str, float]]:
+    return sorted(d.items(), key=lambda item: item[1], reverse=True)
+
+
+def build_report(profiler: Profiler) -> Dict[str, Any]:
+    """Merge the profile of this process and of the builder processes."""
+
+    main = profiler.to_dict()
+    workers = profiler.workers
+
+    contents = _sum_dicts([main["contents"]] + [w["contents"] for w in workers])
+    templates = _sum_dicts([main["templates"]] + [w["templates"] for w in workers])
+    template_counts = _sum_dicts(
+        [main["template_counts"]] + [w["template_counts"] for w in workers]
+    )
+
+    return {
+        "wall": main["wall"],
+        "phases": dict(_sorted_items(main["phases"])),
+        "counts": main["counts"],
+        "workers": {
+            "num": len(workers),
+            "wall": sum(w["wall"] for w in workers),
+            "phases": dict(_sorted_items(_sum_dicts([w["phases"] for w in workers]))),
+            "counts": _sum_dicts([w["counts"] for w in workers]),
+        },
+        "contents": [
+            {"contentpath": contentpath, "secs": secs}
+            for contentpath, secs in _sorted_items(contents)
+        ],
+        "templates": [
+            {"template": name, "secs": secs, "count": int(template_counts[name])}
+            for name, secs in _sorted_items(templates)
+        ],
+    }
+
+
+def format_summary(report: Dict[str, Any]) -> str:
+    lines = [f"Build profile: {report['wall']:.2f} secs"]
+    for name, secs in report["phases"].items():
+        lines.append(f"  {name}: {secs:.2f} secs")
+
+    workers = report["workers"]
+    if workers["num"]:
+        lines.append(
+            f"Builder processes: {workers['num']}, {workers['wall']:.2f} secs total"
+        )
+        for name, secs in workers["phases"].items():
+            lines.append(f"  {name}: {secs:.2f} secs")
+
+    lines.append("Slowest contents:")
+    for d in report["contents"][:SUMMARY_COUNT]:
+        lines.append(f"  {d['contentpath']}: {d['secs']:.3f} secs")
+
+    lines.append("Slowest templates:")
+    for d in report["templates"][:SUMMARY_COUNT]:
+        lines.append(f"  {d['template']}: {d['secs']:.3f} secs ({d['count']} times)")
+
+    return "\n".join(lines)
+
+
+def write_report(profiler: Profiler, filename: Path) -> Dict[str, Any]:
+    report = build_report(profiler)
+    filename.write_text(json.dumps(report, indent=2))
+    return report
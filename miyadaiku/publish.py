@@ -0,0 +1,156 @@
+"""Publish binary files to the output directory.
+
+Outputs which have the same size and mtime as the source, or the same
+hash if requested, are left untouched. Other files are cloned or copied
+by the kernel without reading them into this process. In ``link`` mode,
+files are hard linked to the source if possible.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Any, Optional
+
+from miyadaiku import get_digest
+
+logger = logging.getLogger(__name__)
+
+# binary_publish config
+PUBLISH_MODES = ("copy", "link")
+
+# ioctl request to share extents of a file on btrfs, xfs, etc.
+FICLONE = 0x40049409
+
+# Bytes copied by a copy_file_range() call.
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def get_mode(mode: Any, filename: str) -> str:
+    """Validate binary_publish config of the file."""
+
+    if mode not in PUBLISH_MODES:
+        logger.error(
+            f"Error: {filename}: invalid binary_publish value {mode!r}. "
+            f"Expected one of {', '.join(PUBLISH_MODES)}."
+        )
+        return "copy"
+    return str(mode)
+
+
+def _file_digest(path: Any) -> str:
+    with open(path, "rb") as f:
+        return get_digest(f.read())
+
+
+def is_unchanged(src: str, st: os.stat_result, dest: Path, use_hash: bool) -> bool:
+    try:
+        destst = dest.stat()
+    except FileNotFoundError:
+        return False
+
+    if os.path.samestat(st, destst):
+        return True
+    if st.st_size != destst.st_size:
+        return False
+    if st.st_mtime_ns == destst.st_mtime_ns:
+        return True
+
+    if use_hash and (_file_digest(src) == _file_digest(dest)):
+        # skip hashing in the next build
+        os.utime(dest, ns=(destst.st_atime_ns, st.st_mtime_ns))
+        return True
+    return False
+
+
+def _clone(src: Any, dest: Any) -> bool:
+    if sys.platform != "linux":
+        return False
+
+    import fcntl
+
+    try:
+        fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def _copy_range(src: Any, dest: Any, size: int) -> bool:
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if not copy_file_range:
+        return False
+
+    copied = 0
+    try:
+        while copied < size:
+            n = copy_file_range(src.fileno(), dest.fileno(), COPY_CHUNK_SIZE)
+            if not n:
+                break
+            copied += n
+    except OSError:
+        if copied:
+            raise
+        return False
+    return True
+
+
+def publish_file(
+    src: str, dest: Path, mode: str = "copy", use_hash: bool = False
+) -> str:
+    """Publish the source file to dest, and return the method used."""
+
+    st = os.stat(src)
+    if is_unchanged(src, st, dest, use_hash):
+        return "unchanged"
+
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    if mode == "link":
+        try:
+            os.link(src, dest)
+            return "link"
+        except OSError:
+            pass
+
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        if _clone(fsrc, fdest):
+            method = "clone"
+        elif _copy_range(fsrc, fdest, st.st_size):
+            method = "copy_file_range"
+        else:
+            method = None
+
+    if not method:
+        # shutil uses sendfile() if available
+        shutil.copyfile(src, dest)
+        method = "copy"
+
+    # the same mtime as the source marks the file unchanged
+    os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return method
+
+
+def publish_bytes(body: bytes, dest: Path) -> str:
+    try:
+        if (dest.stat().st_size == len(body)) and (dest.read_bytes() == body):
+            return "unchanged"
+    except FileNotFoundError:
+        pass
+
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    dest.write_bytes(body)
+    return "write"
+
+
+def get_local_path(package_path: Any) -> Optional[str]:
+    """Filename of a file in package, if it is a file in a directory."""
+
+    if isinstance(package_path, Path) and package_path.is_file():
+        return str(package_path)
+    return None
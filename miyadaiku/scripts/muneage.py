@@ -12,10 +12,10 @@ import threading
 import time
 from pathlib import Path
 
-import miyadaiku.site
-from miyadaiku import OUTPUTS_DIR
+import miyadaiku
+from miyadaiku import EXECUTORS, OUTPUTS_DIR
 
-from .. import mp_log
+from .. import mp_log, snapshot
 from . import observer
 
 logger = logging.getLogger(__name__)
@@ -34,13 +34,38 @@ def exec_server(dir, bind, port):
     http.server.test(MiyadaikuHTTPHandler, bind=bind, port=port)
 
 
-def build(path, outputdir, props, args):
+def build(path, outputdir, props, args, pool=None):
+    # Reports are written only by a build
+    if not (args.rebuild or args.profile or args.explain):
+        if snapshot.is_uptodate(path, outputdir, props):
+            print(f"{path.resolve()} is up to date.")
+            return 0
+
+    # Import loaders only if build is required.
+    import miyadaiku.site
+
     print(f"Building {path.resolve()} ...")
     start = datetime.datetime.now()
-
-    site = miyadaiku.site.Site(rebuild=args.rebuild, debug=args.debug)
+    since = time.time_ns()
+
+    site = miyadaiku.site.Site(
+        rebuild=args.rebuild,
+        debug=args.debug,
+        fork=args.fork,
+        schedule=args.schedule,
+        profile=Path(args.profile) if args.profile else None,
+        jobs=args.jobs,
+        executor=args.executor,
+        use_hash=args.hash,
+        explain=Path(args.explain) if args.explain else None,
+    )
     site.load(path, props, outputdir)
-    ok, err, *_ = site.build()
+    ok, err, *_ = site.build(pool)
+
+    if err:
+        snapshot.remove(path)
+    else:
+        snapshot.save(path, outputdir, props, site.themes, since)
 
     finished = datetime.datetime.now()
     secs = (finished - start).total_seconds()
@@ -79,6 +104,68 @@ parser.add_argument(
 
 parser.add_argument("--rebuild", "-r", action="store_true", help="Rebuild contents.")
 
+parser.add_argument(
+    "--fork",
+    action="store_true",
+    default=False,
+    help="Fork builder processes to share loaded contents (Linux only).",
+)
+
+parser.add_argument(
+    "--schedule",
+    choices=["static", "dynamic"],
+    default="static",
+    help="static: split builders into batches before build. "
+    "dynamic: builder processes pull builders from shared queue.",
+)
+
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=None,
+    metavar="N",
+    help="Number of builder processes or threads. "
+    "Defaults to the number of CPUs available.",
+)
+
+parser.add_argument(
+    "--executor",
+    choices=EXECUTORS,
+    default="process",
+    help="process: build in builder processes. "
+    "thread: build in threads sharing a Jinja environment. "
+    "serial: build in the main process.",
+)
+
+parser.add_argument(
+    "--hash",
+    action="store_true",
+    default=False,
+    help="Detect updated files by hash of their contents instead of mtime.",
+)
+
+parser.add_argument(
+    "--profile",
+    default="",
+    metavar="REPORT",
+    help="Write time spent in each build phase to REPORT in JSON format.",
+)
+
+parser.add_argument(
+    "--explain",
+    default="",
+    metavar="REPORT",
+    help="Write the reason why each content is rebuilt to REPORT in JSON format.",
+)
+
+parser.add_argument(
+    "--compact-cache",
+    action="store_true",
+    default=False,
+    help="Show version and size of the file cache and compact it, without build.",
+)
+
 parser.add_argument(
     "--watch", "-w", action="store_true", help="Watch for contents update."
 )
@@ -109,6 +196,16 @@ def _main() -> None:
 
     mp_log.init_logging()
 
+    if args.compact_cache:
+        from miyadaiku import filecache
+
+        before, after = filecache.compact(d)
+        print(
+            f"File cache version {after.ver}: {after.files} files, "
+            f"{before.size} bytes -> {after.size} bytes"
+        )
+        return 0
+
     if args.output:
         outputs = Path(args.output)
     else:
@@ -140,13 +237,24 @@ def _main() -> None:
             obsrv = observer.create_observer(d, ev)
             obsrv.start()
 
-            ev.set()  # run once at least
-            while True:
-                ev.wait()
-                time.sleep(0.1)
-                ev.clear()
+            # keep builder processes alive while watching
+            pool = None
+            if (not args.debug) and (args.executor == "process"):
+                from .. import builder
 
-                build(d, outputs, props, args)
+                pool = builder.BuildPool(args.jobs)
+
+            ev.set()  # run once at least
+            try:
+                while True:
+                    ev.wait()
+                    time.sleep(0.1)
+                    ev.clear()
+
+                    build(d, outputs, props, args, pool)
+            finally:
+                if pool:
+                    pool.close()
 
         if args.server:
             server.join()
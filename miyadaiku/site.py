@@ -15,8 +15,17 @@ from jinja2 import Environment
 
 import miyadaiku
 
-from . import BuildResult, ContentPath, DependsDict, extend, loader
-from .builder import Builder, build
+from . import (
+    BuildResult,
+    ContentPath,
+    DependsDict,
+    extend,
+    filetree,
+    loader,
+    profiling,
+    tracking,
+)
+from .builder import Builder, BuildPool, build
 from .config import Config
 from .jinjaenv import create_env
 
@@ -52,10 +61,40 @@ class Site:
 
     jinja_global_vars: Dict[str, Any]
     jinja_templates: Dict[str, Any]
+    load_reads: tracking.Reads
+    filetrees: filetree.FileTrees
+
+    def __init__(
+        self,
+        rebuild: bool = False,
+        debug: bool = False,
+        fork: bool = False,
+        schedule: str = "static",
+        profile: Optional[Path] = None,
+        jobs: Optional[int] = None,
+        executor: str = "process",
+        use_hash: bool = False,
+        explain: Optional[Path] = None,
+    ) -> None:
+        if executor not in miyadaiku.EXECUTORS:
+            raise ValueError(f"Invalid executor: {executor}")
 
-    def __init__(self, rebuild: bool = False, debug: bool = False) -> None:
         self.rebuild = rebuild
         self.debug = debug
+        self.fork = fork
+        self.schedule = schedule
+        self.profile = profile
+        self.jobs = jobs
+        self.executor = executor
+        self.use_hash = use_hash
+        self.explain = explain
+
+        # Stored fragments are not used if modules, templates or configs
+        # of the site are updated since the last build.
+        self.reuse_fragments = True
+
+        # Identifies fragments rendered by the current build.
+        self.build_id = ""
 
     def _load_config(self, props: Dict[str, Any]) -> None:
         cfgfile = self.root / miyadaiku.CONFIG_FILE
@@ -143,6 +182,9 @@ class Site:
     def load(
         self, root: Path, props: Dict[str, Any], outputdir: Optional[Path] = None
     ) -> None:
+        if self.profile:
+            profiling.enable()
+
         self.root = root.resolve()
         if outputdir:
             self.outputdir = outputdir
@@ -151,32 +193,46 @@ class Site:
 
         self.jinja_global_vars = {}
         self.jinja_templates = {}
+        self.filetrees = filetree.FileTrees()
 
-        self.load_hooks()
-        self._load_config(props)
-        self.files = loader.ContentFiles()
+        # Configs read while loading affect every content.
+        self.load_reads = tracking.Reads()
+        with tracking.track(self.load_reads):
+            with profiling.phase("initialize"):
+                self.load_hooks()
+                self._load_config(props)
+                self.files = loader.ContentFiles()
 
-        extend.run_initialized(self)
+                extend.run_initialized(self)
 
-        self._load_themes()
+                self._load_themes()
 
-        self._init_themes()
+                self._init_themes()
 
-        loader.loadfiles(
-            self,
-            self.files,
-            self.config,
-            self.root,
-            self.ignores | set(miyadaiku.IGNORE),
-            self.themes,
-        )
+            loader.loadfiles(
+                self,
+                self.files,
+                self.config,
+                self.root,
+                self.ignores | set(miyadaiku.IGNORE),
+                self.themes,
+            )
 
-        self._generate_metadata_files()
+            with profiling.phase("metadata_files"):
+                self._generate_metadata_files()
 
     def build_jinjaenv(self) -> Environment:
+        with profiling.phase("jinjaenv"):
+            jinjaenv = create_env(
+                self, self.themes, [self.root / miyadaiku.TEMPLATES_DIR]
+            )
+            self.update_jinjaenv(jinjaenv)
+        return jinjaenv
+
+    def update_jinjaenv(self, jinjaenv: Environment) -> None:
         import miyadaiku.extend
 
-        jinjaenv = create_env(self, self.themes, [self.root / miyadaiku.TEMPLATES_DIR])
+        jinjaenv.globals["site"] = self
 
         for name, value in miyadaiku.extend.jinja_globals.items():
             jinjaenv.globals[name] = value
@@ -188,7 +244,7 @@ class Site:
             template = jinjaenv.get_template(templatename)
             jinjaenv.globals[name] = template.module
 
-        return jinjaenv
-
-    def build(self) -> Tuple[int, int, DependsDict, BuildResult, Set[ContentPath]]:
-        return build(self)
+    def build(
+        self, pool: Optional[BuildPool] = None
+    ) -> Tuple[int, int, DependsDict, BuildResult, Set[ContentPath]]:
+        return build(self, pool)
@@ -0,0 +1,180 @@
+"""Snapshot of files of a site, to skip builds when nothing is updated.
+
+``muneage`` compares the snapshot taken after the last successful build
+with the current files before loading the site. This module is imported
+before the site is loaded, so it must not import loaders or builders.
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import miyadaiku
+from miyadaiku import (
+    CONFIG_FILE,
+    CONTENTS_DIR,
+    FILES_DIR,
+    MODULES_DIR,
+    NBCONVERT_TEMPLATES_DIR,
+    TEMPLATES_DIR,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "_snapshot.pickle"
+SNAPSHOT_VER = "1.0.0"
+
+SOURCE_FILES = (CONFIG_FILE, "hooks.py")
+SOURCE_DIRS = (
+    CONTENTS_DIR,
+    FILES_DIR,
+    TEMPLATES_DIR,
+    MODULES_DIR,
+    NBCONVERT_TEMPLATES_DIR,
+)
+
+# Directories written by python, not by users.
+SKIP_DIRS = {"__pycache__"}
+
+# (size, mtime in nanoseconds) of files
+Stats = Dict[str, Tuple[int, int]]
+
+MISSING = (-1, -1)
+
+
+def scan_files(files: Iterable[Path]) -> Stats:
+    ret: Stats = {}
+    for path in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            ret[str(path)] = MISSING
+        else:
+            ret[str(path)] = (st.st_size, st.st_mtime_ns)
+    return ret
+
+
+def scan_dirs(dirs: Iterable[Path]) -> Stats:
+    """Size and mtime of every file in the directories."""
+
+    ret: Stats = {}
+    stack = [str(d) for d in dirs]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+
+        # Empty directories are listed to detect added or removed ones.
+        ret[path] = MISSING
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name not in SKIP_DIRS:
+                    stack.append(entry.path)
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            ret[entry.path] = (st.st_size, st.st_mtime_ns)
+    return ret
+
+
+def get_theme_dirs(themes: Sequence[str]) -> List[Path]:
+    ret: List[Path] = []
+    for theme in themes:
+        spec = importlib.util.find_spec(theme)
+        if spec and spec.submodule_search_locations:
+            ret.extend(Path(p) for p in spec.submodule_search_locations)
+    return ret
+
+
+def get_args(outputdir: Path, props: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "ver": SNAPSHOT_VER,
+        "version": miyadaiku.__version__,
+        "outputdir": str(outputdir.resolve()),
+        "props": props,
+    }
+
+
+def is_uptodate(root: Path, outputdir: Path, props: Dict[str, Any]) -> bool:
+    """Test if no file was updated since the last build."""
+
+    root = root.resolve()
+    try:
+        with open(root / SNAPSHOT_FILE, "rb") as f:
+            snapshot = pickle.load(f)
+    except Exception:
+        return False
+
+    if snapshot.get("args") != get_args(outputdir, props):
+        return False
+
+    if scan_files(root / name for name in SOURCE_FILES) != snapshot["files"]:
+        return False
+
+    if scan_dirs(Path(d) for d in snapshot["dirs"]) != snapshot["stats"]:
+        return False
+
+    return True
+
+
+def save(
+    root: Path,
+    outputdir: Path,
+    props: Dict[str, Any],
+    themes: Sequence[str],
+    since: Optional[int] = None,
+) -> None:
+    """Save snapshot of the files after a successful build.
+
+    Snapshot is not saved if a source file was updated after `since`,
+    time of the build started in nanoseconds, since the update may not
+    be reflected to the outputs.
+    """
+
+    root = root.resolve()
+    filename = root / SNAPSHOT_FILE
+
+    files = scan_files(root / name for name in SOURCE_FILES)
+    sourcedirs = [root / name for name in SOURCE_DIRS]
+    sourcedirs.extend(get_theme_dirs(themes))
+    stats = scan_dirs(sourcedirs)
+
+    if since is not None:
+        mtimes = [mtime for size, mtime in files.values()]
+        mtimes.extend(mtime for size, mtime in stats.values())
+        if mtimes and (max(mtimes) >= since):
+            remove(root)
+            return
+
+    # Removed or updated outputs should be rebuilt.
+    dirs = sourcedirs + [outputdir.resolve()]
+    stats.update(scan_dirs([outputdir.resolve()]))
+
+    snapshot = {
+        "args": get_args(outputdir, props),
+        "files": files,
+        "dirs": [str(d) for d in dirs],
+        "stats": stats,
+    }
+
+    try:
+        with open(filename, "wb") as f:
+            pickle.dump(snapshot, f)
+    except OSError:
+        logger.exception("Failed to save %s", filename)
+
+
+def remove(root: Path) -> None:
+    try:
+        os.unlink(root.resolve() / SNAPSHOT_FILE)
+    except FileNotFoundError:
+        pass
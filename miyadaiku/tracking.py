@@ -0,0 +1,179 @@
+"""Record what a builder reads while building outputs.
+
+Reads are saved in the depends file, so that an incremental build can
+rebuild only the outputs which read the data updated since the last
+build.
+"""
+
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from miyadaiku import ContentPath, PathTuple
+
+# Key of metadata read from every content, e.g. filter of get_contents().
+ANY_CONTENT = None
+
+MetadataKey = Tuple[Optional[ContentPath], str]
+
+
+class Query(NamedTuple):
+    """Arguments of ContentFiles.get_contents()"""
+
+    filters: Optional[Dict[str, Any]]
+    excludes: Optional[Dict[str, Any]]
+    subdirs: Optional[Sequence[PathTuple]]
+    recurse: bool
+
+
+Members = Tuple[ContentPath, ...]
+
+
+class Reads:
+    def __init__(self) -> None:
+        self.metadata: Set[MetadataKey] = set()
+        self.queries: Dict[str, Tuple[Query, Members]] = {}
+        self.templates: Set[str] = set()
+        self.configs: Set[Tuple[PathTuple, str]] = set()
+
+    def update(self, other: Reads) -> None:
+        self.metadata.update(other.metadata)
+        self.queries.update(other.queries)
+        self.templates.update(other.templates)
+        self.configs.update(other.configs)
+
+    def read_metadata(self, updates: Dict[ContentPath, Set[str]]) -> bool:
+        """Test if any of the updated metadata was read."""
+
+        if not updates:
+            return False
+
+        names: Set[str] = set().union(*updates.values())
+        for contentpath, name in self.metadata:
+            if name not in names:
+                continue
+            if contentpath is ANY_CONTENT:
+                return True
+            if name in updates.get(contentpath, ()):
+                return True
+        return False
+
+    def read_config(
+        self, names: Set[str], overridden: Callable[[PathTuple, str], bool]
+    ) -> bool:
+        """Test if any of the updated site config was read."""
+
+        for dirname, name in self.configs:
+            if (name in names) and not overridden(dirname, name):
+                return True
+
+        # metadata of every content may default to the config
+        return any((ANY_CONTENT, name) in self.metadata for name in names)
+
+    def queried(self, contentpaths: Set[ContentPath]) -> bool:
+        """Test if any of the contents was in results of queries."""
+
+        for query, members in self.queries.values():
+            if not contentpaths.isdisjoint(members):
+                return True
+        return False
+
+    def query_updated(self, run: Callable[[Query], Members]) -> bool:
+        """Test if result of any query differs from the recorded one."""
+
+        for query, members in self.queries.values():
+            if run(query) != members:
+                return True
+        return False
+
+
+_local = threading.local()
+
+
+def _get_current() -> Optional[Reads]:
+    return getattr(_local, "reads", None)
+
+
+@contextmanager
+def track(reads: Optional[Reads] = None) -> Iterator[Reads]:
+    """Record reads in the current thread."""
+
+    if reads is None:
+        reads = Reads()
+
+    prev = _get_current()
+    _local.reads = reads
+    try:
+        yield reads
+    finally:
+        _local.reads = prev
+
+
+@contextmanager
+def recording() -> Iterator[Reads]:
+    """Record reads into a new Reads, in addition to the current one.
+
+    Used to save reads with cached results, which are replayed when the
+    results are reused.
+    """
+
+    prev = _get_current()
+    with track() as reads:
+        yield reads
+
+    if prev is not None:
+        prev.update(reads)
+
+
+def replay(reads: Optional[Reads]) -> None:
+    """Add reads recorded while building a cached result."""
+
+    current = _get_current()
+    if (current is not None) and (reads is not None):
+        current.update(reads)
+
+
+@contextmanager
+def paused() -> Iterator[None]:
+    prev = _get_current()
+    _local.reads = None
+    try:
+        yield
+    finally:
+        _local.reads = prev
+
+
+def read_metadata(contentpath: Optional[ContentPath], name: str) -> None:
+    reads = _get_current()
+    if reads is not None:
+        reads.metadata.add((contentpath, name))
+
+
+def read_query(query: Query, members: Members) -> None:
+    reads = _get_current()
+    if reads is not None:
+        reads.queries[repr(query)] = (query, members)
+
+
+def read_template(name: str) -> None:
+    reads = _get_current()
+    if reads is not None:
+        reads.templates.add(name)
+
+
+def read_config(dirname: PathTuple, name: str) -> None:
+    reads = _get_current()
+    if reads is not None:
+        reads.configs.add((dirname, name))
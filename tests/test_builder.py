@@ -1,8 +1,14 @@
+import asyncio
+import json
+import queue
 from typing import Any, List, cast
 from unittest.mock import patch
 
+import pytest
+from bs4 import BeautifulSoup
 from conftest import SiteRoot
 
+import miyadaiku.site
 from miyadaiku import builder
 
 
@@ -117,7 +123,7 @@ groupby: tags
     assert context.contentpath == (("htmldir",), "index.yml")
 
 
-@patch("multiprocessing.cpu_count", return_value=3)
+@patch("miyadaiku.builder.get_cpu_count", return_value=3)
 def test_split_batch(cpu_count: Any) -> None:
 
     ret = builder.split_batch([i for i in range(25)])
@@ -139,9 +145,304 @@ def test_split_batch(cpu_count: Any) -> None:
         assert ret == [[0, 3], [1, 4], [2, 5]]
 
 
+@patch("miyadaiku.builder.get_cpu_count", return_value=2)
+def test_split_batch_costs(cpu_count: Any) -> None:
+    with patch("miyadaiku.builder.MIN_BATCH_SIZE", 1):
+        ret = builder.split_batch(list("abcde"), costs=[1, 8, 2, 3, 4])
+        assert ret == [["b", "a"], ["e", "d", "c"]]
+
+
+def test_estimate_costs(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "small.txt", "a")
+    siteroot.write_text(siteroot.contents / "large.txt", "a" * 10000)
+    siteroot.write_text(siteroot.contents / "known.txt", "a")
+    site = siteroot.load({}, {})
+
+    builders = [
+        builder.Builder(site.files.get_content(((), name)))
+        for name in ["small.txt", "large.txt", "known.txt"]
+    ]
+
+    small, large, known = builder.estimate_costs(
+        site, builders, {((), "known.txt"): 2.0}
+    )
+    assert known == 2.0
+    assert small < large
+
+
 def test_mpbuild(siteroot: SiteRoot) -> None:
 
     siteroot.write_text(siteroot.contents / "test.txt", "test")
     site = siteroot.load({}, {})
 
     site.build()
+
+
+def test_pool(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "test.txt", "test")
+    siteroot.write_text(siteroot.contents / "test2.txt", "test2")
+
+    with builder.BuildPool(2) as pool:
+        site = siteroot.load({}, {}, debug=False)
+        ok, err, *_ = site.build(pool)
+        assert (ok, err) == (2, 0)
+        assert (siteroot.outputs / "test.txt").read_text() == "test"
+        pids = [p.pid for p in pool._procs]
+
+        siteroot.write_text(siteroot.contents / "test.txt", "updated")
+        (siteroot.contents / "test2.txt").unlink()
+
+        site = siteroot.load({}, {}, debug=False)
+        ok, err, *_ = site.build(pool)
+        assert (ok, err) == (1, 0)
+        assert (siteroot.outputs / "test.txt").read_text() == "updated"
+        assert [p.pid for p in pool._procs] == pids
+
+
+def test_pool_modified(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "a.txt", "a")
+    siteroot.write_text(
+        siteroot.contents / "b.md",
+        """:jinja:`{{ page.load("./a.txt").set(body="modified".encode()) }}`""",
+    )
+
+    with builder.BuildPool(1) as pool:
+        site = siteroot.load({}, {}, debug=False)
+        ok, err, *_ = site.build(pool)
+        assert (ok, err) == (2, 0)
+
+        # contents modified in the worker are sent again in the next build
+        assert ((), "a.txt") not in pool._synced
+        assert ((), "b.md") in pool._synced
+
+
+@pytest.mark.parametrize("mode", ["pool", "spawn", "fork"])
+@pytest.mark.parametrize("schedule", ["static", "dynamic"])
+def test_dead_worker(siteroot: SiteRoot, mode: str, schedule: str) -> None:
+    for i in range(10):
+        siteroot.write_text(siteroot.contents / f"{i}.txt", str(i))
+    siteroot.write_text(
+        siteroot.path / "hooks.py",
+        """
+import os
+from miyadaiku.extend import pre_build
+
+@pre_build
+def crash(ctx):
+    if ctx.content.src.contentpath == ((), "5.txt"):
+        os._exit(1)
+    return ctx
+""",
+    )
+
+    site = siteroot.load({}, {}, debug=False)
+    site.schedule = schedule
+    site.jobs = 2
+    site.fork = mode == "fork"
+    if mode == "pool":
+        with builder.BuildPool(2) as pool:
+            ok, err, deps, results, errors = site.build(pool)
+    else:
+        ok, err, deps, results, errors = site.build()
+
+    # builders lost with the dead worker are reported as failed
+    assert ((), "5.txt") in errors
+    built = {src.contentpath for src, *_ in results}
+    assert built | errors == {((), f"{i}.txt") for i in range(10)}
+    assert ok == len(built)
+    assert err == len(errors)
+
+
+@pytest.mark.parametrize("mode", ["pool", "spawn", "fork", "thread"])
+@pytest.mark.parametrize("schedule", ["static", "dynamic"])
+def test_phase_barrier(siteroot: SiteRoot, mode: str, schedule: str) -> None:
+    for i in range(30):
+        siteroot.write_text(
+            siteroot.contents / f"{i}.md", f"---\ntags: [t{i % 3}]\n---\n\n# {i}"
+        )
+    siteroot.write_text(siteroot.contents / "index.yml", "type: index\n")
+    siteroot.write_text(
+        siteroot.contents / "tags.yml", "type: index\ngroupby: tags\n"
+    )
+
+    siteroot.write_text(siteroot.path / "config.yml", "")
+    reportfile = siteroot.path / "report.json"
+    site = miyadaiku.site.Site(rebuild=True, profile=reportfile)
+    site.load(siteroot.path, {})
+    site.schedule = schedule
+    site.jobs = 3
+    site.fork = mode == "fork"
+    if mode == "thread":
+        site.executor = "thread"
+    if mode == "pool":
+        with builder.BuildPool(3) as pool:
+            ok, err, *_ = site.build(pool)
+    else:
+        ok, err, *_ = site.build()
+    assert err == 0
+
+    # pages use fragments rendered by any worker in phase 1
+    report = json.loads(reportfile.read_text())
+    counts = report["counts"] if mode == "thread" else report["workers"]["counts"]
+    assert counts["soup"] == 30
+
+
+def test_forkbuild(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "test.txt", "test")
+    site = siteroot.load({}, {}, debug=False)
+    site.fork = True
+
+    ok, err, *_ = site.build()
+    assert (ok, err) == (1, 0)
+    assert (siteroot.outputs / "test.txt").read_text() == "test"
+
+
+@patch("os.sched_getaffinity", return_value=set(range(8)), create=True)
+def test_get_cpu_count(affinity: Any, tmpdir: Any) -> None:
+    with patch("miyadaiku.builder.CGROUP_ROOT", str(tmpdir)):
+        assert builder.get_cpu_count() == 8
+
+        (tmpdir / "cpu.max").write_text("max 100000", "utf-8")
+        assert builder.get_cpu_count() == 8
+
+        (tmpdir / "cpu.max").write_text("250000 100000", "utf-8")
+        assert builder.get_cpu_count() == 3
+
+        (tmpdir / "cpu.max").remove()
+        (tmpdir / "cpu").mkdir()
+        (tmpdir / "cpu" / "cpu.cfs_quota_us").write_text("100000", "utf-8")
+        (tmpdir / "cpu" / "cpu.cfs_period_us").write_text("100000", "utf-8")
+        assert builder.get_cpu_count() == 1
+
+
+@pytest.mark.parametrize("schedule", ["static", "dynamic"])
+def test_threadbuild(siteroot: SiteRoot, schedule: str) -> None:
+    for i in range(20):
+        siteroot.write_text(siteroot.contents / f"test{i}.md", f"# test{i}")
+    site = siteroot.load({}, {}, debug=False)
+    site.executor = "thread"
+    site.schedule = schedule
+    site.jobs = 2
+
+    with patch("miyadaiku.builder.submit") as submit:
+        ok, err, *_ = site.build()
+        assert not submit.called
+
+    assert (ok, err) == (20, 0)
+    assert "test3" in (siteroot.outputs / "test3.html").read_text()
+
+
+def test_dynamic_schedule(siteroot: SiteRoot) -> None:
+    for i in range(30):
+        siteroot.write_text(siteroot.contents / f"{i}.txt", str(i))
+    site = siteroot.load({}, {}, debug=False)
+    site.schedule = "dynamic"
+
+    ok, err, deps, results, errors = site.build()
+    assert (ok, err) == (30, 0)
+    assert len(results) == 30
+    assert (siteroot.outputs / "29.txt").read_text() == "29"
+
+
+@pytest.mark.parametrize("schedule", ["static", "dynamic"])
+def test_schedule_phases(siteroot: SiteRoot, schedule: str) -> None:
+    for i in range(30):
+        siteroot.write_text(siteroot.contents / f"{i}.md", str(i))
+    siteroot.write_text(siteroot.contents / "index.yml", "type: index")
+    site = siteroot.load({}, {})
+    site.schedule = schedule
+
+    builders = [
+        b
+        for contentpath, content in site.files.items()
+        for b in builder.create_builders(site, content)
+    ]
+    fragments = builder.create_fragment_builders(site, builders)
+    assert len(fragments) == 30
+
+    batches = builder.schedule_batches(site, [fragments, builders], {}, 3)
+    assert len(batches) == 3
+    assert builder.count_outputs(batches) == len(builders)
+
+    if schedule == "dynamic":
+        batches = [builder.interleave(batches)]
+    for batch in batches:
+        kinds = [isinstance(b, builder.FragmentBuilder) for b in batch]
+        assert kinds == sorted(kinds, reverse=True)
+
+
+@patch("miyadaiku.contents.BeautifulSoup", wraps=BeautifulSoup)
+def test_build_fragments(bs: Any, siteroot: SiteRoot) -> None:
+    for i in range(5):
+        siteroot.write_text(
+            siteroot.contents / f"{i}.md", f"tags: a, b, c\n---\n# header{i}"
+        )
+    siteroot.write_text(siteroot.contents / "index.yml", "type: index\ngroupby: tags")
+    site = siteroot.load({}, {})
+
+    ok, err, *_ = site.build()
+    assert (ok, err) == (8, 0)
+    assert bs.call_count == 5
+    assert "header3" in (siteroot.outputs / "index_tags_c.html").read_text()
+
+
+def test_chunkfeeder() -> None:
+    taskqueue: queue.Queue[Any] = queue.Queue()
+    feeder = builder.ChunkFeeder(taskqueue, list(range(100)), 2)  # type: ignore
+    feeder.start()
+    assert [taskqueue.get() for _ in range(4)] == [[0], [1], [2], [3]]
+
+    feeder.chunk_done(1, 0.01)
+    assert taskqueue.get() == list(range(4, 4 + 24))
+
+    feeder.chunk_done(100, 0.01)
+    chunks = []
+    while True:
+        chunk = taskqueue.get()
+        if chunk is None:
+            break
+        chunks.append(chunk)
+        feeder.chunk_done(len(chunk), 0.01)
+
+    assert sum(chunks, []) == list(range(28, 100))
+    assert taskqueue.get() is None
+
+
+def test_build_chunks(siteroot: SiteRoot) -> None:
+    for i in range(25):
+        siteroot.write_text(siteroot.contents / f"{i}.txt", str(i))
+    site = siteroot.load({}, {})
+    jinjaenv = site.build_jinjaenv()
+
+    builders = [
+        b
+        for c in site.files._contentfiles.values()
+        for b in builder.create_builders(site, c)
+    ]
+
+    q: queue.Queue[Any] = queue.Queue()
+    builder.build_chunks(q, site, jinjaenv, builder.split_chunks(builders, 10))
+
+    msgs = []
+    while not q.empty():
+        msgs.append(q.get())
+
+    results = [value for kind, value in msgs if kind == "RESULT"]
+    assert [r[0] for r in results] == [10, 10, 5]
+
+    chunks = [value for kind, value in msgs if kind == "CHUNK"]
+    assert [c[0] for c in chunks] == [10, 10, 5]
+
+
+def test_buildprogress() -> None:
+    loop = asyncio.new_event_loop()
+    try:
+        progress = builder.BuildProgress(loop, 10)
+        progress.add("RESULT", (3, 1, [], {((), "a")}))
+        progress.add("RESULT", (1, 0, [], set()))
+        assert progress.get_result() == (4, 1, [], {((), "a")})
+
+        msg = progress.format_progress(progress._started + 5)
+        assert msg == "Built 5/10 files (1.0 files/sec, ETA 5 secs)"
+    finally:
+        loop.close()
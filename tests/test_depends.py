@@ -1,6 +1,15 @@
+import os
+import sqlite3
+import time
+from typing import List
+from unittest.mock import patch
+
+import pytest
+
 from conftest import SiteRoot
 
-from miyadaiku import depends
+import miyadaiku.site
+from miyadaiku import context, depends, tracking
 
 
 def test_update(siteroot: SiteRoot) -> None:
@@ -122,44 +131,106 @@ def test_rebuild(siteroot: SiteRoot) -> None:
     site.load(site.root, {})
     rebuild, updated, depdict, outputinfos = depends.check_depends(site)
 
-    assert rebuild is True
+    assert rebuild is False
+    assert updated == {((), "file3.rst")}
+
+
+def test_query(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "")
+    siteroot.write_text(siteroot.contents / "a/doc2.md", "")
+    siteroot.write_text(siteroot.contents / "index.yml", "type: index")
+    siteroot.write_text(
+        siteroot.contents / "a/index.yml", "type: index\ndirectories: [.]"
+    )
+
+    site = siteroot.load({}, {})
+    site.build()
+
+    # created content is listed in the index of root directory
+    siteroot.write_text(siteroot.contents / "doc3.md", "")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {((), "doc3.md"), ((), "index.yml")}
+    site.build()
+
+    # removed content is listed in both indexes
+    (siteroot.contents / "a/doc2.md").unlink()
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {((), "index.yml"), (("a",), "index.yml")}
 
 
 def test_yaml(siteroot: SiteRoot) -> None:
-    siteroot.write_text(siteroot.contents / "file1.rst", "")
+    siteroot.write_text(siteroot.contents / "a/doc1.md", "")
+    siteroot.write_text(siteroot.contents / "a/sub/doc2.md", "")
+    siteroot.write_text(siteroot.contents / "a/sub/config.yml", "category: sub")
+    siteroot.write_text(siteroot.contents / "b/doc3.md", "")
 
     site = siteroot.load({}, {})
-    ok, err, deps, results, errors = site.build()
-    orig_outputinfos = depends.update_outputinfos(site, [], results)
-    depends.save_deps(site, deps, orig_outputinfos, errors)
+    site.build()
 
-    siteroot.write_text(siteroot.contents / "file2.yml", "")
+    # config file created
+    siteroot.write_text(siteroot.contents / "a/config.yml", "category: a")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputresults = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {(("a",), "doc1.md")}
+    site.build()
 
+    # cumulative configs are not overridden
+    siteroot.write_text(
+        siteroot.contents / "a/config.yml", "category: a\nimports: macro.html"
+    )
+    siteroot.write_text(siteroot.templates / "macro.html", "")
+    site.load(site.root, {})
     rebuild, updated, depdict, outputresults = depends.check_depends(site)
-    assert rebuild is True
+
+    assert rebuild is False
+    assert updated == {(("a",), "doc1.md"), (("a", "sub"), "doc2.md")}
 
 
 def test_metadata(siteroot: SiteRoot) -> None:
-    siteroot.write_text(siteroot.contents / "file1.rst", "")
-    siteroot.write_text(siteroot.contents / "file2.rst", "")
+    siteroot.write_text(siteroot.contents / "doc1.md", "title: title1\n---\n")
+    siteroot.write_text(
+        siteroot.contents / "doc2.rst", ":jinja:`{{ page.load('doc1.md').title }}`"
+    )
+    siteroot.write_text(
+        siteroot.contents / "index.yml", "type: index\nfilters:\n  tags: [x]"
+    )
 
     site = siteroot.load({}, {})
+    site.build()
 
-    ok, err, deps, results, errors = site.build()
-    orig_outputinfos = depends.update_outputinfos(site, [], results)
-    depends.save_deps(site, deps, orig_outputinfos, errors)
+    # title of doc1 is read by doc2
+    siteroot.write_text(siteroot.contents / "doc1.md", "title: new\n---\n")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
 
-    # test metadata changed
-    (siteroot.contents / "file1.rst").write_text(
-        """
-file1-new-title
-----------------------------
-"""
-    )
+    assert rebuild is False
+    assert updated == {((), "doc1.md"), ((), "doc2.rst")}
+    site.build()
+
+    # metadata not read by other pages
+    siteroot.write_text(siteroot.contents / "doc1.md", "title: new\nfoo: bar\n---\n")
     site.load(site.root, {})
     rebuild, updated, depdict, outputinfos = depends.check_depends(site)
 
-    assert rebuild is True
+    assert rebuild is False
+    assert updated == {((), "doc1.md")}
+    site.build()
+
+    # filtered metadata of all contents is read by index page
+    siteroot.write_text(siteroot.contents / "doc1.md", "title: new\ntags: x\n---\n")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {((), "doc1.md"), ((), "index.yml")}
 
 
 def test_error(siteroot: SiteRoot) -> None:
@@ -204,3 +275,199 @@ file1-new-title
 ----------------------------
 """
     )
+
+
+def test_buildtimes(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "file1.rst", "")
+
+    site = siteroot.load({}, {})
+    ok, err, deps, results, errors = site.build()
+
+    buildtimes = depends.load_buildtimes(site)
+    assert set(buildtimes) == {((), "file1.rst")}
+    assert buildtimes[((), "file1.rst")] > 0
+
+
+def test_templates(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "")
+    siteroot.write_text(siteroot.contents / "index.yml", "type: index")
+    siteroot.write_text(siteroot.templates / "page_index.html", "index")
+    siteroot.write_text(
+        siteroot.templates / "page_article.html", "{% include 'footer.html' %}"
+    )
+    siteroot.write_text(siteroot.templates / "footer.html", "footer")
+
+    site = siteroot.load({}, {})
+    site.build()
+
+    siteroot.write_text(siteroot.templates / "page_index.html", "new index")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {((), "index.yml")}
+    site.build()
+
+    siteroot.write_text(siteroot.templates / "footer.html", "new footer")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {((), "doc1.md")}
+
+
+def test_hash(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.path / "config.yml", "")
+    siteroot.write_text(siteroot.contents / "doc1.md", "")
+    siteroot.write_text(siteroot.contents / "doc2.md", "")
+    siteroot.write_text(siteroot.templates / "page_article.html", "article")
+
+    site = miyadaiku.site.Site(use_hash=True)
+    site.load(siteroot.path, {})
+    site.build()
+
+    # files are touched without modifying contents
+    future = time.time() + 10
+    for path in [
+        siteroot.path / "config.yml",
+        siteroot.contents / "doc1.md",
+        siteroot.templates / "page_article.html",
+    ]:
+        os.utime(path, (future, future))
+
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == set()
+
+    siteroot.write_text(siteroot.contents / "doc2.md", "updated")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {((), "doc2.md")}
+
+
+def test_store(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "file1.rst", "")
+    siteroot.write_text(siteroot.contents / "file2.rst", "")
+
+    site = siteroot.load({}, {})
+    site.build()
+
+    (siteroot.contents / "file1.rst").write_text("updated")
+    site.load(site.root, {})
+    with patch.object(
+        depends.DependsStore,
+        "write",
+        autospec=True,
+        side_effect=depends.DependsStore.write,
+    ) as write:
+        ok, err, deps, results, errors = site.build()
+
+    # only updated records are written
+    records = write.call_args[0][1]
+    assert set(records) == {((), "file1.rst")}
+
+    assert set(deps) == {((), "file1.rst"), ((), "file2.rst")}
+    assert deps[((), "file2.rst")][2] == {"file2.html"}
+    assert len(depends.open_store(site).get_outputinfos()) == 2
+
+
+def test_store_close(siteroot: SiteRoot) -> None:
+    for i in range(5):
+        siteroot.write_text(siteroot.contents / f"file{i}.rst", "")
+
+    site = siteroot.load({}, {})
+    ok, err, deps, results, errors = site.build()
+
+    stores = []
+    statements: List[str] = []
+
+    def open_store(site: miyadaiku.site.Site) -> depends.DependsStore:
+        store = depends.DependsStore(site.root / depends.DEP_FILE)
+        store._conn.set_trace_callback(statements.append)
+        stores.append(store)
+        return store
+
+    site.load(site.root, {})
+    with patch("miyadaiku.depends.open_store", side_effect=open_store):
+        rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+    assert not rebuild
+
+    # records are read by a query
+    selects = [s for s in statements if "FROM contents" in s]
+    assert len(selects) == 1
+
+    # stores are closed, and the records are kept
+    for store in stores:
+        with pytest.raises(sqlite3.ProgrammingError):
+            store._conn.execute("SELECT 1")
+    assert len(depdict) == 5
+    assert depdict[((), "file1.rst")][2] == {"file1.html"}
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        deps._conn.execute("SELECT 1")  # type: ignore
+    assert len(deps) == 5
+
+
+def test_siteconfig(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.rst", ":jinja:`{{ config.ga_id }}`")
+    siteroot.write_text(siteroot.contents / "doc2.rst", "")
+
+    site = siteroot.load({"ga_id": "1", "ipynb_template_name": "classic"}, {})
+    site.build()
+
+    siteroot.write_text(
+        siteroot.path / "config.yml", "ga_id: 2\nipynb_template_name: classic"
+    )
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert updated == {((), "doc1.rst")}
+    site.build()
+
+    # configs read while loading contents
+    siteroot.write_text(siteroot.path / "config.yml", "ga_id: 2")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is True
+
+
+def test_render_cache_reads(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.rst", "title\n----\n\nsub\n^^^\n")
+    site = siteroot.load({}, {})
+    jinjaenv = site.build_jinjaenv()
+    context.render_cache.clear()
+
+    # html rendered by another output context is taken from the render
+    # cache, with the reads made while rendering.
+    reads = []
+    for i in range(2):
+        ctx = context.JinjaOutput(site, jinjaenv, ((), "doc1.rst"))
+        with tracking.track() as r:
+            ctx.build()
+        reads.append(r)
+
+    assert context.render_cache.get("html", ctx.content) is not None
+    assert ((), "short_header_id") in reads[0].configs
+    assert ((), "short_header_id") in reads[1].configs
+
+
+def test_fragment_reads(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.rst", "title\n----\n\nsub\n^^^\n")
+    siteroot.write_text(siteroot.contents / "doc2.rst", "title2\n------\n")
+
+    # fragments are rendered in phase 1, and possibly in other processes
+    site = siteroot.load({}, {}, debug=False)
+    site.build()
+
+    siteroot.write_text(siteroot.path / "config.yml", "short_header_id: true")
+    site.load(site.root, {})
+    rebuild, updated, depdict, outputinfos = depends.check_depends(site)
+
+    assert rebuild is False
+    assert ((), "doc1.rst") in updated
@@ -0,0 +1,42 @@
+import json
+
+from conftest import SiteRoot
+
+import miyadaiku.site
+from miyadaiku import explain
+
+
+def test_explain(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.rst", "")
+    siteroot.write_text(
+        siteroot.contents / "doc2.rst", ":jinja:`{{ page.load('doc1.rst').html }}`"
+    )
+    siteroot.write_text(siteroot.contents / "doc3.rst", "")
+    siteroot.write_text(siteroot.path / "config.yml", "")
+
+    reportfile = siteroot.path / "explain.json"
+    site = miyadaiku.site.Site(explain=reportfile)
+    site.load(siteroot.path, {})
+    site.build()
+    assert explain.get_explainer() is None
+
+    report = json.loads(reportfile.read_text())
+    assert report["rebuild"] == {"reason": "no_depends_file"}
+    assert len(report["contents"]) == 3
+
+    siteroot.write_text(siteroot.contents / "doc1.rst", "updated")
+    site.load(siteroot.path, {})
+    site.build()
+
+    report = json.loads(reportfile.read_text())
+    assert report["rebuild"] is None
+    assert report["num_builders"] == 2
+
+    reasons = {d["contentpath"]: d["reasons"] for d in report["contents"]}
+    assert reasons == {
+        "doc1.rst": [{"reason": "source"}],
+        "doc2.rst": [{"reason": "dependency", "content": "doc1.rst"}],
+    }
+
+    summary = explain.format_summary(report)
+    assert "source: 1 contents (doc1.rst)" in summary
@@ -0,0 +1,170 @@
+import pathlib
+import pickle
+import secrets
+import sqlite3
+from typing import Any
+from unittest.mock import patch
+
+from conftest import SiteRoot
+
+from miyadaiku import ContentSrc, filecache
+
+
+def _src(name: str) -> ContentSrc:
+    return ContentSrc(
+        package="",
+        srcpath=name,
+        metadata={"type": "article", "loader": "md"},
+        contentpath=((), name),
+        mtime=0,
+    )
+
+
+def test_filecache(tmpdir: Any) -> None:
+    filename = pathlib.Path(str(tmpdir)) / filecache.CACHE_FILE
+
+    cache = filecache.FileCache(filename)
+    body = b"body" * 1000
+    loaded = cache.put("a", filecache.CacheEntry((1, 2), None, [(_src("a"), body)]))
+    cache.put("b", filecache.CacheEntry((3, 4), "digest", [(_src("b"), None)]))
+
+    # bodies are replaced by references
+    ((src, ref),) = loaded
+    assert isinstance(ref, filecache.BodyRef)
+    assert ref.size == len(body)
+    assert cache.get("a") == ((1, 2), None, loaded)
+    assert cache.read(ref) == body
+    cache.close()
+    assert ref.load() == body
+
+    # bodies are compressed
+    conn = sqlite3.connect(str(filename))
+    (size,) = conn.execute("SELECT length(body) FROM bodies").fetchone()
+    conn.close()
+    assert size < len(body)
+
+    cache = filecache.FileCache(filename)
+    assert cache.get("a") == ((1, 2), None, loaded)
+    assert cache.get("b") == ((3, 4), "digest", [(_src("b"), None)])
+    assert cache.read(ref) == body
+    cache.close()
+
+    # entries not read are removed
+    cache = filecache.FileCache(filename)
+    assert cache.get("a")
+    cache.close(evict=True)
+
+    cache = filecache.FileCache(filename)
+    assert cache.get("a")
+    assert not cache.get("b")
+    cache.close(evict=True)
+
+    # unused bodies are removed
+    cache = filecache.FileCache(filename)
+    cache.put("a", filecache.CacheEntry((1, 3), None, [(_src("a"), b"new")]))
+    cache.close(evict=True)
+
+    conn = sqlite3.connect(str(filename))
+    assert conn.execute("SELECT COUNT(*) FROM bodies").fetchone() == (1,)
+    conn.close()
+
+    # cache is cleared
+    cache = filecache.FileCache(filename, clear=True)
+    assert not cache.get("a")
+    cache.close()
+
+
+def test_batch(tmpdir: Any) -> None:
+    filename = pathlib.Path(str(tmpdir)) / filecache.CACHE_FILE
+
+    cache = filecache.FileCache(filename)
+    with patch.object(cache, "flush", wraps=cache.flush) as flush:
+        for i in range(filecache.BATCH_SIZE * 2 + 1):
+            name = str(i)
+            cache.put(name, filecache.CacheEntry((i, i), None, [(_src(name), b"")]))
+        assert flush.call_count == 2
+    cache.close()
+
+    cache = filecache.FileCache(filename)
+    assert cache.info().files == filecache.BATCH_SIZE * 2 + 1
+    cache.close()
+
+
+def test_version(tmpdir: Any) -> None:
+    filename = pathlib.Path(str(tmpdir)) / filecache.CACHE_FILE
+
+    # not a sqlite file
+    filename.write_bytes(b"x" * 1024)
+    cache = filecache.FileCache(filename)
+    cache.put("a", filecache.CacheEntry((1, 2), None, [(_src("a"), b"")]))
+    cache.close()
+
+    with patch("miyadaiku.filecache.CACHE_VER", "0.0.0"):
+        cache = filecache.FileCache(filename)
+        assert not cache.get("a")
+        assert cache.info().ver == "0.0.0"
+        cache.close()
+
+
+def test_lazy_body(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.txt", "text1")
+    site = siteroot.load({}, {})
+
+    doc1 = site.files.get_content(((), "doc1.txt"))
+    assert isinstance(doc1._body, filecache.BodyRef)
+    assert doc1.get_body_size() == len(doc1.get_body())
+
+    # bodies are not read while loading
+    with patch("miyadaiku.filecache.load_body", wraps=filecache.load_body) as load:
+        site = siteroot.load({}, {})
+        assert not load.called
+
+        doc1 = site.files.get_content(((), "doc1.txt"))
+        assert b"text1" in doc1.get_body()
+        assert load.called
+
+    # pickled with the reference
+    assert b"text1" not in pickle.dumps(doc1)
+
+    doc1.body = b"updated"
+    assert doc1.get_body() == b"updated"
+    assert doc1.get_body_size() == 7
+
+
+def test_compact(siteroot: SiteRoot) -> None:
+    for i in range(10):
+        siteroot.write_text(siteroot.contents / f"doc{i}.txt", secrets.token_hex(10000))
+    siteroot.load({}, {})
+
+    for i in range(9):
+        (siteroot.contents / f"doc{i}.txt").unlink()
+    site = siteroot.load({}, {})
+
+    before, after = filecache.compact(site.root)
+    assert before.files == after.files == 1
+    assert after.ver == filecache.CACHE_VER
+    assert after.size < before.size
+
+
+def test_package(tmpdir: Any) -> None:
+    filename = pathlib.Path(str(tmpdir)) / filecache.CACHE_FILE
+
+    cache = filecache.FileCache(filename)
+    assert cache.get_package("pkg_contents", "pkg", "1.0") is None
+    cache.put_package("pkg_contents", "pkg", "1.0", [_src("a")])
+    cache.close()
+
+    cache = filecache.FileCache(filename)
+    assert cache.get_package("pkg_contents", "pkg", "2.0") is None
+    assert not cache.fixed_packages
+    assert cache.get_package("pkg_contents", "pkg", "1.0") == [_src("a")]
+    assert cache.fixed_packages == {"pkg"}
+    cache.close(evict=True)
+
+    # entries of packages not read are removed
+    cache = filecache.FileCache(filename)
+    cache.close(evict=True)
+
+    cache = filecache.FileCache(filename)
+    assert cache.get_package("pkg_contents", "pkg", "1.0") is None
+    cache.close()
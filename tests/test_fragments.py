@@ -0,0 +1,113 @@
+import sqlite3
+from typing import Any
+from unittest.mock import patch
+
+from conftest import SiteRoot
+
+from miyadaiku import context, fragments, repr_contentpath
+
+
+def test_fragments(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "# header\n\ntext")
+    siteroot.write_text(
+        siteroot.contents / "index.yml",
+        """
+type: index
+""",
+    )
+
+    site = siteroot.load({}, {})
+    site.build()
+
+    site = siteroot.load({}, {})
+    jinjaenv = site.build_jinjaenv()
+    context.render_cache.clear()
+
+    doc1 = site.files.get_content(((), "doc1.md"))
+    ctx = context.IndexOutput(site, jinjaenv, ((), "index.yml"), "", [doc1], 1, 1)
+
+    with patch("miyadaiku.contents.BeautifulSoup") as bs:
+        assert "text" in doc1.get_html(ctx)
+        assert doc1.get_headers(ctx)[0].text == "header"
+        assert "text" in doc1.build_abstract(ctx)
+        assert not bs.called
+
+    # soup is rebuilt from html
+    assert doc1.build_abstract(ctx, plain=True) == "header text"
+
+    # updated source is rendered again
+    doc1.body = b"<p>updated</p>"
+    context.render_cache.clear()
+    ctx = context.IndexOutput(site, jinjaenv, ((), "index.yml"), "", [doc1], 1, 1)
+    assert "updated" in doc1.get_html(ctx)
+
+
+def test_fragments_modified(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "text")
+    site = siteroot.load({}, {})
+    site.build()
+
+    site = siteroot.load({}, {})
+    doc1 = site.files.get_content(((), "doc1.md"))
+    context.render_cache.clear()
+    context.render_cache.invalidate(doc1)
+    assert not fragments.load(site, doc1)
+
+    context.render_cache.clear()
+    assert fragments.load(site, doc1)
+
+
+@patch("miyadaiku.fragments.FragmentStore.put")
+def test_fragments_rebuild(put: Any, siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "text")
+    site = siteroot.load({}, {})
+    site.build()
+    assert put.called
+
+    site = siteroot.load({}, {})
+    site.rebuild = True
+    doc1 = site.files.get_content(((), "doc1.md"))
+    context.render_cache.clear()
+    assert not fragments.load(site, doc1)
+
+
+def test_fragments_updated_module(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "text")
+    site = siteroot.load({}, {})
+    site.build()
+
+    site = siteroot.load({}, {})
+    site.build()
+    assert site.reuse_fragments
+
+    # filters in modules may be updated
+    siteroot.write_text(siteroot.modules / "filters.py", "")
+    site = siteroot.load({}, {})
+    site.build()
+    assert not site.reuse_fragments
+
+    # fragments rendered by the current build are used
+    doc1 = site.files.get_content(((), "doc1.md"))
+    context.render_cache.clear()
+    assert fragments.load(site, doc1)
+
+    # fragments rendered by other builds are not used
+    site.build_id = fragments.new_build_id()
+    context.render_cache.clear()
+    assert not fragments.load(site, doc1)
+
+
+def test_fragments_prune(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "text1")
+    siteroot.write_text(siteroot.contents / "doc2.md", "text2")
+    site = siteroot.load({}, {})
+    site.build()
+
+    (siteroot.contents / "doc2.md").unlink()
+    site = siteroot.load({}, {})
+    site.build()
+
+    conn = sqlite3.connect(str(site.root / fragments.FRAGMENT_FILE))
+    rows = conn.execute("SELECT contentpath FROM fragments").fetchall()
+    conn.close()
+    assert rows == [(repr_contentpath(((), "doc1.md")),)]
@@ -1,7 +1,10 @@
+from typing import Any
+from unittest.mock import patch
+
 from bs4 import BeautifulSoup
 from conftest import SiteRoot, create_contexts
 
-from miyadaiku import context
+from miyadaiku import context, jinjaenv
 
 
 def test_build(siteroot: SiteRoot) -> None:
@@ -205,3 +208,42 @@ def test_link_recurse(siteroot: SiteRoot) -> None:
     soup = BeautifulSoup(proxy2.html, "html.parser")
     a = soup.find_all("a")[-1]
     assert "Circular reference detected" in a.text
+
+
+@patch("miyadaiku.contents.BeautifulSoup", wraps=BeautifulSoup)
+def test_render_cache(bs: Any, siteroot: SiteRoot) -> None:
+    (ctx1, ctx2) = create_contexts(
+        siteroot,
+        srcs=[
+            ("doc1.html", "<h1>header{{ 1+1 }}</h1>"),
+            ("doc2.html", "<h1>{{ page.title }}</h1>"),
+        ],
+    )
+    doc1 = ctx1.content
+    doc2 = ctx2.content
+    ctx3 = context.JinjaOutput(ctx1.site, ctx1.jinjaenv, doc2.src.contentpath)
+
+    # doc1 refers no variables
+    assert doc1.get_html(ctx2) == doc1.get_html(ctx3)
+    assert doc1.build_abstract(ctx2) == doc1.build_abstract(ctx3)
+    assert doc1.get_headers(ctx3)[0].text == "header2"
+    assert bs.call_count == 1
+
+    # doc2 refers page
+    assert doc2.get_html(ctx1) != doc2.get_html(ctx2)
+    assert bs.call_count == 3
+
+    # invalidated by ContentProxy.set()
+    context.ContentProxy(ctx1, doc1).set(body=b"<h1>updated</h1>")
+    assert "updated" in doc1.get_html(ctx1)
+
+
+def test_is_context_free(siteroot: SiteRoot) -> None:
+    site = siteroot.load({}, {})
+    env = site.build_jinjaenv()
+
+    assert jinjaenv.is_context_free(env, "abc")
+    assert jinjaenv.is_context_free(env, "{{ 1 + 1 }}{% set a = 1 %}{{ a }}")
+    assert not jinjaenv.is_context_free(env, "{{ page.title }}")
+    assert not jinjaenv.is_context_free(env, "{% include 'a.html' %}")
+    assert not jinjaenv.is_context_free(env, "{{ }")
@@ -1,8 +1,9 @@
-from typing import Set
+from typing import Any, Dict, Set
+from unittest.mock import patch
 
 from conftest import SiteRoot
 
-from miyadaiku import ContentSrc, config, contents, loader, site
+from miyadaiku import ContentSrc, config, contents, filecache, filetree, loader, site
 
 
 def test_walk_directory(siteroot: SiteRoot) -> None:
@@ -39,7 +40,88 @@ def test_walk_directory(siteroot: SiteRoot) -> None:
     )
 
 
-def test_walkpackage() -> None:
+def test_filetree(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "dir1/file1", "")
+    siteroot.write_text(siteroot.contents / "dir1/file1.props.yml", "name: value")
+    siteroot.write_text(siteroot.contents / ".dir2/file2", "")
+    siteroot.write_text(siteroot.contents / "file3.bak", "")
+
+    tree = filetree.FileTree(siteroot.contents, {"*.bak"})
+    assert [e.relpath for e in tree] == ["dir1/file1"]
+    assert tree.entries[0].metadatafile == str(
+        siteroot.contents / "dir1/file1.props.yml"
+    )
+
+    # every file is listed without ignores
+    tree = filetree.FileTree(siteroot.contents)
+    assert sorted(e.relpath for e in tree) == [
+        ".dir2/file2",
+        "dir1/file1",
+        "dir1/file1.props.yml",
+        "file3.bak",
+    ]
+
+    # files are scanned once
+    trees = filetree.FileTrees()
+    assert trees.get(siteroot.contents) is trees.get(siteroot.contents)
+    assert trees.get(siteroot.contents) is not trees.get(siteroot.contents, {"*.bak"})
+
+
+def test_loadfile_stat(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.txt", "text")
+    site = siteroot.load({}, {})
+
+    # stat read by walk is used
+    with patch.object(ContentSrc, "stat", side_effect=AssertionError) as stat:
+        site.load(site.root, {})
+        assert not stat.called
+    assert site.files.has_content(((), "doc1.txt"))
+
+
+@patch("miyadaiku.loader.PARALLEL_LOAD_MIN", 1)
+def test_loadfiles_parallel(siteroot: SiteRoot) -> None:
+    for i in range(5):
+        siteroot.write_text(siteroot.contents / f"doc{i}.md", f"# title{i}\n\ntext")
+        siteroot.write_text(siteroot.contents / f"doc{i}.rst", f"title{i}\n----")
+    siteroot.write_text(siteroot.contents / "config.yml", "prop: value")
+    siteroot.write_text(
+        siteroot.path / "hooks.py",
+        """
+import itertools
+from miyadaiku.extend import post_load
+
+counter = itertools.count()
+
+@post_load
+def post_load_hook(site, src, binary, body):
+    src.metadata["order"] = next(counter)
+    return src, body
+""",
+    )
+
+    def load(debug: bool) -> Dict[Any, Any]:
+        site = siteroot.load({}, {}, debug=debug)
+        assert site.config.get((), "prop") == "value"
+        return {
+            path: (content.src.metadata["order"], content.body)
+            for path, content in site.files.items()
+        }
+
+    serial = load(debug=True)
+
+    for f in siteroot.path.glob(f"{filecache.CACHE_FILE}*"):
+        f.unlink()
+
+    with patch("miyadaiku.loader.loadfile", wraps=loader.loadfile) as loadfile:
+        parallel = load(debug=False)
+
+        # markdown and rst files are not parsed in this process
+        srcpaths = {call[0][1].srcpath for call in loadfile.call_args_list}
+        assert srcpaths == {str(siteroot.contents / "config.yml")}
+
+    assert parallel == serial
+    assert b"title1" in serial[((), "doc1.md")][1]
+
     results = loader.walk_package("package1", "contents", {"*.bak", ".*"})
     all = sorted(results, key=lambda d: str(d.srcpath))
 
@@ -53,6 +135,62 @@ def test_walkpackage() -> None:
     )
 
 
+@patch("miyadaiku.loader.PARALLEL_LOAD_MIN", 1)
+def test_loadfiles_parallel_hooks(siteroot: SiteRoot) -> None:
+    for i in range(5):
+        siteroot.write_text(
+            siteroot.contents / f"doc{i}.rst", f"title{i}\n----\n\n.. hello::\n"
+        )
+    siteroot.write_text(
+        siteroot.path / "hooks.py",
+        """
+from docutils import nodes
+from docutils.parsers.rst import Directive, directives
+
+class Hello(Directive):
+    def run(self):
+        return [nodes.paragraph(text="hello from hooks")]
+
+directives.register_directive("hello", Hello)
+""",
+    )
+
+    with patch("miyadaiku.loader.loadfile", wraps=loader.loadfile) as loadfile:
+        site = siteroot.load({}, {}, debug=False)
+
+        # parsed by loader processes
+        assert not loadfile.called
+
+    # directives registered by hooks are available in loader processes
+    for i in range(5):
+        body = site.files.get_content(((), f"doc{i}.rst")).get_body()
+        assert b"hello from hooks" in body
+
+
+def test_loadfiles_few_misses(siteroot: SiteRoot) -> None:
+    for i in range(3):
+        siteroot.write_text(siteroot.contents / f"doc{i}.md", f"# title{i}")
+    site = siteroot.load({}, {}, debug=False)
+    site.use_hash = True
+
+    for f in siteroot.path.glob(f"{filecache.CACHE_FILE}*"):
+        f.unlink()
+
+    files = loader.ContentFiles()
+    cfg = config.Config({})
+    with patch("miyadaiku.loader.LoadPool") as pool:
+        with patch.object(
+            ContentSrc, "digest", autospec=True, side_effect=ContentSrc.digest
+        ) as digest:
+            loader.loadfiles(site, files, cfg, siteroot.path, set(), [])
+
+    # parsed in this process, and hashed once
+    assert not pool.return_value.map.called
+    srcpaths = [call[0][0].srcpath for call in digest.call_args_list]
+    assert len(srcpaths) == len(set(srcpaths)) == 3
+    assert b"title1" in files.get_content(((), "doc1.md")).get_body()
+
+
 def test_loadfiles(siteroot: SiteRoot) -> None:
     siteroot.write_text(siteroot.contents / "root1.yml", "root_prop: root_prop_value")
     siteroot.write_text(siteroot.contents / "root1.txt", "content_root1")
@@ -98,6 +236,38 @@ def test_loadfiles(siteroot: SiteRoot) -> None:
     assert cfg.get((), "package3_prop_a1") == "value_package3_a1"
 
 
+def test_walk_cached_package(siteroot: SiteRoot) -> None:
+    # not installed by pip
+    assert loader.get_package_fingerprint("package3") is None
+    assert loader.get_package_fingerprint("pygments")
+
+    def load() -> loader.ContentFiles:
+        site = siteroot.load({"themes": ["package3"]}, {})
+        return site.files
+
+    fingerprint = "package3:1.0:/site-packages/package3"
+    with patch("miyadaiku.loader.get_package_fingerprint", return_value=fingerprint):
+        files1 = load()
+        with patch("miyadaiku.loader.walk_package", wraps=loader.walk_package) as walk:
+            with patch.object(ContentSrc, "stat", wraps=ContentSrc.stat) as stat:
+                files2 = load()
+                assert not walk.called
+                assert not stat.called
+
+    assert files2._contentfiles.keys() == files1._contentfiles.keys()
+    content = files2.get_content(((), "package3_root.rst"))
+    assert content.src.package == "package3"
+    assert b"package3/contents/package3_root.rst" in content.get_body()
+
+    # walked again if upgraded
+    with patch("miyadaiku.loader.get_package_fingerprint", return_value="2.0"):
+        with patch("miyadaiku.loader.walk_package", wraps=loader.walk_package) as walk:
+            load()
+            walked = [call[0][:2] for call in walk.call_args_list]
+            assert ("package3", "contents") in walked
+            assert ("package3", "files") in walked
+
+
 def test_get_contents(siteroot: SiteRoot) -> None:
     siteroot.write_text(
         siteroot.contents / "a.rst",
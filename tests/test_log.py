@@ -1,3 +1,5 @@
+import logging
+import queue
 from typing import Any
 from unittest.mock import patch
 
@@ -167,3 +169,23 @@ def test_jinja_err_both(siteroot: SiteRoot) -> None:
     assert "page_article.html" in e.errors[0][0]
     assert "abc/index.rst#html" in e.errors[1][0]
     assert ">>> {{ = }}" in e.errors[1][2]
+
+
+def test_mp_logging_flush() -> None:
+    q: queue.Queue[Any] = queue.Queue()
+    try:
+        mp_log.init_mp_logging(q)
+        logger = logging.getLogger("test_mp_logging_flush")
+        for i in range(mp_log.MAX_PENDINGS + 1):
+            logger.info("msg %d", i)
+
+        kind, msgs = q.get_nowait()
+        assert kind == "LOGS"
+        assert len(msgs) == mp_log.MAX_PENDINGS
+        assert q.empty()
+
+        mp_log.flush_mp_logging()
+        kind, msgs = q.get_nowait()
+        assert msgs[0]["msg"] == f"msg {mp_log.MAX_PENDINGS}"
+    finally:
+        mp_log.init_logging()
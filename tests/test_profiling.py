@@ -0,0 +1,66 @@
+import json
+import time
+
+import pytest
+from conftest import SiteRoot
+
+import miyadaiku.site
+from miyadaiku import profiling
+
+
+def test_phase() -> None:
+    profiler = profiling.enable()
+    try:
+        with profiling.phase("outer"):
+            time.sleep(0.01)
+            with profiling.phase("inner"):
+                time.sleep(0.02)
+
+        d = profiler.to_dict()
+    finally:
+        profiling.disable()
+
+    assert 0.01 <= d["phases"]["outer"] < 0.02
+    assert d["phases"]["inner"] >= 0.02
+    assert sum(d["phases"].values()) == pytest.approx(d["wall"])
+
+
+def test_phase_disabled() -> None:
+    profiling.disable()
+    with profiling.phase("outer"):
+        pass
+    assert profiling.get_profiler() is None
+
+
+@pytest.mark.parametrize("debug", [True, False])
+def test_profile(siteroot: SiteRoot, debug: bool) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "# header\n\ntext")
+    siteroot.write_text(siteroot.contents / "doc2.txt", "text")
+    siteroot.write_text(siteroot.path / "config.yml", "")
+
+    reportfile = siteroot.path / "report.json"
+    site = miyadaiku.site.Site(debug=debug, profile=reportfile)
+    site.load(siteroot.path, {})
+    ok, err, *_ = site.build()
+    assert (ok, err) == (2, 0)
+    assert profiling.get_profiler() is None
+
+    report = json.loads(reportfile.read_text())
+    assert sum(report["phases"].values()) == pytest.approx(report["wall"])
+    for name in ["walk", "loadfile", "build", "save_depends", "sitemap"]:
+        assert name in report["phases"]
+
+    if debug:
+        phases = report["phases"]
+    else:
+        phases = report["workers"]["phases"]
+        assert report["workers"]["num"] >= 1
+        assert "worker_startup" in phases
+    for name in ["build_context", "jinja", "soup", "write"]:
+        assert name in phases
+
+    contentpaths = [d["contentpath"] for d in report["contents"]]
+    assert sorted(contentpaths) == ["doc1.md", "doc2.txt"]
+
+    templates = {d["template"]: d["count"] for d in report["templates"]}
+    assert templates["page_article.html"] == 1
@@ -0,0 +1,100 @@
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from conftest import SiteRoot
+
+from miyadaiku import publish
+
+
+def test_publish_file(tmpdir: Any) -> None:
+    src = Path(str(tmpdir)) / "src.bin"
+    dest = Path(str(tmpdir)) / "dest.bin"
+    src.write_bytes(b"body" * 1000)
+
+    assert publish.publish_file(str(src), dest) != "unchanged"
+    assert dest.read_bytes() == src.read_bytes()
+    assert dest.stat().st_mtime_ns == src.stat().st_mtime_ns
+    assert not os.path.samefile(src, dest)
+
+    assert publish.publish_file(str(src), dest) == "unchanged"
+
+    # updated file of the same size
+    src.write_bytes(b"BODY" * 1000)
+    os.utime(src, ns=(0, src.stat().st_mtime_ns + 10 ** 9))
+    assert publish.publish_file(str(src), dest) != "unchanged"
+    assert dest.read_bytes() == b"BODY" * 1000
+
+
+def test_publish_link(tmpdir: Any) -> None:
+    src = Path(str(tmpdir)) / "src.bin"
+    dest = Path(str(tmpdir)) / "dest.bin"
+    src.write_bytes(b"body")
+    dest.write_bytes(b"old")
+
+    assert publish.publish_file(str(src), dest, "link") == "link"
+    assert os.path.samefile(src, dest)
+    assert publish.publish_file(str(src), dest, "link") == "unchanged"
+
+
+def test_publish_hash(tmpdir: Any) -> None:
+    src = Path(str(tmpdir)) / "src.bin"
+    dest = Path(str(tmpdir)) / "dest.bin"
+    src.write_bytes(b"body")
+    dest.write_bytes(b"body")
+    os.utime(dest, ns=(0, 0))
+
+    assert publish.publish_file(str(src), dest, use_hash=True) == "unchanged"
+    assert dest.stat().st_mtime_ns == src.stat().st_mtime_ns
+
+    os.utime(dest, ns=(0, 0))
+    assert publish.publish_file(str(src), dest) != "unchanged"
+
+
+def test_publish_bytes(tmpdir: Any) -> None:
+    dest = Path(str(tmpdir)) / "dest.bin"
+    assert publish.publish_bytes(b"body", dest) == "write"
+    assert publish.publish_bytes(b"body", dest) == "unchanged"
+    assert publish.publish_bytes(b"body2", dest) == "write"
+    assert dest.read_bytes() == b"body2"
+
+
+def test_binary_output(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.files / "file1.txt", "file1")
+    siteroot.write_text(siteroot.files / "file2.txt", "file2")
+    siteroot.write_text(siteroot.files / "file2.txt.props.yml", "binary_publish: link")
+
+    site = siteroot.load({}, {})
+    site.build()
+
+    file1 = site.outputdir / "file1.txt"
+    file2 = site.outputdir / "file2.txt"
+    assert file1.read_text() == "file1"
+    assert not os.path.samefile(file1, siteroot.files / "file1.txt")
+    assert os.path.samefile(file2, siteroot.files / "file2.txt")
+
+    # unchanged outputs are kept
+    ino = file1.stat().st_ino
+    site = siteroot.load({}, {})
+    site.build()
+    assert file1.stat().st_ino == ino
+
+
+def test_publish_mode(siteroot: SiteRoot, caplog: pytest.LogCaptureFixture) -> None:
+    siteroot.write_text(siteroot.files / "file1.txt", "file1")
+    siteroot.write_text(
+        siteroot.files / "file1.txt.props.yml", "binary_publish: hardlink"
+    )
+
+    site = siteroot.load({}, {})
+    with caplog.at_level(logging.ERROR, logger="miyadaiku.publish"):
+        site.build()
+
+    assert "invalid binary_publish value 'hardlink'" in caplog.text
+
+    file1 = site.outputdir / "file1.txt"
+    assert file1.read_text() == "file1"
+    assert not os.path.samefile(file1, siteroot.files / "file1.txt")
@@ -0,0 +1,74 @@
+import argparse
+import importlib
+import os
+import time
+from typing import Any
+from unittest.mock import patch
+
+from conftest import SiteRoot
+
+from miyadaiku import snapshot
+
+# muneage is not type checked
+muneage: Any = importlib.import_module("miyadaiku.scripts.muneage")
+
+
+def test_snapshot(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "text")
+    site = siteroot.load({}, {})
+    since = time.time_ns()
+    site.build()
+
+    assert not snapshot.is_uptodate(site.root, site.outputdir, {})
+    snapshot.save(site.root, site.outputdir, {}, site.themes, since)
+    assert snapshot.is_uptodate(site.root, site.outputdir, {})
+
+    # props differ
+    assert not snapshot.is_uptodate(site.root, site.outputdir, {"a": "b"})
+
+    # updated source
+    doc1 = siteroot.contents / "doc1.md"
+    os.utime(doc1, ns=(since, since))
+    assert not snapshot.is_uptodate(site.root, site.outputdir, {})
+    snapshot.save(site.root, site.outputdir, {}, site.themes)
+    assert snapshot.is_uptodate(site.root, site.outputdir, {})
+
+    # new directory
+    (siteroot.contents / "subdir").mkdir()
+    assert not snapshot.is_uptodate(site.root, site.outputdir, {})
+    snapshot.save(site.root, site.outputdir, {}, site.themes)
+
+    # removed output
+    (site.outputdir / "doc1.html").unlink()
+    assert not snapshot.is_uptodate(site.root, site.outputdir, {})
+    snapshot.save(site.root, site.outputdir, {}, site.themes)
+
+    # hooks.py
+    siteroot.write_text(siteroot.path / "hooks.py", "")
+    assert not snapshot.is_uptodate(site.root, site.outputdir, {})
+
+    # source updated during build
+    snapshot.save(site.root, site.outputdir, {}, site.themes, since)
+    assert not (site.root / snapshot.SNAPSHOT_FILE).exists()
+
+
+def test_muneage(siteroot: SiteRoot) -> None:
+    siteroot.write_text(siteroot.contents / "doc1.md", "text")
+    siteroot.write_text(siteroot.path / "config.yml", "")
+    outputs = siteroot.path / "outputs"
+    outputs.mkdir(exist_ok=True)
+
+    args = muneage.parser.parse_args([str(siteroot.path), "-D"])
+    assert isinstance(args, argparse.Namespace)
+    assert muneage.build(siteroot.path, outputs, {}, args) == 0
+    assert (outputs / "doc1.html").exists()
+
+    with patch("miyadaiku.site.Site") as site:
+        site.return_value.build.return_value = (1, 0, None, None)
+        site.return_value.themes = []
+        assert muneage.build(siteroot.path, outputs, {}, args) == 0
+        assert not site.called
+
+        args.rebuild = True
+        muneage.build(siteroot.path, outputs, {}, args)
+        assert site.called